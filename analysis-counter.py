@@ -35,7 +35,7 @@ def main(argv):
     setup_logging(".%s.log" % os.path.splitext(os.path.basename(__file__))[0], aargs.verbose, False, True, True)
     logging.debug(aargs)
 
-    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir)
+    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir, inference=True)
     averages = categorize_rates(lstm, data.stream_data(aargs.data_dir, aargs.kind), aargs.dimensions, aargs.report)
     rows = [("", "0", "1")]
 
@@ -72,19 +72,19 @@ def categorize_rates(lstm, xys, dimensions, report):
     largest_drop = {dimension: (None, None, None) for dimension in dimensions}
     minimum_growth = {dimension: (None, None, None) for dimension in dimensions}
 
-    for j, xy in enumerate(xys):
+    for j, xy_instruments in enumerate(rnn.stream_instrumented(lstm, xys, ["cells"])):
         if j % 1000 == 0:
             logging.debug("At the %d-Kth instance." % (int(j / 1000)))
 
+        xy, timestep_instruments = xy_instruments
         sequence = [item[0] for item in xy.x]
         total += 1
-        stepwise_rnn = lstm.stepwise(handle_unknown=True)
         cells = []
         previous = None
         index = None
 
         for i, word_pos in enumerate(xy.x):
-            result, instruments = stepwise_rnn.step(word_pos[0], ["cells"])
+            instruments = timestep_instruments[i]
             state = instruments["cells"][0]
             activations = [state[dimension] for dimension in dimensions]
             cells += [activations]
@@ -5,11 +5,11 @@ from csv import writer as csv_writer
 import glob
 import math
 import logging
+import numpy as np
 import os
 import pdb
 import queue
 import random
-import statistics
 import sys
 
 from nnwd import data
@@ -67,18 +67,12 @@ def main(argv):
 
 
 def calculate_stats(hidden_states):
-    #flattened = adjutant.flat_map([[float(v) for v in hs.point] for hs in hidden_states])
-    points = [[float(v) for v in hs.point] for hs in hidden_states]
-    flattened = adjutant.flat_map(points)
-    global_average = sum(flattened) / len(flattened)
-    count = 0
-    total = 0
-
-    for point in points:
-        count += 1
-        total += sum([(v - global_average)**2 for v in point]) / len(point)
-
-    return {"stdev": statistics.stdev(flattened), "mse": total / count}
+    points = states.points(hidden_states).astype("float64")
+    global_average = points.mean()
+    # Sample standard deviation (as per statistics.stdev) across every value of every point.
+    stdev = points.std(ddof=1)
+    mse = ((points - global_average)**2).mean(axis=1).mean()
+    return {"stdev": float(stdev), "mse": float(mse)}
 
 
 if __name__ == "__main__":
@@ -17,14 +17,21 @@ from nnwd import parameters
 from nnwd import pickler
 from nnwd import rnn
 
+from pytils import check
 from pytils.log import setup_logging, teardown, user_log
 
 
+STREAM_LOG_RATE = 1000
+BATCH_SIZE = 32
+
 @teardown
 def main(argv):
     ap = ArgumentParser(prog="generate-activation-states")
     ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Turn on verbose logging.")
     #ap.add_argument("-d", "--dry-run", default=False, action="store_true")
+    ap.add_argument("-b", "--backend", choices=states.BACKENDS, default=states.PICKLER)
+    ap.add_argument("-c", "--codec", choices=pickler.CODECS, default=pickler.NONE, help="Compression for the activation states shards.")
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Number of sentences to elicit per run of the rnn.")
     ap.add_argument("data_dir")
     ap.add_argument("sequential_dir")
     ap.add_argument("activations_dir")
@@ -33,45 +40,62 @@ def main(argv):
     setup_logging(".%s.log" % os.path.splitext(os.path.basename(__file__))[0], aargs.verbose, False, True, True)
     logging.debug(aargs)
 
-    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir)
+    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir, inference=True)
     description = data.get_description(aargs.data_dir)
-    elicit_activation_states(lstm, data.stream_data(aargs.data_dir, aargs.kind), aargs.activations_dir)
+    # Language model sequences are stored encoded by the data's vocabulary.
+    vocabulary = data.get_vocabulary(aargs.data_dir, persist=True) if description.task == data.LM else None
+    elicit_activation_states(lstm, data.stream_data(aargs.data_dir, aargs.kind, prefetch=1), aargs.activations_dir, aargs.backend, aargs.codec, vocabulary, aargs.batch_size)
 
     return 0
 
 
-def elicit_activation_states(lstm, xys, activations_dir):
+def elicit_activation_states(lstm, xys, activations_dir, backend, codec=pickler.NONE, vocabulary=None, batch_size=BATCH_SIZE):
+    check.check_gte(batch_size, 1)
     activation_states = {}
 
     for key in lstm.keys():
-        start_queue(activation_states, activations_dir, key)
+        start_queue(activation_states, activations_dir, key, backend, codec)
 
     total = 0
     instances = 0
 
-    for j, xy in enumerate(xys):
+    for j, xy_instruments in enumerate(rnn.stream_instrumented(lstm, xys, rnn.LSTM_INSTRUMENTS, batch_size)):
+        xy, timestep_instruments = xy_instruments
         total += 1
         instances += len(xy.x)
-        stepwise_rnn = lstm.stepwise(handle_unknown=True)
         sequence = tuple(xy.x) + (xy.y[-1],)
 
+        if vocabulary is not None:
+            # The same array is shared by all the timesteps (and keys) of the sequence.
+            sequence = vocabulary.encode_sequence(sequence)
+
         for i, word_pos in enumerate(xy.x):
-            result, instruments = stepwise_rnn.step(word_pos[0], rnn.LSTM_INSTRUMENTS)
+            instruments = timestep_instruments[i]
 
             for part, layer in lstm.part_layers():
                 activation_states[lstm.encode_key(part, layer)].put(states.ActivationState(sequence, i, tuple([float(v) for v in instruments[part][layer]])))
 
+        if total % STREAM_LOG_RATE == 0:
+            log_streams(activation_states)
+
     # Mark the queue as finished.
     for value in activation_states.values():
         value.put(None)
 
+    log_streams(activation_states)
+
     user_log.info("%d sentences, eliciting %d activation states (per part-layer)." % (total, instances))
 
 
-def start_queue(activation_states, activations_dir, key):
-    states_queue = queue.Queue()
+def log_streams(streams):
+    for key, stream in sorted(streams.items()):
+        logging.debug("%s: %s" % (key, stream))
+
+
+def start_queue(activation_states, activations_dir, key, backend, codec):
+    states_queue = pickler.StreamQueue()
     activation_states[key] = states_queue
-    states.set_activation_states(activations_dir, key, states_queue)
+    states.set_activation_states(activations_dir, key, states_queue, backend, codec=codec)
 
 
 if __name__ == "__main__":
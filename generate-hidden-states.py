@@ -18,15 +18,24 @@ from nnwd import pickler
 from nnwd import rnn
 from nnwd import sequential
 
+from pytils import check
 from pytils.log import setup_logging, teardown, user_log
 
 
+STREAM_LOG_RATE = 1000
+BATCH_SIZE = 32
+
 @teardown
 def main(argv):
     ap = ArgumentParser(prog="generate-hidden-states")
     ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Turn on verbose logging.")
     ap.add_argument("-s", "--sample-rate", type=float, default=0.1, help="train then test sampling rates.")
     ap.add_argument("-d", "--dry-run", default=False, action="store_true")
+    ap.add_argument("-b", "--backend", choices=states.BACKENDS, default=states.PICKLER)
+    ap.add_argument("-c", "--codec", choices=pickler.CODECS, default=pickler.NONE, help="Compression for the hidden states shards.")
+    ap.add_argument("--resume", default=False, action="store_true", help="Continue from the last committed shard of an interrupted run.")
+    ap.add_argument("--fused", default=False, action="store_true", help="Write all the part-layers together, into a single columnar store.")
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Number of sentences to elicit per run of the rnn.")
     ap.add_argument("data_dir")
     ap.add_argument("sequential_dir")
     ap.add_argument("states_dir")
@@ -39,7 +48,7 @@ def main(argv):
         dry_run(data.stream_data(aargs.data_dir, aargs.kind), aargs.sample_rate, aargs.kind)
         return 0
 
-    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir)
+    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir, inference=True)
     description = data.get_description(aargs.data_dir)
 
     if description.task == data.LM:
@@ -47,45 +56,91 @@ def main(argv):
     else:
         annotation_fn = lambda y, i: y
 
-    elicit_hidden_states(lstm, data.stream_data(aargs.data_dir, aargs.kind), annotation_fn, aargs.sample_rate, aargs.states_dir, aargs.kind)
+    start = 0
+
+    if aargs.fused and aargs.resume:
+        raise ValueError("the fused store cannot be resumed")
+
+    if aargs.resume:
+        # Restart from the least advanced of the part-layers - those further along drop what they've already committed.
+        committed = [states.committed_hidden_states(aargs.states_dir, aargs.kind, key) for key in lstm.keys()]
+        start = min([0 if position is None else position for position in committed])
+        user_log.info("Resuming %s from sentence %d." % (aargs.kind, start))
+
+    elicit_hidden_states(lstm, data.stream_data(aargs.data_dir, aargs.kind, prefetch=1, start=start), annotation_fn, aargs.sample_rate, aargs.states_dir, aargs.kind, aargs.backend, start, aargs.resume, aargs.codec, aargs.fused, aargs.batch_size)
     return 0
 
 
-def elicit_hidden_states(lstm, xys, annotation_fn, sample_rate, states_dir, kind):
+def elicit_hidden_states(lstm, xys, annotation_fn, sample_rate, states_dir, kind, backend, start=0, append=False, codec=pickler.NONE, fused=False, batch_size=BATCH_SIZE):
+    check.check_gte(batch_size, 1)
     hidden_states = {}
 
-    for key in lstm.keys():
-        start_queue(hidden_states, states_dir, kind, key)
+    if fused:
+        start_fused_queue(hidden_states, states_dir, kind, lstm)
+    else:
+        for key in lstm.keys():
+            start_queue(hidden_states, states_dir, kind, key, backend, append, codec)
+
+    for value in hidden_states.values():
+        value.put(pickler.Mark(start))
 
     total = 0
     sampled = 0
     instances = 0
+    batch = []
 
-    for j, xy in enumerate(xys):
+    for j, xy in enumerate(xys, start):
         total += 1
 
         if sample_rate == 1.0 or random.random() <= sample_rate:
             sampled += 1
             instances += len(xy.x)
-            stepwise_rnn = lstm.stepwise(handle_unknown=True)
+            batch += [(j, xy)]
 
-            for i, word_pos in enumerate(xy.x):
-                # Set the annotation to that which the rnn has been trained against, not the actual learned annotation (which will be fixed).
-                # For example, consider the two training examples: "the little prince" -> "was" and "the little prince" -> "is".
-                # We need predictor samples for both "was" and "is", but if we use the actual rnn annotation this will fixate on just one of these.
-                annotation = annotation_fn(xy.y, i)
-                result, instruments = stepwise_rnn.step(word_pos[0], rnn.LSTM_INSTRUMENTS)
+            if len(batch) == batch_size:
+                put_hidden_states(lstm, batch, annotation_fn, hidden_states, fused)
+                batch = []
 
-                for part, layer in lstm.part_layers():
-                    hidden_states[lstm.encode_key(part, layer)].put(states.HiddenState(word_pos[0], tuple([float(v) for v in instruments[part][layer]]), annotation))
+            if sampled % STREAM_LOG_RATE == 0:
+                log_streams(hidden_states)
+
+    if len(batch) > 0:
+        put_hidden_states(lstm, batch, annotation_fn, hidden_states, fused)
 
     # Mark the queue as finished.
     for value in hidden_states.values():
         value.put(None)
 
+    log_streams(hidden_states)
+
     user_log.info("%s %.4f: %d sentences sampled down to %d, eliciting %d hidden states (per part-layer)." % (kind, sample_rate, total, sampled, instances))
 
 
+def put_hidden_states(lstm, batch, annotation_fn, hidden_states, fused):
+    # Run the whole batch of sentences through the rnn at once, then stream out their states in order.
+    sequence_instruments = lstm.evaluate_batch_instrumented([[word_pos[0] for word_pos in xy.x] for j, xy in batch], True, rnn.LSTM_INSTRUMENTS)
+
+    for j_xy, timestep_instruments in zip(batch, sequence_instruments):
+        j, xy = j_xy
+
+        for i, word_pos in enumerate(xy.x):
+            # Set the annotation to that which the rnn has been trained against, not the actual learned annotation (which will be fixed).
+            # For example, consider the two training examples: "the little prince" -> "was" and "the little prince" -> "is".
+            # We need predictor samples for both "was" and "is", but if we use the actual rnn annotation this will fixate on just one of these.
+            annotation = annotation_fn(xy.y, i)
+            instruments = timestep_instruments[i]
+
+            if fused:
+                hidden_states[states.STATES_FUSED].put(states.FusedState(word_pos[0], [instruments[part][layer] for part, layer in lstm.part_layers()], annotation))
+            else:
+                for part, layer in lstm.part_layers():
+                    hidden_states[lstm.encode_key(part, layer)].put(states.HiddenState(word_pos[0], tuple([float(v) for v in instruments[part][layer]]), annotation))
+
+        # Everything up to (and including) this sentence has been elicited.
+        for value in hidden_states.values():
+            value.put(pickler.Mark(j + 1))
+
+
 def dry_run(xys, sample_rate, kind):
     total = 0
     sampled = 0
@@ -101,10 +156,21 @@ def dry_run(xys, sample_rate, kind):
     user_log.info("(dry run) %s %.4f: %d sentences sampled down to %d, eliciting %d hidden states (per part-layer)." % (kind, sample_rate, total, sampled, instances))
 
 
-def start_queue(hidden_states, states_dir, kind, key):
-    states_queue = queue.Queue()
+def log_streams(streams):
+    for key, stream in sorted(streams.items()):
+        logging.debug("%s: %s" % (key, stream))
+
+
+def start_queue(hidden_states, states_dir, kind, key, backend, append, codec):
+    states_queue = pickler.StreamQueue()
     hidden_states[key] = states_queue
-    states.set_hidden_states(states_dir, kind, key, states_queue)
+    states.set_hidden_states(states_dir, kind, key, states_queue, backend, append, codec)
+
+
+def start_fused_queue(hidden_states, states_dir, kind, lstm):
+    states_queue = pickler.StreamQueue()
+    hidden_states[states.STATES_FUSED] = states_queue
+    states.set_fused_hidden_states(states_dir, kind, [(key, lstm.part_width(key)) for key in lstm.keys()], states_queue)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+from argparse import ArgumentParser
+import logging
+import numpy as np
+import os
+import pdb
+import sys
+
+from nnwd import data
+from nnwd import prefixes
+from nnwd import rnn
+from nnwd import sequential
+from nnwd import states
+
+from pytils import check
+from pytils.log import setup_logging, teardown, user_log
+
+
+STREAM_LOG_RATE = 1000
+BATCH_SIZE = 32
+
+@teardown
+def main(argv):
+    ap = ArgumentParser(prog="generate-prefix-states")
+    ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Turn on verbose logging.")
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Number of sentences to elicit per run of the rnn.")
+    ap.add_argument("data_dir")
+    ap.add_argument("sequential_dir")
+    ap.add_argument("states_dir")
+    ap.add_argument("kind", choices=["train", "validation", "test"])
+    aargs = ap.parse_args(argv)
+    setup_logging(".%s.log" % os.path.splitext(os.path.basename(__file__))[0], aargs.verbose, False, True, True)
+    logging.debug(aargs)
+
+    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir, inference=True)
+    elicit_prefix_states(lstm, data.stream_data(aargs.data_dir, aargs.kind, prefetch=1), aargs.states_dir, aargs.batch_size)
+    return 0
+
+
+def elicit_prefix_states(lstm, xys, states_dir, batch_size=BATCH_SIZE):
+    check.check_gte(batch_size, 1)
+    counts = {"total": 0, "instances": 0}
+
+    def _prefix_states():
+        # Sentences commonly share their prefixes (ex: "the"), which are only stored once.
+        seen = set()
+
+        for j, xy_instruments in enumerate(rnn.stream_instrumented(lstm, xys, rnn.LSTM_INSTRUMENTS, batch_size)):
+            xy, timestep_instruments = xy_instruments
+            counts["total"] += 1
+            sequence = [word_pos[0] for word_pos in xy.x]
+
+            for i, instruments in enumerate(timestep_instruments):
+                key = prefixes.prefix_key(sequence[:i + 1])
+
+                if key not in seen:
+                    seen.add(key)
+                    counts["instances"] += 1
+                    # The state, as per rnn.Stepwise: [SCAN_STATES, layers, 1, width].
+                    state = np.expand_dims(np.stack([instruments[part] for part in rnn.SCAN_PARTS]), 2)
+                    yield states.PrefixState(*key, state, instruments["embedding"])
+
+            if counts["total"] % STREAM_LOG_RATE == 0:
+                logging.debug("%d sentences, %d prefix states." % (counts["total"], counts["instances"]))
+
+    # Written synchronously, since the rows are sorted by their hash once they have all been written.
+    states.set_prefix_states(states_dir, rnn.SCAN_PARTS, lstm.hyper_parameters.layers, lstm.hyper_parameters.width, lstm.hyper_parameters.embedding_width, _prefix_states())
+    user_log.info("%d sentences, eliciting %d (distinct) prefix states." % (counts["total"], counts["instances"]))
+
+
+if __name__ == "__main__":
+    ret = main(sys.argv[1:])
+    sys.exit(ret)
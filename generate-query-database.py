@@ -39,6 +39,8 @@ def main(argv):
     ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Turn on verbose logging.")
     ap.add_argument("--key-offsets", nargs="*", default=None)
     ap.add_argument("--db-kind", choices=["sqlite", "postgres"])
+    ap.add_argument("--prefetch", default=2, type=int, help="Number of activation shards to decode ahead of the database inserts.")
+    ap.add_argument("--resume", default=False, action="store_true", help="Continue each key from the activations already committed to its database.")
     ap.add_argument("data_dir")
     ap.add_argument("sequential_dir")
     ap.add_argument("activation_dir")
@@ -53,7 +55,7 @@ def main(argv):
     for parameter in (lstm.keys() if aargs.key_offsets is None else aargs.key_offsets):
         key = parameter if aargs.key_offsets is None else parameter.split("#")[0]
         offset = 0 if aargs.key_offsets is None else int(parameter.split("#")[1])
-        thread = threading.Thread(target=generate_db, args=[lstm, aargs.activation_dir, key, aargs.query_dir, aargs.db_kind, offset])
+        thread = threading.Thread(target=generate_db, args=[lstm, aargs.activation_dir, key, aargs.query_dir, aargs.db_kind, offset, aargs.prefetch, aargs.resume])
         # Non-daemon threads will keep the program running until they finish (as per documentation).
         thread.daemon = False
         thread.start()
@@ -65,37 +67,46 @@ def main(argv):
     return 0
 
 
-def generate_db(lstm, activation_dir, key, query_dir, db_kind, offset):
-    logging.debug("Processing activation data for query database %s @%d." % (key, offset))
+def generate_db(lstm, activation_dir, key, query_dir, db_kind, offset, prefetch, resume=False):
     query_db = query.database_for(query_dir, db_kind, lstm, key)
+
+    if resume:
+        # Activations are inserted in stream order (and re-inserting one is ignored), so the committed row count is a safe place to continue from.
+        offset = max(offset, query_db.count_activations())
+
+    logging.debug("Processing activation data for query database %s @%d." % (key, offset))
     sequence_ids = {}
     batch = []
+    statistics = pickler.Statistics()
 
-    for i, sequence_index_point in enumerate(states.stream_activations(activation_dir, key)):
-        if i < offset:
-            pass
-        else:
-            if i % 10000 == 0 or len(sequence_ids) == 0:
-                query_db.commit()
-                logging.debug("At the %d-ten-Kth instance of %s." % (int(i / 10000), key))
+    # The activations stream starts directly at the offset (only the shard containing it gets deserialized).
+    for i, sequence_index_point in enumerate(states.stream_activations(activation_dir, key, offset, prefetch, statistics), offset):
+        if i % 10000 == 0 or len(sequence_ids) == 0:
+            query_db.commit()
+            logging.debug("At the %d-ten-Kth instance of %s." % (int(i / 10000), key))
 
+        if isinstance(sequence_index_point[0], np.ndarray):
+            # Encoded sequences are stored by their word ids (the sequences table is decoded by the vocabulary on the way out).
+            sequence = tuple(sequence_index_point[0][:, 0].tolist())
+        else:
             sequence = tuple([word_pos[0] for word_pos in sequence_index_point[0]])
-            sequence_index = sequence_index_point[1]
-            #point = sequence_index_point[2]
-            point = tuple([float(v) for v in sequence_index_point[2]])
-
-            if sequence not in sequence_ids:
-                sequence_id = query_db.insert_sequence(sequence)
-                sequence_ids[sequence] = sequence_id
-            else:
-                sequence_id = sequence_ids[sequence]
-
-            data = (sequence_id, sequence_index) + point
-            batch += [data]
-
-            if len(batch) == BATCH_SIZE:
-                query_db.insert_activations(batch)
-                batch = []
+
+        sequence_index = sequence_index_point[1]
+        #point = sequence_index_point[2]
+        point = tuple([float(v) for v in sequence_index_point[2]])
+
+        if sequence not in sequence_ids:
+            sequence_id = query_db.insert_sequence(sequence)
+            sequence_ids[sequence] = sequence_id
+        else:
+            sequence_id = sequence_ids[sequence]
+
+        data = (sequence_id, sequence_index) + point
+        batch += [data]
+
+        if len(batch) == BATCH_SIZE:
+            query_db.insert_activations(batch)
+            batch = []
 
     if len(batch) > 0:
         query_db.insert_activations(batch)
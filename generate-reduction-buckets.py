@@ -79,7 +79,7 @@ def main(argv):
 def generate_buckets(states_dir, key, width, buckets_dir, target):
     logging.debug("Calculating for '%s'." % key)
     train_points, test_points = states.get_hidden_states(states_dir, key)
-    learned_buckets, fixed_buckets = calculate_buckets(width, target, [hidden_state.point for hidden_state in train_points])
+    learned_buckets, fixed_buckets = calculate_buckets(width, target, states.points(train_points))
     reduction.set_buckets(buckets_dir, key, learned_buckets, fixed_buckets)
     learned_mse = 0.0
     fixed_mse = 0.0
@@ -108,7 +108,7 @@ def generate_buckets_grouping(lstm, states_dir, grouping, buckets_dir, target):
 
     for key in grouping:
         train_stream, _ = states.get_hidden_states(states_dir, key)
-        train_points[key] = [hidden_state.point for hidden_state in train_stream]
+        train_points[key] = states.points(train_stream)
 
     learned_buckets = calculate_learned_grouping(width, target, train_points)
     fixed_buckets = calculate_fixed(width, target)
@@ -164,7 +164,7 @@ def calculate_fixed(width, target):
 
 def calculate_learned(width, target, points):
     buckets = {i: [] for i in range(target)}
-    X = np.array([p for p in points])
+    X = points if isinstance(points, np.ndarray) else np.array([p for p in points])
     X_transpose = X.transpose()
     logging.debug("learning gaussian mixture model from %d points (%d wide)." % X.shape)
     dimension_grouping = None
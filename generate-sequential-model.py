@@ -17,6 +17,7 @@ from ml import base as mlbase
 from ml import model
 from ml import scoring
 from nnwd import data
+from nnwd import parallel
 from nnwd import pickler
 from nnwd import reduction
 from nnwd import rnn
@@ -41,6 +42,8 @@ def main(argv):
     ap.add_argument("-a", "--arc-epochs", default=5, type=int)
     ap.add_argument("-i", "--initial-decays", default=5, type=int)
     ap.add_argument("-c", "--convergence-decays", default=2, type=int)
+    ap.add_argument("--workers", default=1, type=int, help="Number of (data parallel) training processes, or 1 to train in this process.")
+    ap.add_argument("--prefetch", default=mlbase.TrainingParameters.DEFAULT_PREFETCH, type=int, help="Number of training feeds to prepare ahead of the session runs (0 to prepare them in line).")
     ap.add_argument("data_dir")
     ap.add_argument("sequential_dir")
     aargs = ap.parse_args(argv)
@@ -48,23 +51,30 @@ def main(argv):
     logging.debug(aargs)
     hyper_parameters = sequential.HyperParameters(aargs.layers, aargs.width, aargs.embedding_width)
     ablations = sequential.Ablations(aargs.srnn, aargs.out)
-    rnn = generate_rnn(aargs.data_dir, hyper_parameters, ablations, aargs.batch, aargs.arc_epochs, aargs.initial_decays, aargs.convergence_decays, aargs.sequential_dir)
+    rnn = generate_rnn(aargs.data_dir, hyper_parameters, ablations, aargs.batch, aargs.arc_epochs, aargs.initial_decays, aargs.convergence_decays, aargs.sequential_dir, aargs.prefetch, aargs.workers)
     return 0
 
 
-def generate_rnn(data_dir, hyper_parameters, ablations, batch, arc_epochs, initial_decays, convergence_decays, sequential_dir):
+def generate_rnn(data_dir, hyper_parameters, ablations, batch, arc_epochs, initial_decays, convergence_decays, sequential_dir, prefetch=mlbase.TrainingParameters.DEFAULT_PREFETCH, workers=1):
     rnn = sequential.model_for(data_dir, hyper_parameters=hyper_parameters, ablations=ablations)
-    train_xys = [xy for xy in data.stream_train(data_dir)]
-    validation_xys = [xy for xy in data.stream_validation(data_dir)]
-    test_xys = [xy for xy in data.stream_test(data_dir)]
+    # Encode each of the data sets once, up front, so that their feeds are cheap to construct every epoch.
+    train_xys = rnn.encode([xy for xy in data.stream_train(data_dir)])
+    validation_xys = rnn.encode([xy for xy in data.stream_validation(data_dir)])
+    test_xys = rnn.encode([xy for xy in data.stream_test(data_dir)])
     logging.debug("data sets (train, validation, test): %d, %d, %d" % (len(train_xys), len(validation_xys), len(test_xys)))
     show_score = data.get_description(data_dir).task == data.SA
-    converging_train(rnn, batch, arc_epochs, initial_decays, convergence_decays, sequential_dir, train_xys, validation_xys, test_xys, show_score)
+    # Either train the rnn directly, or via data parallel replicas of it.
+    trainer = rnn if workers == 1 else parallel.DataParallel(rnn, data_dir, workers)
+    converging_train(rnn, batch, arc_epochs, initial_decays, convergence_decays, sequential_dir, train_xys, validation_xys, test_xys, show_score, prefetch, trainer)
+
+    if trainer is not rnn:
+        trainer.close()
+
     del train_xys
     return rnn
 
 
-def converging_train(rnn, batch, arc_epochs, initial_decays, convergence_decays, sequential_dir, train_xys, validation_xys, test_xys, show_score):
+def converging_train(rnn, batch, arc_epochs, initial_decays, convergence_decays, sequential_dir, train_xys, validation_xys, test_xys, show_score, prefetch=mlbase.TrainingParameters.DEFAULT_PREFETCH, trainer=None):
     assert initial_decays > convergence_decays, "%d <= %d" % (initial_decays, convergence_decays)
     best_score_train = rnn.test(train_xys, score=show_score)
     best_score_validation = rnn.test(validation_xys, score=show_score)
@@ -75,7 +85,8 @@ def converging_train(rnn, batch, arc_epochs, initial_decays, convergence_decays,
         .epochs(arc_epochs) \
         .convergence(False) \
         .debug(True) \
-        .score(True)
+        .score(True) \
+        .prefetch(prefetch)
     previous_loss = None
     arc = -1
     version = 0
@@ -87,7 +98,7 @@ def converging_train(rnn, batch, arc_epochs, initial_decays, convergence_decays,
     while not converged:
         arc += 1
         logging.debug("train lstm arc %d: %s" % (arc, training_parameters))
-        loss, score_train, score_validation = rnn_train_loop(rnn, train_xys, validation_xys, training_parameters)
+        loss, score_train, score_validation = rnn_train_loop(rnn if trainer is None else trainer, rnn, train_xys, validation_xys, training_parameters)
         loss_change = _change(previous_loss, loss, lambda prev, curr: prev > curr)
         train_change = _change(best_score_train, score_train, lambda prev, curr: prev < curr)
         validation_change = _change(best_score_validation, score_validation, lambda prev, curr: prev < curr)
@@ -145,8 +156,8 @@ def _change(previous, current, better_fn):
         return "▼"
 
 
-def rnn_train_loop(rnn, train_xys, validation_xys, training_parameters):
-    loss, score_train = rnn.train(train_xys, training_parameters)
+def rnn_train_loop(trainer, rnn, train_xys, validation_xys, training_parameters):
+    loss, score_train = trainer.train(train_xys, training_parameters)
     score_validation = rnn.test(validation_xys)
     return loss, score_train, score_validation
 
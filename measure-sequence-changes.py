@@ -46,7 +46,7 @@ def main(argv):
     setup_logging(".%s.log" % os.path.splitext(os.path.basename(__file__))[0], aargs.verbose, False, True, True)
     logging.debug(aargs)
 
-    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir)
+    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir, inference=True)
     minimum, maximum, sequence_changes = measure(lstm, aargs.data_dir, aargs.kind, aargs.keys)
 
     for key in aargs.keys:
@@ -65,19 +65,19 @@ def measure(lstm, data_dir, kind, keys):
     global_minimum = {key: (None, None, None) for key in keys}
     global_maximum = {key: (None, None, None) for key in keys}
 
-    for j, xy in enumerate(data.stream_data(data_dir, kind)):
+    for j, xy_instruments in enumerate(rnn.stream_instrumented(lstm, data.stream_data(data_dir, kind), rnn.LSTM_INSTRUMENTS, BATCH_SIZE)):
         if j % 100 == 0:
             logging.debug("At the %d instance." % (j))
 
+        xy, timestep_instruments = xy_instruments
         sequence = tuple([item[0] for item in xy.x]) + (xy.y[-1][0],)
-        stepwise_rnn = lstm.stepwise(handle_unknown=True)
         change_distances = {key: [] for key in keys}
         previous_states = {}
         minimum = {key: (None, None) for key in keys}
         maximum = {key: (None, None) for key in keys}
 
         for i, word_pos in enumerate(xy.x):
-            result, instruments = stepwise_rnn.step(word_pos[0], rnn.LSTM_INSTRUMENTS)
+            instruments = timestep_instruments[i]
 
             for part, layer in lstm.part_layers():
                 key = lstm.encode_key(part, layer)
@@ -9,6 +9,9 @@ import math
 import numpy as np
 import os
 import pdb
+import queue
+import threading
+import time
 
 from pytils import check
 
@@ -185,6 +188,7 @@ class TrainingParameters:
     DEFAULT_WINDOW = 10
     DEFAULT_DEBUG = False
     DEFAULT_SCORE = False
+    DEFAULT_PREFETCH = 2
     REASON_EPOCHS = "maximum epochs"
     REASON_ABSOLUTE = "absolute convergence"
     REASON_RELATIVE = "relative convergence"
@@ -203,6 +207,7 @@ class TrainingParameters:
         self._window = TrainingParameters.DEFAULT_WINDOW
         self._debug = TrainingParameters.DEFAULT_DEBUG
         self._score = TrainingParameters.DEFAULT_SCORE
+        self._prefetch = TrainingParameters.DEFAULT_PREFETCH
         self._decays = 0
 
     def decay(self, initial=False):
@@ -368,13 +373,145 @@ class TrainingParameters:
         self._score = check.check_one_of(value, [True, False])
         return self
 
+    def prefetch(self, value=None):
+        # The number of training feeds to prepare ahead of the session (see prefetch_feeds), or 0 to prepare them in line.
+        if value is None:
+            return self._prefetch
+
+        self._prefetch = check.check_gte(value, 0)
+        return self
+
     def __repr__(self):
         if self._convergence:
-            return "TrainingParameters{btch=%d, epch=%d, drop=%.4f, learn=%.4f, cnrm=%.4f, abs-c=%.4f, rel-c=%.4f, degr=%d, wndw=%d, debug=%s}" % \
-                (self._batch, self._epochs, self._dropout_rate, self._learning_rate, self._clip_norm, self._absolute, self._relative, self._degradation, self._window, self._debug)
+            return "TrainingParameters{btch=%d, epch=%d, drop=%.4f, learn=%.4f, cnrm=%.4f, abs-c=%.4f, rel-c=%.4f, degr=%d, wndw=%d, pfch=%d, debug=%s}" % \
+                (self._batch, self._epochs, self._dropout_rate, self._learning_rate, self._clip_norm, self._absolute, self._relative, self._degradation, self._window, self._prefetch, self._debug)
         else:
-            return "TrainingParameters{btch=%d, epch=%d, drop=%.4f, learn=%.4f, cnrm=%.4f, degr=%d, wndw=%d, debug=%s}" % \
-                (self._batch, self._epochs, self._dropout_rate, self._learning_rate, self._clip_norm, self._degradation, self._window, self._debug)
+            return "TrainingParameters{btch=%d, epch=%d, drop=%.4f, learn=%.4f, cnrm=%.4f, degr=%d, wndw=%d, pfch=%d, debug=%s}" % \
+                (self._batch, self._epochs, self._dropout_rate, self._learning_rate, self._clip_norm, self._degradation, self._window, self._prefetch, self._debug)
+
+
+def prefetch_feeds(batches, feed_fn, prefetch=0, statistics=None):
+    # Yields the (batch, feed) of each of the batches, where the feeds are prepared up to 'prefetch' batches ahead of the
+    # consumer in a background thread (so that preparing the data overlaps with the consumer's session runs).
+    if prefetch > 0:
+        prepared = _prefetch_feeds(iter(batches), feed_fn, prefetch, statistics)
+    else:
+        prepared = _prepare_feeds(iter(batches), feed_fn, statistics)
+
+    while True:
+        waiting = time.time()
+
+        try:
+            batch_feed = next(prepared)
+        except StopIteration:
+            break
+
+        if statistics is not None:
+            statistics.stalled(time.time() - waiting)
+
+        yield batch_feed
+
+
+def _prepare_feeds(batches, feed_fn, statistics):
+    while True:
+        preparing = time.time()
+
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return
+
+        feed = feed_fn(batch)
+
+        if statistics is not None:
+            statistics.prepared(time.time() - preparing)
+
+        yield batch, feed
+
+
+def _prefetch_feeds(batches, feed_fn, prefetch, statistics):
+    return prefetched(_prepare_feeds(batches, feed_fn, statistics), prefetch)
+
+
+def prefetched(iterator, prefetch):
+    # Yields the values of the iterator, which is run up to 'prefetch' values ahead of the consumer in a background thread.
+    # An exception raised by the iterator is re-raised to the consumer, and a consumer that stops early stops the thread.
+    values = queue.Queue(maxsize=check.check_gte(prefetch, 1))
+    stopped = threading.Event()
+    # Distinct from any value the iterator may yield.
+    end = object()
+
+    def _put(value):
+        while not stopped.is_set():
+            try:
+                values.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _produce():
+        try:
+            for value in iterator:
+                if not _put(value):
+                    return
+
+            _put(end)
+        except Exception as e:
+            _put(_Raised(e))
+
+    thread = threading.Thread(target=_produce)
+    # The consumer may abandon the values early, so don't let the producer keep the program running.
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            value = values.get()
+
+            if value is end:
+                break
+            elif isinstance(value, _Raised):
+                raise value.error
+
+            yield value
+    finally:
+        stopped.set()
+
+
+class _Raised:
+    def __init__(self, error):
+        self.error = error
+
+
+class FeedStatistics:
+    def __init__(self):
+        self.feeds = 0
+        # Time spent preparing the feeds (by whichever thread is doing the preparing).
+        self.prepare_seconds = 0.0
+        # Time the consumer spent stalled, waiting on its next feed.
+        self.stall_seconds = 0.0
+        self.started = time.time()
+        # The producer (when prefetching) and the consumer update the counters from different threads.
+        self._lock = threading.Lock()
+
+    def prepared(self, seconds):
+        with self._lock:
+            self.feeds += 1
+            self.prepare_seconds += seconds
+
+    def stalled(self, seconds):
+        with self._lock:
+            self.stall_seconds += seconds
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def __repr__(self):
+        elapsed = self.elapsed()
+        return "FeedStatistics{feeds=%d, prepare=%.2fs, stall=%.2fs (%.1f%% of %.2fs)}" % \
+            (self.feeds, self.prepare_seconds, self.stall_seconds, 0.0 if elapsed == 0 else 100.0 * self.stall_seconds / elapsed, elapsed)
 
 
 class Checkpoints:
@@ -60,8 +60,12 @@ class Model:
 
 
 class TfModel(Model):
-    def __init__(self, scope):
+    def __init__(self, scope, inference=False, session_config=None):
         super(TfModel, self).__init__(scope)
+        # Inference only models build just the forward pass (no cost, gradients or updates), so they cannot be trained.
+        self.inference = inference
+        # The tf.ConfigProto for the model's session (ex: to set its thread counts), or None for the defaults.
+        self.session_config = session_config
 
     def placeholder(self, name, shape, dtype=tf.float32):
         return tf.placeholder(dtype, shape, name=name)
@@ -73,6 +77,10 @@ class TfModel(Model):
 
     def train(self, xys_stream, training_parameters):
         check.check_instance(training_parameters, mlbase.TrainingParameters)
+
+        if self.inference:
+            raise ValueError("cannot train an inference only model")
+
         slot_length = len(str(training_parameters.epochs())) - 1
         epoch_template = "[%s] Epoch training {:%dd}: (loss, perplexity): {:.6f}, {:.6f}" % (self.scope, slot_length)
         final_loss = None
@@ -81,36 +89,20 @@ class TfModel(Model):
         finished = False
         epoch = -1
 
+        statistics = mlbase.FeedStatistics()
+
         while not finished:
             epoch += 1
             epoch_loss = 0
             # Start at a different offset for every epoch to help avoid overfitting.
             offset = random.randint(0, training_parameters.batch() - 1)
-            batch = []
-            first = True
-            batch_set = False
             count = 0
+            # The stream is read, and its feeds prepared, ahead of the session runs.
+            feeds = mlbase.prefetch_feeds(self.training_batches(xys_stream, offset, training_parameters.batch()),
+                lambda batch: self.get_training_feed(batch, training_parameters), training_parameters.prefetch(), statistics)
 
-            for xy in xys_stream():
-                batch += [xy]
-
-                if first and len(batch) == offset:
-                    first = False
-                    batch_set = True
-                elif len(batch) == training_parameters.batch():
-                    batch_set = True
-
-                if batch_set:
-                    count += len(batch)
-                    feed = self.get_training_feed(batch, training_parameters)
-                    _, training_loss = self.session.run([self.updates, self.cost], feed_dict=feed)
-                    epoch_loss += training_loss
-                    batch_set = False
-                    batch = []
-
-            if len(batch) > 0:
+            for batch, feed in feeds:
                 count += len(batch)
-                feed = self.get_training_feed(batch, training_parameters)
                 _, training_loss = self.session.run([self.updates, self.cost], feed_dict=feed)
                 epoch_loss += training_loss
 
@@ -124,8 +116,24 @@ class TfModel(Model):
 
         logging.debug(epoch_template.format(epoch, epoch_loss, epoch_perplexity))
         logging.debug("Training on %d instances finished due to %s (%s)." % (count, reason, losses))
+        logging.debug("[%s] Training feeds: %s." % (self.scope, statistics))
         return epoch_loss, -epoch_perplexity
 
+    def training_batches(self, xys_stream, offset, batch_size):
+        batch = []
+        first = True
+
+        for xy in xys_stream():
+            batch += [xy]
+
+            if (first and len(batch) == offset) or len(batch) == batch_size:
+                first = False
+                yield batch
+                batch = []
+
+        if len(batch) > 0:
+            yield batch
+
     def converging_train(self, data_streams, model_dir, batch=32, arc_epochs=5, initial_decays=5, convergence_decays=2):
         assert initial_decays > convergence_decays, "%d <= %d" % (initial_decays, convergence_decays)
         train_stream, validation_stream, test_stream = data_streams
@@ -213,13 +221,23 @@ class TfModel(Model):
     def evaluate(self, batch, handle_unknown=False):
         feed = self.get_testing_feed(batch)
 
-        distributions, loss = self.session.run([self.output_distributions, self.cost], feed_dict=feed)
+        if self.inference:
+            distributions = self.session.run(self.output_distributions, feed_dict=feed)
+            loss = None
+        else:
+            distributions, loss = self.session.run([self.output_distributions, self.cost], feed_dict=feed)
 
         if isinstance(batch, list):
             return [mlbase.Result(self.output_labels, distribution) for distribution in distributions], loss
         else:
             return mlbase.Result(self.output_labels, distributions[0]), loss
 
+    def predict_top_k(self, inputs, cases, k):
+        # Prediction only - takes the already encoded [batch, input_field] float32 inputs (and their [batch] case ids), runs
+        # just the output distributions (no labels or cost), and returns the [batch, k] top k output indices and probabilities.
+        distributions = self.session.run(self.output_distributions, feed_dict=self.get_prediction_feed(inputs, cases))
+        return top_k(distributions, k)
+
     def load_parameters(self, model_dir, version=None):
         checkpoints = mlbase.Checkpoints.load(model_dir)
         model_path = checkpoints.model_path(version)
@@ -246,8 +264,8 @@ class TfModel(Model):
 
 
 class Ffnn(TfModel):
-    def __init__(self, scope, hyper_parameters, extra, input_field, output_labels):
-        super(Ffnn, self).__init__(scope)
+    def __init__(self, scope, hyper_parameters, extra, input_field, output_labels, inference=False, session_config=None):
+        super(Ffnn, self).__init__(scope, inference, session_config)
         self.hyper_parameters = check.check_instance(hyper_parameters, HyperParameters)
         self.extra = extra
         self.input_field = check.check_instance(input_field, mlbase.Field)
@@ -308,16 +326,17 @@ class Ffnn(TfModel):
         #    inputs=hidden,
         #    num_sampled=1,
         #    num_classes=len(self.output_labels)))
-        loss_fn = tf.nn.sparse_softmax_cross_entropy_with_logits
-        self.cost = tf.reduce_sum(loss_fn(labels=tf.stop_gradient(self.output_p), logits=self.output_logit))
-        #self.updates = tf.train.AdamOptimizer().minimize(self.cost)
+        if not self.inference:
+            loss_fn = tf.nn.sparse_softmax_cross_entropy_with_logits
+            self.cost = tf.reduce_sum(loss_fn(labels=tf.stop_gradient(self.output_p), logits=self.output_logit))
+            #self.updates = tf.train.AdamOptimizer().minimize(self.cost)
 
-        optimizer = tf.train.GradientDescentOptimizer(self.learning_rate_p[0])
-        gradients = optimizer.compute_gradients(self.cost)
-        gradients_clipped = [(tf.clip_by_norm(g, self.clip_norm_p[0]), var) for g, var in gradients if g is not None]
-        self.updates = optimizer.apply_gradients(gradients_clipped)
+            optimizer = tf.train.GradientDescentOptimizer(self.learning_rate_p[0])
+            gradients = optimizer.compute_gradients(self.cost)
+            gradients_clipped = [(tf.clip_by_norm(g, self.clip_norm_p[0]), var) for g, var in gradients if g is not None]
+            self.updates = optimizer.apply_gradients(gradients_clipped)
 
-        config = tf.ConfigProto()
+        config = tf.ConfigProto() if self.session_config is None else self.session_config
         config.gpu_options.allow_growth = True
         self.session = tf.Session(config=config)
         self.session.run(tf.global_variables_initializer())
@@ -345,10 +364,17 @@ class Ffnn(TfModel):
             self.dropout_keep_p: np.array([1.0]),
         }
 
+    def get_prediction_feed(self, inputs, cases):
+        # The monolith has no separate case weights, since the case is encoded into its inputs.
+        return {
+            self.input_p: inputs,
+            self.dropout_keep_p: np.array([1.0]),
+        }
+
 
 class SeparateFfnn(TfModel):
-    def __init__(self, scope, hyper_parameters, extra, input_field, output_labels, case_field):
-        super(SeparateFfnn, self).__init__(scope)
+    def __init__(self, scope, hyper_parameters, extra, input_field, output_labels, case_field, inference=False, session_config=None):
+        super(SeparateFfnn, self).__init__(scope, inference, session_config)
         self.hyper_parameters = check.check_instance(hyper_parameters, HyperParameters)
         self.extra = extra
         self.input_field = check.check_instance(input_field, mlbase.Field)
@@ -370,62 +396,48 @@ class SeparateFfnn(TfModel):
         self.dropout_keep_p = self.placeholder("dropout_keep_p", [1], tf.float32)
 
         self.batch_size, _ = tf.unstack(tf.shape(self.input_p))
+        cases = len(self.case_field)
 
         if self.hyper_parameters.layers > 0:
-            self.E = self.variable("E", [len(self.case_field), len(self.input_field), self.hyper_parameters.width])
-            self.E_bias = self.variable("E_bias", [len(self.case_field), 1, self.hyper_parameters.width], 0.)
+            self.E = self.variable("E", [cases, len(self.input_field), self.hyper_parameters.width])
+            self.E_bias = self.variable("E_bias", [cases, 1, self.hyper_parameters.width], 0.)
 
-            self.Y = self.variable("Y", [len(self.case_field), self.hyper_parameters.width, len(self.output_labels)])
-            self.Y_bias = self.variable("Y_bias", [len(self.case_field), 1, len(self.output_labels)], 0.)
+            self.Y = self.variable("Y", [cases, self.hyper_parameters.width, len(self.output_labels)])
+            self.Y_bias = self.variable("Y_bias", [cases, 1, len(self.output_labels)], 0.)
 
             # The E layer is the first layer.
             if self.hyper_parameters.layers > 1:
-                self.H = self.variable("H", [len(self.case_field), self.hyper_parameters.layers - 1, self.hyper_parameters.width, self.hyper_parameters.width])
-                self.H_bias = self.variable("H_bias", [len(self.case_field), self.hyper_parameters.layers - 1, 1, self.hyper_parameters.width], 0.)
-
-            # Computational graph encoding
-            cased_E = tf.nn.embedding_lookup(self.E, self.input_cases_p)
-            mlbase.assert_shape(cased_E, [batch_size_dimension, len(self.input_field), self.hyper_parameters.width])
-            cased_E_bias = tf.nn.embedding_lookup(self.E_bias, self.input_cases_p)
-            mlbase.assert_shape(cased_E_bias, [batch_size_dimension, 1, self.hyper_parameters.width])
-
-            self.embedded_input = tf.tanh(tf.matmul(tf.expand_dims(self.input_p, axis=1), cased_E) + cased_E_bias)
-            mlbase.assert_shape(self.embedded_input, [batch_size_dimension, 1, self.hyper_parameters.width])
-            hidden = self.embedded_input
-            mlbase.assert_shape(hidden, [batch_size_dimension, 1, self.hyper_parameters.width])
-
-            for l in range(self.hyper_parameters.layers - 1):
-                cased_H = tf.nn.embedding_lookup(self.H, self.input_cases_p)
-                mlbase.assert_shape(cased_H, [batch_size_dimension, self.hyper_parameters.layers - 1, self.hyper_parameters.width, self.hyper_parameters.width])
-                cased_H_bias = tf.nn.embedding_lookup(self.H_bias, self.input_cases_p)
-                mlbase.assert_shape(cased_H_bias, [batch_size_dimension, self.hyper_parameters.layers - 1, 1, self.hyper_parameters.width])
-
-                hidden = tf.tanh(tf.matmul(self.dropout(hidden), cased_H[:, l]) + cased_H_bias[:, l])
-                mlbase.assert_shape(hidden, [batch_size_dimension, 1, self.hyper_parameters.width])
-
-            mlbase.assert_shape(hidden, [batch_size_dimension, 1, self.hyper_parameters.width])
-
-            cased_Y = tf.nn.embedding_lookup(self.Y, self.input_cases_p)
-            mlbase.assert_shape(cased_Y, [batch_size_dimension, self.hyper_parameters.width, len(self.output_labels)])
-            cased_Y_bias = tf.nn.embedding_lookup(self.Y_bias, self.input_cases_p)
-            mlbase.assert_shape(cased_Y_bias, [batch_size_dimension, 1, len(self.output_labels)])
+                self.H = self.variable("H", [cases, self.hyper_parameters.layers - 1, self.hyper_parameters.width, self.hyper_parameters.width])
+                self.H_bias = self.variable("H_bias", [cases, self.hyper_parameters.layers - 1, 1, self.hyper_parameters.width], 0.)
         else:
-            self.Y = self.variable("Y", [len(self.case_field), len(self.input_field), len(self.output_labels)])
-            self.Y_bias = self.variable("Y_bias", [len(self.case_field), 1, len(self.output_labels)], 0.)
+            self.Y = self.variable("Y", [cases, len(self.input_field), len(self.output_labels)])
+            self.Y_bias = self.variable("Y_bias", [cases, 1, len(self.output_labels)], 0.)
+
+        # Computational graph encoding
+        # Group the batch by case, so each case's weights are applied with one dense matmul over its group of instances.
+        # Looking the weights up per instance instead would copy them for each, ex: [batch, width, output_labels] for Y.
+        case_indices = tf.dynamic_partition(tf.range(self.batch_size), self.input_cases_p, cases)
+        case_inputs = tf.dynamic_partition(self.input_p, self.input_cases_p, cases)
+        case_logits = []
+
+        for case in range(cases):
+            hidden = case_inputs[case]
+            mlbase.assert_shape(hidden, [batch_size_dimension, len(self.input_field)])
 
-            # Computational graph encoding
-            hidden = tf.expand_dims(self.input_p, axis=1)
-            mlbase.assert_shape(hidden, [batch_size_dimension, 1, len(self.input_field)])
+            if self.hyper_parameters.layers > 0:
+                hidden = tf.tanh(tf.matmul(hidden, tf.gather(self.E, case)) + tf.gather(self.E_bias, case))
+                mlbase.assert_shape(hidden, [batch_size_dimension, self.hyper_parameters.width])
 
-            cased_Y = tf.nn.embedding_lookup(self.Y, self.input_cases_p)
-            mlbase.assert_shape(cased_Y, [batch_size_dimension, len(self.input_field), len(self.output_labels)])
-            cased_Y_bias = tf.nn.embedding_lookup(self.Y_bias, self.input_cases_p)
-            mlbase.assert_shape(cased_Y_bias, [batch_size_dimension, 1, len(self.output_labels)])
+                for l in range(self.hyper_parameters.layers - 1):
+                    hidden = tf.tanh(tf.matmul(self.dropout(hidden), tf.gather(self.H, case)[l]) + tf.gather(self.H_bias, case)[l])
+                    mlbase.assert_shape(hidden, [batch_size_dimension, self.hyper_parameters.width])
 
-        cased_logit = tf.matmul(self.dropout(hidden), cased_Y) + cased_Y_bias
-        mlbase.assert_shape(cased_logit, [batch_size_dimension, 1, len(self.output_labels)])
+            case_logit = tf.matmul(self.dropout(hidden), tf.gather(self.Y, case)) + tf.gather(self.Y_bias, case)
+            mlbase.assert_shape(case_logit, [batch_size_dimension, len(self.output_labels)])
+            case_logits += [case_logit]
 
-        self.output_logit = tf.reshape(cased_logit, [-1, len(self.output_labels)])
+        # Put the instances back in their original order.
+        self.output_logit = tf.dynamic_stitch(case_indices, case_logits)
         mlbase.assert_shape(self.output_logit, [batch_size_dimension, len(self.output_labels)])
 
         self.output_distributions = tf.nn.softmax(self.output_logit)
@@ -437,16 +449,17 @@ class SeparateFfnn(TfModel):
         #    inputs=hidden,
         #    num_sampled=1,
         #    num_classes=len(self.output_labels)))
-        loss_fn = tf.nn.sparse_softmax_cross_entropy_with_logits
-        self.cost = tf.reduce_sum(loss_fn(labels=tf.stop_gradient(self.output_p), logits=self.output_logit))
-        #self.updates = tf.train.AdamOptimizer().minimize(self.cost)
+        if not self.inference:
+            loss_fn = tf.nn.sparse_softmax_cross_entropy_with_logits
+            self.cost = tf.reduce_sum(loss_fn(labels=tf.stop_gradient(self.output_p), logits=self.output_logit))
+            #self.updates = tf.train.AdamOptimizer().minimize(self.cost)
 
-        optimizer = tf.train.GradientDescentOptimizer(self.learning_rate_p[0])
-        gradients = optimizer.compute_gradients(self.cost)
-        gradients_clipped = [(tf.clip_by_norm(g, self.clip_norm_p[0]), var) for g, var in gradients if g is not None]
-        self.updates = optimizer.apply_gradients(gradients_clipped)
+            optimizer = tf.train.GradientDescentOptimizer(self.learning_rate_p[0])
+            gradients = optimizer.compute_gradients(self.cost)
+            gradients_clipped = [(tf.clip_by_norm(g, self.clip_norm_p[0]), var) for g, var in gradients if g is not None]
+            self.updates = optimizer.apply_gradients(gradients_clipped)
 
-        config = tf.ConfigProto()
+        config = tf.ConfigProto() if self.session_config is None else self.session_config
         config.gpu_options.allow_growth = True
         self.session = tf.Session(config=config)
         self.session.run(tf.global_variables_initializer())
@@ -476,6 +489,13 @@ class SeparateFfnn(TfModel):
             self.dropout_keep_p: np.array([1.0]),
         }
 
+    def get_prediction_feed(self, inputs, cases):
+        return {
+            self.input_p: inputs,
+            self.input_cases_p: cases,
+            self.dropout_keep_p: np.array([1.0]),
+        }
+
 
 class CustomOutput(Model):
     def __init__(self, scope, output_labels, output_distribution):
@@ -491,6 +511,15 @@ class CustomOutput(Model):
             return mlbase.Result(self.output_labels, self.output_distribution), None
 
 
+def top_k(distributions, k):
+    # The k most probable output indices (and their probabilities) of each distribution, most probable first.
+    k = min(check.check_gte(k, 1), distributions.shape[-1])
+    indices = np.argpartition(-distributions, k - 1, axis=-1)[:, :k]
+    probabilities = np.take_along_axis(distributions, indices, axis=-1)
+    order = np.argsort(-probabilities, axis=-1, kind="stable")
+    return np.take_along_axis(indices, order, axis=-1), np.take_along_axis(probabilities, order, axis=-1)
+
+
 class HyperParameters:
     def __init__(self, layers, width):
         self.layers = layers
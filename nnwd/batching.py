@@ -0,0 +1,206 @@
+
+import logging
+import numpy as np
+import queue
+import threading
+import time
+
+from nnwd import rnn
+from pytils import check
+
+
+MAX_BATCH = 32
+MAX_WAIT = 0.002
+
+
+class MicroBatcher:
+    # Collects the calls submitted by concurrent (request) threads for up to 'max_wait' seconds, or until there are 'max_batch'
+    # of them, and runs them together via 'run_batch(calls)', which returns the result of each call.
+    # Calls are only batched with others of the same key (ex: those requesting the same instruments).
+    def __init__(self, run_batch, max_batch=MAX_BATCH, max_wait=MAX_WAIT, workers=1):
+        self.run_batch = run_batch
+        self.max_batch = check.check_gte(max_batch, 1)
+        self.max_wait = check.check_gte(max_wait, 0)
+        self.calls = 0
+        self.batches = 0
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+
+        # Each worker runs one batch at a time (ex: one per replica of a pool.LstmPool).
+        for i in range(check.check_gte(workers, 1)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def __repr__(self):
+        return "MicroBatcher{calls=%d, batches=%d, average=%.2f}" % (self.calls, self.batches, 0.0 if self.batches == 0 else self.calls / self.batches)
+
+    def submit(self, key, call):
+        pending = _Pending(key, call)
+        self._pending.put(pending)
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+        return pending.result
+
+    def _work(self):
+        # Calls of a different key than the batch being collected are held over to start the next batch.
+        held = []
+
+        while True:
+            first = held.pop(0) if len(held) > 0 else self._pending.get()
+            batch = [first]
+            deadline = time.time() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+
+                try:
+                    pending = self._pending.get(timeout=remaining) if remaining > 0 else self._pending.get(block=False)
+                except queue.Empty:
+                    break
+
+                if pending.key == first.key:
+                    batch += [pending]
+                else:
+                    held += [pending]
+
+            self._run(batch)
+
+    def _run(self, batch):
+        with self._lock:
+            self.calls += len(batch)
+            self.batches += 1
+
+        try:
+            results = self.run_batch([pending.call for pending in batch])
+            assert len(results) == len(batch), "%d != %d" % (len(results), len(batch))
+
+            for pending, result in zip(batch, results):
+                pending.result = result
+        except Exception as e:
+            logging.exception("Failed running a batch of %d." % len(batch))
+
+            for pending in batch:
+                pending.error = e
+
+        for pending in batch:
+            pending.done.set()
+
+
+class _Pending:
+    def __init__(self, key, call):
+        self.key = key
+        self.call = call
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchingLstm:
+    # Runs the (single step) evaluate calls of concurrent threads as batches (see Lstm.evaluate_batch).
+    # Mirrors the inference interface of rnn.Lstm, so it may be used in its place (ex: by rnn.Stepwise).
+    def __init__(self, lstm, max_batch=MAX_BATCH, max_wait=MAX_WAIT, workers=1):
+        self.lstm = lstm
+        self.hyper_parameters = lstm.hyper_parameters
+        self.ablations = lstm.ablations
+        self.word_labels = lstm.word_labels
+        self.output_labels = lstm.output_labels
+        self.batcher = MicroBatcher(self._evaluate_batch, max_batch, max_wait, workers)
+
+    def evaluate(self, x, handle_unknown=False, state=None, instrument_names=[]):
+        return self.batcher.submit((handle_unknown, tuple(instrument_names)), (x, handle_unknown, state, instrument_names))
+
+    def _evaluate_batch(self, calls):
+        # All of the calls share the same key.
+        handle_unknown = calls[0][1]
+        instrument_names = calls[0][3]
+        return self.lstm.evaluate_batch([x for x, _, state, _ in calls], handle_unknown, [state for x, _, state, _ in calls], instrument_names)
+
+    def evaluate_sequence(self, xs, handle_unknown=False, instrument_names=[]):
+        return self.lstm.evaluate_sequence(xs, handle_unknown, instrument_names)
+
+    def evaluate_batch(self, xs, handle_unknown=False, states=None, instrument_names=[]):
+        return self.lstm.evaluate_batch(xs, handle_unknown, states, instrument_names)
+
+    def evaluate_batch_instrumented(self, sequences, handle_unknown=False, instrument_names=[]):
+        return self.lstm.evaluate_batch_instrumented(sequences, handle_unknown, instrument_names)
+
+    def result(self, state):
+        return self.lstm.result(state)
+
+    def stepwise(self, name=None, handle_unknown=False):
+        return rnn.Stepwise(self, name, handle_unknown)
+
+    def embed(self, x):
+        return self.lstm.embed(x)
+
+    def probe(self, name, layer):
+        return self.lstm.probe(name, layer)
+
+    def keys(self):
+        return self.lstm.keys()
+
+    def part_layers(self):
+        return self.lstm.part_layers()
+
+    def is_embedding(self, key_or_part, layer=None):
+        return self.lstm.is_embedding(key_or_part, layer)
+
+    def part_width(self, key):
+        return self.lstm.part_width(key)
+
+    def encode_key(self, part, layer=None):
+        return self.lstm.encode_key(part, layer)
+
+    def decode_key(self, key):
+        return self.lstm.decode_key(key)
+
+
+class BatchingModel:
+    # Runs the evaluate calls of concurrent threads (ex: to the semantic model) as one concatenated batch.
+    # Mirrors the inference interface of ml.model.Model.
+    def __init__(self, model, max_batch=MAX_BATCH, max_wait=MAX_WAIT, workers=1):
+        self.model = model
+        self.scope = model.scope
+        self.batcher = MicroBatcher(self._evaluate_batch, max_batch, max_wait, workers)
+        self.predict_batcher = MicroBatcher(self._predict_top_k_batch, max_batch, max_wait, workers)
+
+    def evaluate(self, batch, handle_unknown=False):
+        if isinstance(batch, list):
+            return self.batcher.submit(handle_unknown, (batch, handle_unknown))
+        else:
+            results, loss = self.batcher.submit(handle_unknown, ([batch], handle_unknown))
+            return results[0], loss
+
+    def _evaluate_batch(self, calls):
+        # All of the calls share the same key.
+        handle_unknown = calls[0][1]
+        results, _ = self.model.evaluate([xy for batch, handle_unknown in calls for xy in batch], handle_unknown)
+        out = []
+        offset = 0
+
+        for batch, handle_unknown in calls:
+            # Notice, the loss isn't separable across the calls (and isn't computed for inference only models).
+            out += [(results[offset:offset + len(batch)], None)]
+            offset += len(batch)
+
+        return out
+
+    def predict_top_k(self, inputs, cases, k):
+        return self.predict_batcher.submit(k, (inputs, cases, k))
+
+    def _predict_top_k_batch(self, calls):
+        # All of the calls share the same k.
+        k = calls[0][2]
+        indices, probabilities = self.model.predict_top_k(np.concatenate([inputs for inputs, _, _ in calls]), np.concatenate([cases for _, cases, _ in calls]), k)
+        out = []
+        offset = 0
+
+        for inputs, cases, k in calls:
+            out += [(indices[offset:offset + len(inputs)], probabilities[offset:offset + len(inputs)])]
+            offset += len(inputs)
+
+        return out
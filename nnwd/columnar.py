@@ -0,0 +1,318 @@
+
+import json
+import logging
+import numpy as np
+import os
+import pickle
+import queue
+import threading
+
+from nnwd import pickler
+from pytils import check
+
+
+MANIFEST = "columnar.json"
+# The kinds of fields a columnar directory may hold.
+#   POINT       a float32 matrix (exactly one per directory)
+#   INTERNED    arbitrary hashable values (or numpy arrays, interned by their contents), stored as int32 ids into a vocabulary
+#   INTEGER     plain int32 values
+#   INTEGER64   plain int64 values (ex: hashes)
+POINT = "point"
+INTERNED = "interned"
+INTEGER = "integer"
+INTEGER64 = "integer64"
+FLUSH_SIZE = 10000
+# Flush sooner for wide points, so that a bounded stream (pickler.StreamQueue) is released regularly.
+FLUSH_BYTES = 8 * 1024 * 1024
+READ_CHUNK = 10000
+
+
+def exists(dir_path):
+    return os.path.exists(os.path.join(dir_path, MANIFEST))
+
+
+def dump(data, dir_path, fields, converter=None, metadata=None):
+    # The (json serializable) 'metadata' is kept in the manifest, for the reader.
+    os.makedirs(dir_path, exist_ok=True)
+    check.check_length([name for name, kind in fields if kind == POINT], 1)
+
+    if isinstance(data, queue.Queue):
+        if isinstance(data, pickler.StreamQueue):
+            data.converter = converter
+
+        thread = threading.Thread(target=_dump_stream, args=[data, dir_path, fields, converter, metadata])
+        # Non-daemon threads will keep the program running until they finish (as per documentation).
+        thread.daemon = False
+        thread.start()
+    else:
+        writer = Writer(dir_path, fields, metadata)
+
+        for item in data:
+            writer.append(item if converter is None else converter(item))
+
+        writer.close()
+        logging.debug("Completed columnar writing for '%s'." % dir_path)
+
+
+def _dump_stream(data, dir_path, fields, converter, metadata):
+    check.check_instance(data, queue.Queue)
+    writer = Writer(dir_path, fields, metadata)
+
+    if isinstance(data, pickler.StreamQueue):
+        writer.on_flush = data.written
+
+    while True:
+        item = data.get()
+
+        if isinstance(item, pickler.Mark):
+            # Columnar directories are written in one go, so the input positions aren't needed.
+            continue
+        elif item is not None:
+            writer.append(item if converter is None else converter(item))
+        else:
+            # The data stream is complete - flush the remaining data.
+            writer.close()
+            logging.debug("Completed columnar stream for '%s'." % dir_path)
+            break
+
+
+def load(dir_path, allow_not_found=False, converter=None):
+    try:
+        with open(os.path.join(dir_path, MANIFEST), "r") as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError as e:
+        if allow_not_found:
+            return None
+        else:
+            raise e
+
+    return Columns(dir_path, manifest, converter)
+
+
+def _dtype(kind):
+    return "float32" if kind == POINT else ("int64" if kind == INTEGER64 else "int32")
+
+
+def _field_path(dir_path, name, kind):
+    return os.path.join(dir_path, name + "." + _dtype(kind))
+
+
+def _vocabulary_path(dir_path, name):
+    return os.path.join(dir_path, name + ".vocabulary")
+
+
+def sort(dir_path, name):
+    # Reorders every column of the (completely written) directory by the integer field 'name', so it may be binary searched.
+    # The manifest is removed for the duration, so that a partially sorted directory is never recognized as columnar.
+    columns = load(dir_path)
+
+    if columns.kind(name) not in [INTEGER, INTEGER64]:
+        raise ValueError("cannot sort by the %s field '%s'" % (columns.kind(name), name))
+
+    order = np.argsort(columns.array(name), kind="stable")
+    os.remove(os.path.join(dir_path, MANIFEST))
+
+    for field_name, kind in columns.fields:
+        array = columns.array(field_name)
+        write_path = _field_path(dir_path, field_name, kind)
+
+        with open(write_path + ".sorting", "wb") as fh:
+            for offset in range(0, len(order), READ_CHUNK):
+                np.asarray(array[order[offset:offset + READ_CHUNK]]).tofile(fh)
+
+        os.replace(write_path + ".sorting", write_path)
+
+    manifest = dict(columns.manifest)
+    manifest["sorted"] = name
+
+    with open(os.path.join(dir_path, MANIFEST), "w") as fh:
+        json.dump(manifest, fh)
+
+
+class Writer:
+    def __init__(self, dir_path, fields, metadata=None):
+        self.dir_path = dir_path
+        self.fields = [(name, kind) for name, kind in fields]
+        self.metadata = metadata
+        self.width = None
+        self.count = 0
+        self._buffers = [[] for field in self.fields]
+        self._encodings = {name: {} for name, kind in self.fields if kind == INTERNED}
+        self._handles = [open(_field_path(dir_path, name, kind), "wb") for name, kind in self.fields]
+        self._buffered = 0
+        # Called with the (rows, bytes) of each flush.
+        self.on_flush = None
+
+    def append(self, row):
+        check.check_length(row, len(self.fields))
+
+        for i, field_value in enumerate(zip(self.fields, row)):
+            field, value = field_value
+            name, kind = field
+
+            if kind == POINT:
+                if self.width is None:
+                    self.width = len(value)
+
+                assert len(value) == self.width, "%d != %d" % (len(value), self.width)
+                self._buffers[i] += [value]
+            elif kind == INTERNED:
+                encoding = self._encodings[name]
+                interned = (value.dtype.str, value.shape, value.tobytes()) if isinstance(value, np.ndarray) else value
+
+                if interned not in encoding:
+                    encoding[interned] = (len(encoding), value)
+
+                self._buffers[i] += [encoding[interned][0]]
+            else:
+                self._buffers[i] += [value]
+
+        self.count += 1
+        self._buffered += 1
+
+        if self._buffered == FLUSH_SIZE or self._buffered * (self.width + len(self.fields)) * 4 >= FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        size = 0
+
+        for i, field in enumerate(self.fields):
+            if len(self._buffers[i]) > 0:
+                array = np.array(self._buffers[i], dtype=_dtype(field[1]))
+                array.tofile(self._handles[i])
+                size += array.nbytes
+                self._buffers[i] = []
+
+        if self.on_flush is not None and self._buffered > 0:
+            self.on_flush(self._buffered, size)
+
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+
+        for handle in self._handles:
+            handle.close()
+
+        for name, encoding in self._encodings.items():
+            vocabulary = [value for identifier, value in sorted(encoding.values(), key=lambda item: item[0])]
+
+            with open(_vocabulary_path(self.dir_path, name), "wb") as fh:
+                pickle.dump(vocabulary, fh)
+
+        # The manifest is written last, so that only a fully written directory is recognized as columnar.
+        with open(os.path.join(self.dir_path, MANIFEST), "w") as fh:
+            json.dump({
+                "fields": self.fields,
+                "width": 0 if self.width is None else self.width,
+                "count": self.count,
+                "metadata": self.metadata,
+            }, fh)
+
+
+class Columns:
+    def __init__(self, dir_path, manifest, converter=None):
+        self.dir_path = dir_path
+        self.manifest = manifest
+        self.fields = [(name, kind) for name, kind in manifest["fields"]]
+        self.width = manifest["width"]
+        self.count = manifest["count"]
+        self.metadata = manifest.get("metadata")
+        # The field the rows are ordered by (see 'sort'), or None.
+        self.sorted = manifest.get("sorted")
+        self.converter = converter
+        # The (start, stop) of the point's columns this view is restricted to, or None for all of them.
+        self.span = None
+        self._arrays = {}
+        self._vocabularies = {}
+
+    def view(self, start, stop, converter=None):
+        # A view of these columns, with the point restricted to its columns [start, stop).
+        # The arrays are shared - the view's points are a strided slice of the same memory map.
+        offset = 0 if self.span is None else self.span[0]
+        check.check_gte(start, 0)
+        check.check_lte(stop, self.width)
+        view = Columns(self.dir_path, self.manifest, converter)
+        view.span = (offset + start, offset + stop)
+        view.width = stop - start
+        view._arrays = self._arrays
+        view._vocabularies = self._vocabularies
+        return view
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "Columns{%s, count=%d, width=%d}" % (self.dir_path, self.count, self.width)
+
+    def kind(self, name):
+        for field_name, kind in self.fields:
+            if field_name == name:
+                return kind
+
+        raise ValueError("unknown field '%s' in %s" % (name, self.fields))
+
+    def array(self, name):
+        if name not in self._arrays:
+            kind = self.kind(name)
+            dtype = _dtype(kind)
+            shape = (self.count, self.manifest["width"]) if kind == POINT else (self.count,)
+
+            # Numpy refuses to memory map an empty file.
+            if self.count == 0:
+                self._arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self._arrays[name] = np.memmap(_field_path(self.dir_path, name, kind), dtype=dtype, mode="r", shape=shape)
+
+        if self.span is not None and self.kind(name) == POINT:
+            return self._arrays[name][:, self.span[0]:self.span[1]]
+
+        return self._arrays[name]
+
+    @property
+    def points(self):
+        return self.array(next(name for name, kind in self.fields if kind == POINT))
+
+    def vocabulary(self, name):
+        if name not in self._vocabularies:
+            with open(_vocabulary_path(self.dir_path, name), "rb") as fh:
+                self._vocabularies[name] = pickle.load(fh)
+
+        return self._vocabularies[name]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+
+        if index < 0 or index >= self.count:
+            raise IndexError("index %d out of range for %d items" % (index, self.count))
+
+        return next(self.rows(index, index + 1))
+
+    def __iter__(self):
+        return self.rows()
+
+    def rows(self, start=0, stop=None):
+        stop = self.count if stop is None else min(stop, self.count)
+
+        for offset in range(start, stop, READ_CHUNK):
+            end = min(offset + READ_CHUNK, stop)
+            chunks = []
+
+            for name, kind in self.fields:
+                if kind == POINT:
+                    chunks += [self.array(name)[offset:end]]
+                elif kind == INTERNED:
+                    vocabulary = self.vocabulary(name)
+                    chunks += [[vocabulary[identifier] for identifier in self.array(name)[offset:end]]]
+                else:
+                    chunks += [self.array(name)[offset:end].tolist()]
+
+            for row in zip(*chunks):
+                if self.converter is None:
+                    yield row
+                else:
+                    result = self.converter(row)
+
+                    if result is not None:
+                        yield result
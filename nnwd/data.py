@@ -1,10 +1,12 @@
 
 import json
+import logging
 import os
 
 from ml import base as mlbase
 from ml import nlp
 from nnwd import pickler
+from nnwd.vocabulary import Vocabulary
 
 
 XYS_TRAIN = "xys.train"
@@ -16,6 +18,7 @@ DESCRIPTION = "description.json"
 OUTPUT_DISTRIBUTION = "output-distribution"
 POS_MAPPING = "pos-mapping"
 POS_TAGS = "pos-tags"
+VOCABULARY = "vocabulary"
 
 LM = "lm"
 SA = "sa"
@@ -27,7 +30,9 @@ def get_description(data_dir):
     with open(os.path.join(data_dir, DESCRIPTION), "r") as fh:
         key_values = json.load(fh)
         description = Description.__new__(Description)
-        description.__dict__ = {key: value for key, value in key_values.items()}
+        # Descriptions written before encoding was introduced.
+        description.__dict__ = {"encoded": False}
+        description.__dict__.update({key: value for key, value in key_values.items()})
         return description
 
 
@@ -65,6 +70,40 @@ def set_output_distribution(data_dir, distribution):
     pickler.dump([(key, value) for key, value in distribution.items()], os.path.join(data_dir, OUTPUT_DISTRIBUTION))
 
 
+def get_vocabulary(data_dir, persist=False):
+    # With 'persist', a vocabulary built for an older data directory is also saved into it (ex: by the data generation scripts).
+    vocabulary_path = os.path.join(data_dir, VOCABULARY)
+    values = pickler.load(vocabulary_path, allow_not_found=True)
+
+    if values is not None:
+        return Vocabulary([value for value in values])
+
+    description = get_description(data_dir)
+
+    if description.encoded:
+        raise ValueError("missing the vocabulary for the encoded data in '%s'" % data_dir)
+
+    # Data directories created before the vocabulary was introduced - build it from the data.
+    logging.debug("No vocabulary for '%s' - building it." % data_dir)
+    vocabulary = Vocabulary()
+
+    for kind in ["train", "validation", "test"]:
+        for xy in stream_data(data_dir, kind):
+            vocabulary.encode_sequence(xy.x)
+
+            if description.task == LM:
+                vocabulary.encode_sequence(xy.y)
+
+    if persist:
+        set_vocabulary(data_dir, vocabulary)
+
+    return vocabulary
+
+
+def set_vocabulary(data_dir, vocabulary):
+    pickler.dump(vocabulary.values(), os.path.join(data_dir, VOCABULARY))
+
+
 def stream_train(data_dir):
     return stream_data(data_dir, "train")
 
@@ -77,7 +116,7 @@ def stream_test(data_dir):
     return stream_data(data_dir, "test")
 
 
-def stream_data(data_dir, kind):
+def stream_data(data_dir, kind, prefetch=0, start=0):
     description = get_description(data_dir)
 
     if description.task == LM:
@@ -87,8 +126,20 @@ def stream_data(data_dir, kind):
     else:
         raise ValueError()
 
+    if description.encoded:
+        # Decode the sequences as they're streamed out.
+        vocabulary = get_vocabulary(data_dir)
+        converter = _decoding(converter, vocabulary, description.task)
+
     target_path = os.path.join(data_dir, XYS_TRAIN if kind == "train" else (XYS_TEST if kind == "test" else XYS_VALIDATION))
-    return pickler.load(target_path, converter=converter)
+    return pickler.load(target_path, converter=converter, start=start, prefetch=prefetch)
+
+
+def _decoding(converter, vocabulary, task):
+    if task == LM:
+        return lambda data: converter(vocabulary.decode_sequence(data))
+    else:
+        return lambda data: converter((vocabulary.decode_sequence(data[0]), data[1]))
 
 
 def _xy_sa(data):
@@ -104,21 +155,32 @@ def _xy_lm(data):
         return None
 
 
-def set_train(data_dir, pairs):
-    _set_data(data_dir, pairs, "train")
+def set_train(data_dir, pairs, vocabulary=None):
+    _set_data(data_dir, pairs, "train", vocabulary)
 
 
-def set_validation(data_dir, pairs):
-    _set_data(data_dir, pairs, "validation")
+def set_validation(data_dir, pairs, vocabulary=None):
+    _set_data(data_dir, pairs, "validation", vocabulary)
 
 
-def set_test(data_dir, pairs):
-    _set_data(data_dir, pairs, "test")
+def set_test(data_dir, pairs, vocabulary=None):
+    _set_data(data_dir, pairs, "test", vocabulary)
 
 
-def _set_data(data_dir, pairs, kind):
+def _set_data(data_dir, pairs, kind, vocabulary):
+    # With a 'vocabulary', the [(word, pos), ..] sequences are stored as int32 id arrays (see Vocabulary.encode_sequence).
     target_path = os.path.join(data_dir, XYS_TRAIN if kind == "train" else (XYS_TEST if kind == "test" else XYS_VALIDATION))
-    pickler.dump(pairs, target_path)
+
+    if vocabulary is None:
+        pickler.dump(pairs, target_path)
+    else:
+        # SA pairs are ([(word1, pos1), .., (wordN, posN)], sentiment), while LM pairs are just the sequence.
+        if get_description(data_dir).task == LM:
+            converter = lambda pair: vocabulary.encode_sequence(pair)
+        else:
+            converter = lambda pair: (vocabulary.encode_sequence(pair[0]), pair[1])
+
+        pickler.dump(pairs, target_path, converter=converter, out_of_band=True)
 
 
 def set_pos_mapping(data_dir, pos_mapping):
@@ -134,9 +196,11 @@ def set_pos(data_dir, pos_tags):
 
 
 class Description:
-    def __init__(self, task):
+    def __init__(self, task, encoded=False):
         self.task = task
+        # Whether the xys are stored encoded by the vocabulary.
+        self.encoded = encoded
 
     def __repr__(self):
-        return "Description{%s}" % (self.task)
+        return "Description{%s, encoded=%s}" % (self.task, self.encoded)
 
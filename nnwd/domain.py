@@ -26,13 +26,17 @@ import uuid
 from ml import base as mlbase
 from ml import model
 from ml import nlp
+from nnwd import batching
 from nnwd import data
 from nnwd import geometry
+from nnwd import inference
 from nnwd import latex
 from nnwd import lm
 from nnwd.models import Timestep, WeightExplain, WeightDetail, HiddenState, LabelDistribution, SequenceRollup, SequenceMatch, Estimate, SoftFilters, Predicates
 from nnwd import parameters
 from nnwd import pickler
+from nnwd import pool
+from nnwd import prefixes
 from nnwd import query
 from nnwd import reduction
 from nnwd import rnn
@@ -154,7 +158,8 @@ def pos_colour_mapping():
 
 
 class NeuralNetwork:
-    def __init__(self, data_dir, sequential_dir, buckets_dir, encoding_dir, use_fixed_buckets):
+    def __init__(self, data_dir, sequential_dir, buckets_dir, encoding_dir, use_fixed_buckets, numpy_inference=False, prefix_states_dir=None,
+                 replicas=1, intra_op_threads=0, inter_op_threads=0, micro_batch=0, micro_batch_wait=batching.MAX_WAIT):
         self.data_dir = data_dir
         self.sequential_dir = sequential_dir
         self.buckets_dir = buckets_dir
@@ -184,7 +189,7 @@ class NeuralNetwork:
         else:
             self.bucket_mappings = reduction.get_learned_buckets(self.buckets_dir)
 
-        self.lstm = sequential.load_model(self.data_dir, self.sequential_dir)
+        session_config = pool.session_config(intra_op_threads, inter_op_threads)
 
         def _ffnn_constructor(scope, hyper_parameters, extra, case_field, hidden_vector, word_labels, output_labels):
             if extra["word_input"]:
@@ -193,11 +198,37 @@ class NeuralNetwork:
                 input_field = mlbase.ConcatField([case_field, hidden_vector])
 
             if extra["monolith"]:
-                return model.Ffnn(scope, hyper_parameters, extra, input_field, output_labels)
+                return model.Ffnn(scope, hyper_parameters, extra, input_field, output_labels, inference=True, session_config=session_config)
             else:
-                return model.SeparateFfnn(scope, hyper_parameters, extra, input_field, output_labels, case_field)
+                return model.SeparateFfnn(scope, hyper_parameters, extra, input_field, output_labels, case_field, inference=True, session_config=session_config)
 
-        self.sem = semantic.load_model(self.lstm, self.encoding_dir, model_fn=_ffnn_constructor)
+        def _load_models():
+            lstm = sequential.load_model(self.data_dir, self.sequential_dir, inference=True, session_config=session_config)
+
+            if numpy_inference:
+                lstm = inference.NumpyLstm(lstm)
+
+            return lstm, semantic.load_model(lstm, self.encoding_dir, model_fn=_ffnn_constructor)
+
+        if replicas == 1:
+            self.lstm, self.sem = _load_models()
+        else:
+            # Concurrent requests are each handed their own replica of the models.
+            lstms, sems = zip(*pool.replicate(replicas, _load_models))
+            self.lstm = pool.LstmPool(list(lstms))
+            self.sem = pool.ModelPool(list(sems))
+
+        if micro_batch > 0:
+            # Concurrent requests' single step lstm (and semantic model) calls are run together, as batches.
+            self.lstm = batching.BatchingLstm(self.lstm, micro_batch, micro_batch_wait, replicas)
+            self.sem = batching.BatchingModel(self.sem, micro_batch, micro_batch_wait, replicas)
+
+        self.prefixes = prefixes.PrefixTrie(rnn.Stepwise(self.lstm, "root", handle_unknown=True))
+        # The precomputed states of known prefixes (see generate-prefix-states.py).
+        self.prefix_store = None if prefix_states_dir is None else states.get_prefix_states(prefix_states_dir)
+
+        if prefix_states_dir is not None and self.prefix_store is None:
+            raise ValueError("no prefix states in '%s'" % prefix_states_dir)
 
         # TODO
         embedding_padding = tuple([0] * max(0, self.lstm.hyper_parameters.width - self.lstm.hyper_parameters.embedding_width))
@@ -211,24 +242,28 @@ class NeuralNetwork:
             return (key, tuple(point) + (embedding_padding if self.lstm.is_embedding(key) else hidden_padding))
 
         self.as_input = _as_input
+        self.case_labels = semantic.case_labels_for(self.lstm)
+        self.hidden_width = semantic.hidden_width(self.lstm)
         self.details_mins = {}
         self.details_maxs = {}
         self.weights_mins = {}
         self.weights_maxs = {}
 
-    @functools.lru_cache()
     def stepwise(self, sequence):
-        if len(sequence) == 0:
-            return rnn.Stepwise(self.lstm, "root", handle_unknown=True)
-        else:
-            return self.stepwise(sequence[:-1]).next_stepwise(sequence[-1])
+        return self.prefixes.stepwise(sequence)
 
     def query_lstm(self, sequence, instruments):
         word = sequence[-1]
         resolved_word = self.words.decode(self.words.encode(word, True))
-        stepwise_lstm = self.stepwise(tuple(sequence[:-1]))
-        assert stepwise_lstm.name == ",".join(["root"] + sequence[:-1]), "%s != %s" % (stepwise_lstm.name, ",".join(["root"] + sequence))
-        result, instrument_values = stepwise_lstm.query(word, instrument_names=instruments)
+        stored = None if self.prefix_store is None else self.prefix_store.get(sequence, instruments)
+
+        if stored is not None:
+            state, instrument_values = stored
+            result = self.lstm.result(state)
+        else:
+            stepwise_lstm = self.stepwise(tuple(sequence[:-1]))
+            assert stepwise_lstm.name == ",".join(["root"] + sequence[:-1]), "%s != %s" % (stepwise_lstm.name, ",".join(["root"] + sequence))
+            result, instrument_values = stepwise_lstm.query(word, instrument_names=instruments)
 
         for kind, units in instrument_values.items():
             if kind != "ws":
@@ -330,21 +365,14 @@ class NeuralNetwork:
         return out
 
     def predict_distributions(self, word, points):
-        annotation = None
-        keys = []
-        xys = []
-
-        for key, point in points.items():
-            keys += [key]
-            xys += [mlbase.Xy(self.as_input(key, point), annotation)]
-
-        results, _ = self.sem.evaluate(xys)
-
+        keys = [key for key in points.keys()]
+        # Only the top k of each distribution is computed and decoded.
+        inputs, cases = semantic.stack_inputs(self.case_labels, self.hidden_width, keys, [points[key] for key in keys])
+        indices, probabilities = self.sem.predict_top_k(inputs, cases, self.top_k)
         distribution_predictions = {}
 
         for i, key in enumerate(keys):
-            ordered_predictions = [item[0] for item in sorted(results[i].distribution().items(), key=lambda item: item[1], reverse=True)]
-            distribution_predictions[key] = {prediction: results[i].distribution()[prediction] for prediction in ordered_predictions[:self.top_k]}
+            distribution_predictions[key] = {self.lstm.output_labels.decode(int(index)): probability for index, probability in zip(indices[i], probabilities[i])}
 
         return distribution_predictions
 
@@ -441,7 +469,8 @@ class NeuralNetwork:
         embedding = HiddenState(embedding_name, embedding_name_no_t, point_reductions[embedding_key], min_max, point_colours[embedding_key], self.prediction_distribution(point_predictions[embedding_key]))
         units = self.make_lstm_units(len(sequence) - 1, point_reductions, point_colours, point_predictions)
         softmax_name = self.latex_name(len(sequence) - 1, "softmax")
-        softmax = LabelDistribution(softmax_name, result.distribution, self.sort_key, parameters.OUTPUT_TOP_K, lambda output: self.rgb(self.output_colour(output)))
+        # Only the top outputs are shown, so avoid decoding the entire distribution.
+        softmax = LabelDistribution(softmax_name, result.top_k(parameters.OUTPUT_TOP_K), self.sort_key, parameters.OUTPUT_TOP_K, lambda output: self.rgb(self.output_colour(output)))
         return Timestep(embedding, units, softmax, len(sequence) - 1, last_word, result.prediction)
 
     def weight_detail(self, sequence, part, layer):
@@ -472,16 +501,15 @@ class NeuralNetwork:
         full_hidden_state = HiddenState(name, name_no_t, repositioned_point, min_max, None, None, positioning)
         return WeightDetail(hidden_state, full_hidden_state, back_links)
 
-    def soft_filter(self, sequence):
-        last_word, result, instrument_values = self.query_lstm(sequence, ["ws"])
+    def soft_filter(self, timestep_ws):
         part = "w"
         ws = []
 
-        for timestep in range(len(instrument_values["ws"])):
+        for timestep in range(len(timestep_ws)):
             units = []
 
-            for layer in range(len(instrument_values["ws"][timestep])):
-                point = instrument_values["ws"][timestep][layer]
+            for layer in range(len(timestep_ws[timestep])):
+                point = timestep_ws[timestep][layer]
                 # TODO
                 point_reduction = reduction.reduce(self.bucket_mappings["cells-0"], point)
                 name = self.latex_name(timestep, part, layer)
@@ -491,11 +519,24 @@ class NeuralNetwork:
 
             ws += [units]
 
-        return last_word, ws
+        return ws
 
     def soft_filters(self, sequence):
-        word_timesteps = [self.soft_filter(sequence[:i + 1]) for i in range(len(sequence))]
-        return SoftFilters([item[0] for item in word_timesteps], [item[1] for item in word_timesteps])
+        # The soft filters of every prefix, from a single run of the lstm over the whole sequence.
+        # For the prefix ending at i, the w of timestep t is: remember_gate[t] * product(forget_gate[t + 1:i + 1]).
+        timestep_instruments = self.lstm.evaluate_batch_instrumented([sequence], True, ["remember_gates", "forget_gates"])[0]
+        words = []
+        timesteps = []
+        #   [timestep][layer][width]
+        timestep_ws = []
+
+        for i, instruments in enumerate(timestep_instruments):
+            # Extending the prefix by one timestep multiplies each of the existing ws by the new forget gate.
+            timestep_ws = [w * instruments["forget_gates"] for w in timestep_ws] + [instruments["remember_gates"]]
+            words += [self.words.decode(self.words.encode(sequence[i], True))]
+            timesteps += [self.soft_filter(timestep_ws)]
+
+        return SoftFilters(words, timesteps)
 
     def prediction_distribution(self, prediction):
         if prediction is None:
@@ -785,10 +826,11 @@ class PatternEngine:
 
 
 class QueryEngine:
-    def __init__(self, lstm, query_dir, db_kind):
+    def __init__(self, lstm, query_dir, db_kind, vocabulary=None):
         self.lstm = lstm
         self.query_dir = query_dir
         self.db_kind = db_kind
+        self.vocabulary = vocabulary
         self.requests = queue.Queue()
         self.responses = {}
         thread = threading.Thread(target=self._process_sql)
@@ -797,7 +839,7 @@ class QueryEngine:
 
     def _process_sql(self):
         # Sql requests need to be run in the same thread as where the handle is created - so we do this using IPC.
-        query_dbs = query.get_databases(self.query_dir, self.db_kind, self.lstm)
+        query_dbs = query.get_databases(self.query_dir, self.db_kind, self.lstm, self.vocabulary)
         logging.debug("Started sql IPC.")
 
         while True:
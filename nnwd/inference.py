@@ -0,0 +1,194 @@
+
+import numpy as np
+
+from ml import base as mlbase
+from nnwd import rnn
+
+
+class NumpyLstm:
+    # The forward pass of a (loaded) rnn.Lstm, run in numpy from its exported parameters.
+    # For the server's one token, batch of one steps, this avoids the (dominating) overhead of each tensorflow session.run.
+    # Mirrors the inference interface of rnn.Lstm, so it may be used in its place (ex: by rnn.Stepwise).
+    def __init__(self, lstm):
+        self.lstm = lstm
+        self.hyper_parameters = lstm.hyper_parameters
+        self.ablations = lstm.ablations
+        self.word_labels = lstm.word_labels
+        self.output_labels = lstm.output_labels
+        self.parameters = lstm.export_parameters()
+        self._initials = {}
+        width = self.hyper_parameters.width
+        gate_names = ["R", "F", "O"] if self.ablations.srnn else ["R", "F", "O", "H"]
+        # All the gates of a layer are computed by a single matmul, from the concatenated [output_previous, x].
+        #   [layers, width * 2, width * gates]
+        self._gates = np.concatenate([self.parameters[name] for name in gate_names], axis=-1)
+        #   [layers, width * gates]
+        self._gates_bias = np.concatenate([self.parameters[name + "_bias"] for name in gate_names], axis=-1)
+        assert self._gates.shape == (self.hyper_parameters.layers, width * 2, width * len(gate_names)), self._gates.shape
+        assert self._gates_bias.shape == (self.hyper_parameters.layers, width * len(gate_names)), self._gates_bias.shape
+
+    def initial_state(self, batch_length):
+        if batch_length not in self._initials:
+            self._initials[batch_length] = np.zeros([rnn.Lstm.SCAN_STATES, self.hyper_parameters.layers, batch_length, self.hyper_parameters.width], dtype="float32")
+
+        return self._initials[batch_length]
+
+    def evaluate_sequence(self, xs, handle_unknown=False, instrument_names=[]):
+        # As per rnn.Lstm, the testing feed always handles unknown words.
+        embedded, unrolled_states = self._unroll([[self.word_labels.encode(x, True)] for x in xs], self.initial_state(1))
+        return self._result(unrolled_states[-1]), self._instruments(instrument_names, embedded, unrolled_states)
+
+    def evaluate(self, x, handle_unknown=False, state=None, instrument_names=[]):
+        embedded, unrolled_states = self._unroll([[self.word_labels.encode(x, handle_unknown)]], state if state is not None else self.initial_state(1))
+        return self._result(unrolled_states[-1]), unrolled_states[-1], self._instruments(instrument_names, embedded, unrolled_states)
+
+    def evaluate_batch(self, xs, handle_unknown=False, states=None, instrument_names=[]):
+        states = [None] * len(xs) if states is None else states
+        state = np.concatenate([self.initial_state(1) if state is None else state for state in states], axis=2)
+        embedded, unrolled_states = self._unroll([[self.word_labels.encode(x, handle_unknown) for x in xs]], state)
+        instrument_values = self._instruments(rnn.unrolled_instrument_names(instrument_names), embedded, unrolled_states)
+        unrolled_values = [instrument_values[name] for name in rnn.unrolled_instrument_names(instrument_names)]
+        distributions = self._distributions(unrolled_states[-1])
+        return [(rnn.TopKResult(self.output_labels, distributions[b]), unrolled_states[-1][:, :, b:b + 1].copy(), rnn.case_instruments(instrument_names, unrolled_values, b)) \
+            for b in range(len(xs))]
+
+    def evaluate_batch_instrumented(self, sequences, handle_unknown=False, instrument_names=[]):
+        max_time = max([len(xs) for xs in sequences])
+        blank = self.word_labels.encode(mlbase.BLANK, True)
+        input_labels = [[self.word_labels.encode(xs[t], handle_unknown) if t < len(xs) else blank for xs in sequences] for t in range(max_time)]
+        embedded, unrolled_states = self._unroll(input_labels, self.initial_state(len(sequences)))
+        instrument_values = self._instruments(["%s%s" % (name, rnn.UNROLLED_SUFFIX) for name in instrument_names], embedded, unrolled_states)
+        return [[{name: instrument_values[name + rnn.UNROLLED_SUFFIX][t, :, b] for name in instrument_names} for t in range(len(xs))] for b, xs in enumerate(sequences)]
+
+    def result(self, state):
+        return self._result(state)
+
+    def stepwise(self, name=None, handle_unknown=False):
+        return rnn.Stepwise(self, name, handle_unknown)
+
+    def embed(self, x):
+        return self.parameters["E"][[self.word_labels.encode(x, True)]].tolist()
+
+    def probe(self, name, layer):
+        result = self.parameters[name]
+
+        if name == "Y_bias":
+            # Matching the named tensor of the graph.
+            result = result.reshape([len(self.output_labels)])
+
+        if layer is None:
+            return result
+        else:
+            return result[layer]
+
+    def keys(self):
+        return self.lstm.keys()
+
+    def part_layers(self):
+        return self.lstm.part_layers()
+
+    def is_embedding(self, key_or_part, layer=None):
+        return self.lstm.is_embedding(key_or_part, layer)
+
+    def part_width(self, key):
+        return self.lstm.part_width(key)
+
+    def encode_key(self, part, layer=None):
+        return self.lstm.encode_key(part, layer)
+
+    def decode_key(self, key):
+        return self.lstm.decode_key(key)
+
+    def _unroll(self, input_labels, initial_state):
+        #   [time, batch, embedding_width]
+        embedded = self.parameters["E"][np.array(input_labels, dtype="int32")]
+
+        if "EP" in self.parameters:
+            projected = np.matmul(embedded, self.parameters["EP"])
+        else:
+            projected = embedded
+
+        #   [time, SCAN_STATES, layers, batch, width]
+        unrolled_states = np.zeros((len(input_labels),) + initial_state.shape, dtype="float32")
+        state = initial_state
+
+        for t in range(len(input_labels)):
+            state = self._step(state, projected[t], unrolled_states[t])
+
+        return embedded, unrolled_states
+
+    def _step(self, previous_state, x, state):
+        # Fills in 'state' in the order of the scan states (see rnn.SCAN_PARTS).
+        width = self.hyper_parameters.width
+        output_previous = previous_state[0]
+        cell_previous = previous_state[1]
+
+        for l in range(self.hyper_parameters.layers):
+            gates = np.matmul(np.concatenate([output_previous[l], x], axis=-1), self._gates[l]) + self._gates_bias[l]
+            remember_gate = _sigmoid(gates[:, :width])
+            forget_gate = _sigmoid(gates[:, width:width * 2])
+            output_gate = _sigmoid(gates[:, width * 2:width * 3])
+
+            if self.ablations.srnn:
+                input_hat = np.matmul(x, self.parameters["H"][l])
+            else:
+                input_hat = np.tanh(gates[:, width * 3:])
+
+            remember = input_hat * remember_gate
+            forget = cell_previous[l] * forget_gate
+            cell = forget + remember
+            cell_hat = np.tanh(cell)
+
+            if self.ablations.out:
+                output = cell_hat
+            else:
+                output = cell_hat * output_gate
+
+            state[:, l] = [output, cell, remember_gate, forget_gate, output_gate, input_hat, remember, cell_previous[l], forget, cell_hat]
+            x = output
+
+        return state
+
+    def _result(self, state):
+        # The distribution of the (first and only) sequence.
+        return rnn.TopKResult(self.output_labels, self._distributions(state)[0])
+
+    def _distributions(self, state):
+        # The distributions from the final layer's output of each sequence.
+        logits = np.matmul(state[0, -1], self.parameters["Y"]) + self.parameters["Y_bias"]
+        return _softmax(logits)
+
+    def _instruments(self, instrument_names, embedded, unrolled_states):
+        # The equivalent of each of the named instrument tensors of the graph.
+        instrument_values = {}
+
+        for name in instrument_names:
+            if name == "embedding":
+                instrument_values[name] = embedded.reshape([-1, self.hyper_parameters.embedding_width])
+            elif name == "embedding" + rnn.UNROLLED_SUFFIX:
+                instrument_values[name] = np.expand_dims(embedded, 1)
+            elif name in rnn.SCAN_PARTS:
+                instrument_values[name] = unrolled_states[-1, rnn.SCAN_PARTS.index(name)].reshape([-1, self.hyper_parameters.width])
+            elif name.endswith(rnn.UNROLLED_SUFFIX) and name[:-len(rnn.UNROLLED_SUFFIX)] in rnn.SCAN_PARTS:
+                instrument_values[name] = unrolled_states[:, rnn.SCAN_PARTS.index(name[:-len(rnn.UNROLLED_SUFFIX)])]
+            elif name == "ws":
+                # remember_gate[t] * product(forget_gate[t + 1:]), via the suffix products of the forget gates.
+                remember_gates = unrolled_states[:, rnn.SCAN_PARTS.index("remember_gates")]
+                forget_gates = unrolled_states[:, rnn.SCAN_PARTS.index("forget_gates")]
+                suffixes = np.ones(forget_gates.shape, dtype="float32")
+                suffixes[:-1] = np.cumprod(forget_gates[::-1], axis=0)[::-1][1:]
+                instrument_values[name] = (remember_gates * suffixes).reshape([len(unrolled_states), self.hyper_parameters.layers, self.hyper_parameters.width])
+            else:
+                raise ValueError("unknown instrument '%s'" % name)
+
+        return instrument_values
+
+
+def _sigmoid(x):
+    # Avoids the overflow of exp for large negative x.
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def _softmax(logits):
+    exponents = np.exp(logits - np.max(logits, axis=-1, keepdims=True))
+    return exponents / np.sum(exponents, axis=-1, keepdims=True)
@@ -4,6 +4,7 @@ import pdb
 import random
 
 from nnwd import data
+from nnwd.vocabulary import Vocabulary
 from pytils import adjutant
 
 
@@ -48,15 +49,18 @@ def create(data_dir, corpus_stream_fn):
         pos_count = sorted(counts.items(), key=lambda item: item[1], reverse=True)[0]
         pos_mapping[word] = pos_count[0]
 
-    data.set_train(data_dir, train_xys)
-    data.set_validation(data_dir, validation_xys)
-    data.set_test(data_dir, test_xys)
+    # The description comes first, since the data is stored according to it.
+    data.set_description(data_dir, data.Description(data.LM, encoded=True))
+    vocabulary = Vocabulary()
+    data.set_train(data_dir, train_xys, vocabulary)
+    data.set_validation(data_dir, validation_xys, vocabulary)
+    data.set_test(data_dir, test_xys, vocabulary)
+    data.set_vocabulary(data_dir, vocabulary)
     data.set_output_distribution(data_dir, output_distribution)
     words = set([word for word in word_pos_counts2.keys()])
     data.set_words(data_dir, words)
     data.set_pos_mapping(data_dir, pos_mapping)
     data.set_pos(data_dir, pos_tags)
-    data.set_description(data_dir, data.Description(data.LM))
     logging.debug("total pairs (t, v, t): %d, %d, %d" % (sum([len(xy) for xy in train_xys]), sum([len(xy) for xy in validation_xys]), sum([len(xy) for xy in test_xys])))
     logging.debug("unique words: %d" % len(words))
     return train_xys, validation_xys, test_xys
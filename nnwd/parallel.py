@@ -0,0 +1,199 @@
+
+import logging
+import math
+import multiprocessing
+import numpy as np
+import random
+import time
+
+from ml import base as mlbase
+from nnwd import sequential
+from pytils import check
+
+
+# The number of (evenly spaced) batches timed for the single process baseline of the reported speedup.
+BASELINE_STEPS = 8
+
+
+class DataParallel:
+    # Trains an rnn.Lstm with 'workers' processes, each owning a replica of its graph and a shard of the training sequences.
+    # Every step, each worker computes the gradients of its next local batch, which are combined (synchronously) and applied
+    # to the lstm and all of the replicas alike - so they stay in sync without sending the parameters back and forth.
+    # A step is the same update as a single process would make for the workers' local batches together (see 'combine').
+    # The lstm itself remains the model of record (ex: for sequential.save_model).
+    def __init__(self, lstm, data_dir, workers):
+        self.lstm = lstm
+        self.workers = check.check_gte(workers, 1)
+        self._training_id = None
+        # Tensorflow isn't fork safe, so each worker starts as a fresh process.
+        context = multiprocessing.get_context("spawn")
+        self._connections = []
+        self._processes = []
+
+        for i in range(workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=_work, args=(worker_connection, data_dir, lstm.hyper_parameters, lstm.ablations))
+            process.daemon = True
+            process.start()
+            self._connections += [connection]
+            self._processes += [process]
+
+    def __repr__(self):
+        return "DataParallel{workers=%d}" % self.workers
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(("stop", None))
+
+        for process in self._processes:
+            process.join()
+
+    def train(self, xy_sequences, training_parameters):
+        check.check_instance(training_parameters, mlbase.TrainingParameters)
+
+        if self.lstm.inference:
+            raise ValueError("cannot train an inference only model")
+
+        if id(xy_sequences) != self._training_id:
+            self._training_id = id(xy_sequences)
+            # Stripe the (length sorted) sequences across the workers, so that each shard has a similar distribution of lengths.
+            encoded = self.lstm.encode(xy_sequences)
+            self._encoded = encoded
+            self._shard_lengths = []
+
+            for i, connection in enumerate(self._connections):
+                shard = encoded.xys[i::self.workers]
+                self._shard_lengths += [len(shard)]
+                connection.send(("shard", shard))
+
+        # Measured before the replicas start, so the workers don't compete with it for the cores.
+        baseline_rate = single_process_rate(self.lstm, self._encoded, training_parameters)
+        # The replicas start from the lstm's (possibly reloaded) parameters.
+        self._broadcast("variables", self.lstm.get_variables())
+        slot_length = len(str(training_parameters.epochs())) - 1
+        epoch_template = "Epoch training {:%dd} (loss, perplexity): {:.6f}, {:.6f} ({:.2f}s, {:.1f} instances/s, speedup {:.2f}x)" % slot_length
+        epochs_tenth = max(1, int(training_parameters.epochs() / 10))
+        losses = training_parameters.losses()
+        finished = False
+        epoch = -1
+
+        while not finished:
+            epoch += 1
+            started = time.time()
+            epoch_loss = 0.0
+            count = 0
+
+            for connection, shard_length in zip(self._connections, self._shard_lengths):
+                # Start at a different offset for every epoch (and worker) to help avoid overfitting.
+                offset = random.randint(0, max(1, min(training_parameters.batch(), shard_length)) - 1)
+                connection.send(("epoch", (offset, training_parameters)))
+
+            while True:
+                self._broadcast("gradients", None)
+                step_gradients = []
+
+                for connection in self._connections:
+                    batch_count, loss, gradients = self._receive(connection)
+
+                    if batch_count > 0:
+                        count += batch_count
+                        epoch_loss += loss
+                        step_gradients += [gradients]
+
+                if len(step_gradients) == 0:
+                    break
+
+                combined = combine(step_gradients)
+                self._broadcast("apply", combined)
+                self.lstm.apply_gradients(combined, training_parameters)
+
+            assert count == len(xy_sequences), "%d != %d" % (count, len(xy_sequences))
+            epoch_loss /= count
+            epoch_perplexity = math.exp(epoch_loss)
+            losses.append(epoch_loss)
+            finished, reason = training_parameters.finished(epoch, losses)
+            elapsed = time.time() - started
+
+            if finished or epoch % epochs_tenth == 0:
+                logging.debug(epoch_template.format(epoch, epoch_loss, epoch_perplexity, elapsed, count / elapsed, (count / elapsed) / baseline_rate))
+
+        return epoch_loss, -epoch_perplexity
+
+    def _broadcast(self, command, payload):
+        for connection in self._connections:
+            connection.send((command, payload))
+
+    def _receive(self, connection):
+        result = connection.recv()
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+
+def combine(step_gradients):
+    # The lstm costs are summed over the instances of a batch, so the gradient of the workers' batches together is the sum
+    # of each worker's (unclipped) gradients - the clipping is then applied to the sum, as it would be for a single batch.
+    return [np.sum(worker_gradients, axis=0) for worker_gradients in zip(*step_gradients)]
+
+
+def single_process_rate(lstm, encoded, training_parameters):
+    # The instances/s of single process training, from real training steps of the lstm over evenly spaced batches of the
+    # (length sorted) sequences - its parameters are restored afterwards, so the steps don't count towards the training.
+    variables = lstm.get_variables()
+    batch_size = training_parameters.batch()
+    starts = sorted(set([int(i * len(encoded) / BASELINE_STEPS) for i in range(BASELINE_STEPS)]))
+    # The first run of a session includes its (one off) setup, which wouldn't be part of an epoch.
+    lstm.session.run(lstm.updates, feed_dict=lstm.get_training_feed(encoded.batch(0, batch_size), training_parameters))
+    started = time.time()
+    count = 0
+
+    for start in starts:
+        batch = encoded.batch(start, start + batch_size)
+        lstm.session.run(lstm.updates, feed_dict=lstm.get_training_feed(batch, training_parameters))
+        count += len(batch)
+
+    elapsed = time.time() - started
+    lstm.set_variables(variables)
+    return count / max(elapsed, 1e-9)
+
+
+def _work(connection, data_dir, hyper_parameters, ablations):
+    lstm = sequential.model_for(data_dir, hyper_parameters=hyper_parameters, ablations=ablations)
+    _serve(connection, lstm)
+
+
+def _serve(connection, lstm):
+    training_parameters = None
+    batches = None
+
+    while True:
+        command, payload = connection.recv()
+
+        try:
+            if command == "stop":
+                break
+            elif command == "shard":
+                lstm.training_encoded = lstm.encode(payload)
+            elif command == "variables":
+                lstm.set_variables(payload)
+            elif command == "epoch":
+                offset, training_parameters = payload
+                batches = lstm.training_batches(offset, training_parameters.batch())
+            elif command == "gradients":
+                batch = next(batches, None)
+
+                if batch is None:
+                    connection.send((0, None, None))
+                else:
+                    loss, gradients = lstm.compute_gradients(batch, training_parameters)
+                    connection.send((len(batch), loss, gradients))
+            elif command == "apply":
+                lstm.apply_gradients(payload, training_parameters)
+            else:
+                raise ValueError("unknown command '%s'" % command)
+        except Exception as e:
+            logging.exception("Worker failed on '%s'." % command)
+            connection.send(e)
+            break
@@ -1,53 +1,121 @@
 
+import bisect
+import bz2
+import collections
+import io
+import json
 import logging
+import lzma
+import mmap
 import os
 import pickle
 import queue
 import random
+import struct
 import threading
+import time
+import zlib
 
+from ml import base as mlbase
 from pytils import check
 
 
 EXTENSION = ".pickle"
+BUFFERS_EXTENSION = ".buffers"
+MANIFEST = "manifest.json"
+TEMPORARY_EXTENSION = ".tmp"
 # 2147483648 - 1
 MAX_BYTES = (2**31) - 1
 # 100 MB = 100 * 1024 KB
 TARGET_FILE_SIZE = 100 * 1024 * 1024
 STREAM_TARGET_FILE_SIZE = 10 * 1024 * 1024
 STREAM_MAX_BATCH = 2000
-
-
-def dump(data, dir_path, converter=None):
+# The default in-flight budget for a StreamQueue - this must comfortably exceed the stream's target file size.
+STREAM_MAX_BYTES = 4 * STREAM_TARGET_FILE_SIZE
+# Out-of-band buffers are aligned within their file, so they may be viewed (by numpy) directly from the mapped memory.
+BUFFER_ALIGNMENT = 16
+# Shard compression codecs.
+#   NONE    uncompressed (buffers are memory mapped, rather than read)
+#   ZLIB    fast, moderate compression
+#   BZ2     slow, good compression
+#   LZMA    slowest, best compression
+NONE = "none"
+ZLIB = "zlib"
+BZ2 = "bz2"
+LZMA = "lzma"
+CODECS = [NONE, ZLIB, BZ2, LZMA]
+READ_SIZE = 1024 * 1024
+
+
+def dump(data, dir_path, converter=None, out_of_band=False, append=False, codec=NONE):
+    # With 'out_of_band', items are pickled with protocol 5 and their (contiguous) buffers, such as numpy arrays, are written
+    # as raw segments beside the pickle stream.
+    # On load, these come back as read-only views over the memory mapped segments, rather than copies.
+    # With 'append', the shards are added after those already committed to the directory's manifest.
+    # The 'codec' compresses each shard (it is recorded in the manifest, so 'load' needs not be told).
+    # Compressed out-of-band buffers are also byte-shuffled, which groups like bytes (ex: float exponents) for the compressor.
     os.makedirs(dir_path, exist_ok=True)
+    check.check_one_of(codec, CODECS)
 
     if isinstance(data, queue.Queue):
-        thread = threading.Thread(target=_dump_stream, args=[data, dir_path, converter])
+        if isinstance(data, StreamQueue):
+            data.converter = converter
+
+        thread = threading.Thread(target=_dump_stream, args=[data, dir_path, converter, out_of_band, append, codec])
         # Non-daemon threads will keep the program running until they finish (as per documentation).
         thread.daemon = False
         thread.start()
     else:
-        _dump(data, dir_path, converter)
+        _dump(data, dir_path, converter, out_of_band, append, codec)
+
+
+class Mark:
+    # Put into a stream by the producer to mark that all the items following it derive from the input at 'position' (or later).
+    # Streamed shards are only cut at marks, so that the manifest can record the input position each shard completes.
+    # Appending to a directory then drops the items before the position its manifest already commits.
+    def __init__(self, position):
+        self.position = check.check_gte(position, 0)
+
+    def __repr__(self):
+        return "Mark{%d}" % self.position
 
 
-def _dump_stream(data, dir_path, converter):
+def _dump_stream(data, dir_path, converter, out_of_band, append, codec):
     check.check_instance(data, queue.Queue)
     batch = []
     batch_size = None
-    i = 0
+    shards = _existing_shards(dir_path, append)
+    i = _next_index(shards)
+    committed = _committed(shards)
+    # The input position of the most recent mark (None for unmarked streams).
+    position = None
     try_size = 10
 
     while True:
         item = data.get()
 
-        if item is not None:
+        if isinstance(item, Mark):
+            position = item.position
+
+            if batch_size is not None and len(batch) >= batch_size:
+                shards += [_write_shard(_convert(converter, batch), dir_path, i, out_of_band, codec, position)]
+                _write_manifest(dir_path, shards, False)
+                _written(data, len(batch), shards[-1]["bytes"])
+                i += 1
+                batch = []
+        elif item is not None:
+            if committed is not None and position is not None and position < committed:
+                # This item was already committed by a previous run.
+                _discarded(data, 1)
+                continue
+
             batch += [item]
 
             # If we're still building out the sample.
             if batch_size is None:
                 # Only try to discover the batch_size every so often.
                 if len(batch) % try_size == 0:
-                    average = _average_size(batch, converter)
+                    average = _average_size(batch, converter, out_of_band)
                     sample_size = average * len(batch)
 
                     if sample_size > STREAM_TARGET_FILE_SIZE:
@@ -60,25 +128,115 @@ def _dump_stream(data, dir_path, converter):
                 if batch_size is None and len(batch) == STREAM_MAX_BATCH:
                     # The batch is plenty large enough - just set it here.
                     batch_size = STREAM_MAX_BATCH
-            else:
-                # The batch_size has been determined.
+            elif position is None:
+                # The batch_size has been determined (and the stream is unmarked, so cut the shards right away).
                 while len(batch) > batch_size:
-                    bytes_out = pickle.dumps(_convert(converter, batch[:batch_size]))
-                    _write_bytes(bytes_out, dir_path, i)
+                    shards += [_write_shard(_convert(converter, batch[:batch_size]), dir_path, i, out_of_band, codec)]
+                    _write_manifest(dir_path, shards, False)
+                    _written(data, batch_size, shards[-1]["bytes"])
                     i += 1
                     batch = batch[batch_size:]
         else:
             # The data stream is complete - flush the remaining data.
             if len(batch) > 0:
-                bytes_out = pickle.dumps(_convert(converter, batch))
-                _write_bytes(bytes_out, dir_path, i)
+                shards += [_write_shard(_convert(converter, batch), dir_path, i, out_of_band, codec, position)]
 
+            _write_manifest(dir_path, shards, True)
+            _written(data, len(batch), 0 if len(batch) == 0 else shards[-1]["bytes"])
             logging.debug("Completed pickling stream for '%s'." % dir_path)
             break
 
 
-def _dump(data, dir_path, converter):
+def _written(data, items, size):
+    if isinstance(data, StreamQueue):
+        data.written(items, size)
+
+
+def _discarded(data, items):
+    if isinstance(data, StreamQueue):
+        data.discarded(items)
+
+
+class StreamQueue(queue.Queue):
+    # A queue for streaming into 'dump', which blocks producers while the (estimated) bytes of the items that have been
+    # put but not yet written out exceed 'max_bytes'.
+    # The 'converter' is set by the 'dump' the queue streams into, so that items are estimated by the size they are written at.
+    SAMPLES = 10
+
+    def __init__(self, max_bytes=STREAM_MAX_BYTES):
+        super(StreamQueue, self).__init__()
+        self.max_bytes = check.check_gte(max_bytes, 2 * STREAM_TARGET_FILE_SIZE)
+        self.in_flight = 0
+        self.written_items = 0
+        self.written_bytes = 0
+        self.blocked_seconds = 0.0
+        self.started = time.time()
+        self.converter = None
+        self._estimates = collections.deque()
+        self._sampled_items = 0
+        self._sampled_bytes = 0
+        self._budget = threading.Condition()
+
+    def estimate(self, item):
+        if self.written_items > 0:
+            return self.written_bytes / self.written_items
+
+        # Nothing has been written yet, so sample the pickled size of the first few (converted) items.
+        # Otherwise, items that are much larger than they're written at could use up the budget before a first shard is cut.
+        if self._sampled_items < StreamQueue.SAMPLES:
+            self._sampled_items += 1
+            self._sampled_bytes += len(pickle.dumps(item if self.converter is None else self.converter(item)))
+
+        return self._sampled_bytes / self._sampled_items
+
+    def put(self, item, block=True, timeout=None):
+        if item is not None and not isinstance(item, Mark):
+            with self._budget:
+                size = self.estimate(item)
+                blocking = time.time()
+
+                # Always admit an item when nothing is in flight, so that no single item can block forever.
+                while self.in_flight > 0 and self.in_flight + size > self.max_bytes:
+                    self._budget.wait()
+
+                self.blocked_seconds += time.time() - blocking
+                self.in_flight += size
+                self._estimates.append(size)
+
+        super(StreamQueue, self).put(item, block, timeout)
+
+    def written(self, items, size):
+        with self._budget:
+            for i in range(items):
+                self.in_flight -= self._estimates.popleft()
+
+            self.written_items += items
+            self.written_bytes += size
+            self._budget.notify_all()
+
+    def discarded(self, items):
+        with self._budget:
+            for i in range(items):
+                self.in_flight -= self._estimates.popleft()
+
+            self._budget.notify_all()
+
+    def depth(self):
+        return self.qsize()
+
+    def bytes_per_second(self):
+        elapsed = time.time() - self.started
+        return 0.0 if elapsed == 0 else self.written_bytes / elapsed
+
+    def __repr__(self):
+        return "StreamQueue{depth=%d, in-flight MB=%.1f, written MB=%.1f, MB/s=%.2f, blocked=%.2fs}" % \
+            (self.depth(), self.in_flight / (1024.0 * 1024.0), self.written_bytes / (1024.0 * 1024.0), self.bytes_per_second() / (1024.0 * 1024.0), self.blocked_seconds)
+
+
+def _dump(data, dir_path, converter, out_of_band, append, codec):
     check.check_list(data)
+    shards = _existing_shards(dir_path, append)
+    start = _next_index(shards)
 
     if len(data) > 0:
         sample_size = max(1, int(0.1 * len(data)))
@@ -88,25 +246,26 @@ def _dump(data, dir_path, converter):
             sample_indices.add(random.randint(0, len(data) - 1))
 
         sample = [data[index] for index in sample_indices]
-        average = _average_size(sample, converter)
+        average = _average_size(sample, converter, out_of_band)
         batch_size = max(1, int(TARGET_FILE_SIZE / average))
 
         for i, offset in enumerate(range(0, len(data), batch_size)):
-            bytes_out = pickle.dumps(_convert(converter, data[offset:offset + batch_size]))
-            _write_bytes(bytes_out, dir_path, i)
-    else:
-        _write_bytes(pickle.dumps([]), dir_path, 0)
+            shards += [_write_shard(_convert(converter, data[offset:offset + batch_size]), dir_path, start + i, out_of_band, codec)]
+    elif len(shards) == 0:
+        shards = [_write_shard([], dir_path, 0, out_of_band, codec)]
 
+    _write_manifest(dir_path, shards, True)
     logging.debug("Completed pickling for '%s'." % dir_path)
 
 
-def _average_size(sample, converter):
+def _average_size(sample, converter, out_of_band=False):
     batch = [i for i in sample]
     average = None
 
     while average is None:
         try:
-            batch_size = len(pickle.dumps(_convert(converter, batch)))
+            bytes_out, buffers = _pickle(_convert(converter, batch), out_of_band)
+            batch_size = len(bytes_out) + sum([buffer.nbytes for buffer, itemsize in buffers])
             average = batch_size / float(len(batch))
         except MemoryError as e:
             batch = batch[:int(len(batch) / 2.0)]
@@ -118,39 +277,355 @@ def _convert(converter, batch):
     return batch if converter is None else [converter(b) for b in batch]
 
 
-def _write_bytes(bytes_out, dir_path, index):
-    write_path = os.path.join(dir_path, str(index) + EXTENSION)
+def _pickle(items, out_of_band):
+    # Returns the pickled bytes, along with the (raw buffer, item size) of each out-of-band buffer.
+    if not out_of_band:
+        return pickle.dumps(items), []
+
+    buffers = []
+    bytes_out = pickle.dumps(items, protocol=5, buffer_callback=buffers.append)
+    return bytes_out, [(buffer.raw(), memoryview(buffer).itemsize) for buffer in buffers]
+
+
+def _write_shard(items, dir_path, index, out_of_band, codec=NONE, position=None):
+    bytes_out, buffers = _pickle(items, out_of_band)
+    stored = 0
+
+    # The buffers are written first - a shard is only ever read once its pickle file exists.
+    if out_of_band:
+        buffer_bytes, buffer_stored = _write_buffers(buffers, dir_path, index, codec)
+        stored += buffer_stored
+
+    stored += _write_bytes(bytes_out, dir_path, index, codec)
+    shard = _shard(index, len(items), bytes_out)
+
+    # Recorded so that the reader never mistakes a stale buffers file (ex: from an interrupted write) as belonging to the shard.
+    shard["out_of_band"] = out_of_band
+
+    if out_of_band:
+        shard["bytes"] += buffer_bytes
+
+    if codec != NONE:
+        shard["codec"] = codec
+        shard["stored"] = stored
+
+    if position is not None:
+        shard["position"] = position
+
+    return shard
+
+
+def _write_buffers(buffers, dir_path, index, codec):
+    # The buffers file starts with a table of the (offset, length, item size) of each buffer, followed by the aligned buffers themselves.
+    # Returns the (uncompressed, stored) sizes of the file.
+    table_size = struct.calcsize("<q") * (1 + (3 * len(buffers)))
+    segments = []
+    offset = table_size
+
+    for buffer, itemsize in buffers:
+        offset += (BUFFER_ALIGNMENT - (offset % BUFFER_ALIGNMENT)) % BUFFER_ALIGNMENT
+        segments += [offset, buffer.nbytes, itemsize]
+        offset += buffer.nbytes
+
+    chunks = [struct.pack("<%dq" % (1 + len(segments)), len(buffers), *segments)]
+    position = table_size
+
+    for i, buffer_itemsize in enumerate(buffers):
+        buffer, itemsize = buffer_itemsize
+        chunks += [b"\0" * (segments[i * 3] - position)]
+        chunks += [buffer if codec == NONE else _shuffle(buffer, itemsize)]
+        position = segments[i * 3] + buffer.nbytes
+
+    return offset, _write_file(chunks, os.path.join(dir_path, str(index) + BUFFERS_EXTENSION), codec)
+
+
+def _shuffle(buffer, itemsize):
+    # Lay out the i-th byte of every item together (and so on for each i).
+    if itemsize <= 1 or buffer.nbytes % itemsize != 0:
+        return buffer
+
+    return b"".join([buffer[i::itemsize].tobytes() for i in range(itemsize)])
+
+
+def _unshuffle(shuffled, itemsize):
+    if itemsize <= 1 or len(shuffled) % itemsize != 0:
+        return shuffled
+
+    count = len(shuffled) // itemsize
+    buffer = bytearray(len(shuffled))
+
+    for i in range(itemsize):
+        buffer[i::itemsize] = shuffled[i * count:(i + 1) * count]
+
+    return buffer
+
+
+def _write_bytes(bytes_out, dir_path, index, codec=NONE):
+    # Chunk the writes at MAX_BYTES.
+    view = memoryview(bytes_out)
+    chunks = [view[offset:offset + MAX_BYTES] for offset in range(0, len(view), MAX_BYTES)]
+    return _write_file(chunks, os.path.join(dir_path, str(index) + EXTENSION), codec)
+
+
+def _write_file(chunks, write_path, codec):
+    # Write to a temporary file and then rename it into place, so that an interrupted write never leaves a partial file.
+    # Any existing shard not committed to the manifest (from an interrupted run) is simply replaced.
+    # Returns the number of bytes stored.
+    compressor = _compressor(codec)
+    stored = 0
+
+    with io.open(write_path + TEMPORARY_EXTENSION, "wb") as fh:
+        for chunk in chunks:
+            out = chunk if compressor is None else compressor.compress(chunk)
+            fh.write(out)
+            stored += len(out)
+
+        if compressor is not None:
+            out = compressor.flush()
+            fh.write(out)
+            stored += len(out)
+
+        _sync(fh)
+
+    os.replace(write_path + TEMPORARY_EXTENSION, write_path)
+    _sync_directory(os.path.dirname(write_path))
+    return stored
+
+
+def _sync(fh):
+    # The data must be on disk before it is renamed into place - otherwise, after a crash (or power loss), the rename may
+    # survive while the data doesn't, leaving an empty (or truncated) file that the manifest commits.
+    fh.flush()
+    os.fsync(fh.fileno())
+
+
+def _sync_directory(dir_path):
+    # Makes the rename itself durable, so that a shard is on disk before the manifest that commits it.
+    if os.name != "posix":
+        return
+
+    descriptor = os.open(dir_path, os.O_RDONLY)
+
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def _compressor(codec):
+    if codec == ZLIB:
+        return zlib.compressobj()
+    elif codec == BZ2:
+        return bz2.BZ2Compressor()
+    elif codec == LZMA:
+        return lzma.LZMACompressor()
+    elif codec == NONE:
+        return None
+    else:
+        raise ValueError("unknown codec: %s" % codec)
+
+
+def _reader(fh, codec):
+    # A file object that decompresses 'fh' as it is read.
+    if codec == ZLIB:
+        return io.BufferedReader(_ZlibReader(fh), READ_SIZE)
+    elif codec == BZ2:
+        return bz2.BZ2File(fh, "rb")
+    elif codec == LZMA:
+        return lzma.LZMAFile(fh, "rb")
+    elif codec == NONE:
+        return fh
+    else:
+        raise ValueError("unknown codec: %s" % codec)
+
+
+class _ZlibReader(io.RawIOBase):
+    def __init__(self, fh):
+        super(_ZlibReader, self).__init__()
+        self.fh = fh
+        self.decompressor = zlib.decompressobj()
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.pending) == 0:
+            if self.decompressor.eof:
+                return 0
+
+            compressed = self.decompressor.unconsumed_tail
+
+            if len(compressed) == 0:
+                compressed = self.fh.read(READ_SIZE)
+
+                if len(compressed) == 0:
+                    raise EOFError("compressed stream ended early: %s" % self.fh.name)
+
+            self.pending = self.decompressor.decompress(compressed, len(buffer))
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def _shard(index, items, bytes_out):
+    return {"index": index, "items": items, "bytes": len(bytes_out)}
+
+
+def _write_manifest(dir_path, shards, complete):
+    write_path = os.path.join(dir_path, MANIFEST)
+
+    with io.open(write_path + TEMPORARY_EXTENSION, "w") as fh:
+        json.dump({"shards": shards, "complete": complete}, fh)
+        _sync(fh)
+
+    os.replace(write_path + TEMPORARY_EXTENSION, write_path)
+    _sync_directory(dir_path)
 
-    # TODO
-    #if os.path.exists(write_path):
-    #    raise ValueError("cannot overwrite existing file: %s" % write_path)
 
-    with open(write_path, "wb") as fh:
-        while len(bytes_out) > 0:
-            fh.write(bytes_out[:MAX_BYTES])
-            bytes_out = bytes_out[MAX_BYTES:]
+def _existing_shards(dir_path, append):
+    if not append:
+        return []
 
+    manifest = _read_manifest(dir_path)
 
-def load(dir_path, allow_not_found=False, converter=None):
+    if manifest is None:
+        if len(_shard_indices(dir_path)) > 0:
+            raise ValueError("cannot append to '%s' without a manifest" % dir_path)
+
+        return []
+
+    return manifest["shards"]
+
+
+def _next_index(shards):
+    return 0 if len(shards) == 0 else shards[-1]["index"] + 1
+
+
+def _committed(shards):
+    positions = [shard["position"] for shard in shards if "position" in shard]
+    return None if len(positions) == 0 else positions[-1]
+
+
+def committed(dir_path):
+    # The input position up to which the (marked) stream dumped to 'dir_path' has been written, or None if there is none.
+    manifest = _read_manifest(dir_path)
+    return None if manifest is None else _committed(manifest["shards"])
+
+
+def has_manifest(dir_path):
+    # Whether the shards' item counts are known without decoding them.
+    return os.path.exists(os.path.join(dir_path, MANIFEST))
+
+
+def complete(dir_path):
+    manifest = _read_manifest(dir_path)
+
+    if manifest is None:
+        # Directories pickled before the manifest was introduced are only recognizable by their shards.
+        return os.path.exists(dir_path) and len(_shard_indices(dir_path)) > 0
+
+    # Manifests from before 'complete' was recorded were only ever written for complete directories.
+    return manifest.get("complete", True)
+
+
+def _check_complete(dir_path, manifest, allow_incomplete):
+    if not allow_incomplete and manifest is not None and not manifest.get("complete", True):
+        raise ValueError("'%s' is incomplete (its writer is still running or was interrupted)" % dir_path)
+
+
+def _read_manifest(dir_path):
     try:
-        sub_files = os.listdir(dir_path)
+        with io.open(os.path.join(dir_path, MANIFEST), "r") as fh:
+            return json.load(fh)
+    except FileNotFoundError as e:
+        # Directories pickled before the manifest was introduced.
+        return None
+
+
+def _shard_indices(dir_path):
+    sub_files = [sub_file for sub_file in os.listdir(dir_path) if sub_file.endswith(EXTENSION)]
+    return sorted([int(sub_file[:sub_file.index(EXTENSION)]) for sub_file in sub_files])
+
+
+def _read_buffers(file_path, codec):
+    with io.open(file_path, "rb") as fh:
+        if codec == NONE:
+            # The mapping stays open for as long as any of the views over it are alive.
+            view = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            view = memoryview(_reader(fh, codec).read())
+
+    count = struct.unpack_from("<q", view)[0]
+    segments = struct.unpack_from("<%dq" % (3 * count), view, struct.calcsize("<q"))
+    buffers = []
+
+    for i in range(count):
+        offset, length, itemsize = segments[i * 3:(i + 1) * 3]
+        buffer = view[offset:offset + length]
+        buffers += [buffer if codec == NONE else _unshuffle(buffer, itemsize)]
+
+    return buffers
+
+
+def _read_shard(dir_path, shard):
+    # Unpickle straight from the (decompressing) file, rather than reading it all into memory first.
+    codec = shard.get("codec", NONE)
+    buffers_path = os.path.join(dir_path, str(shard["index"]) + BUFFERS_EXTENSION)
+    out_of_band = shard.get("out_of_band")
+
+    if out_of_band is None:
+        # Shards recorded before the manifest noted whether they are out-of-band.
+        out_of_band = os.path.exists(buffers_path)
+
+    with io.open(os.path.join(dir_path, str(shard["index"]) + EXTENSION), "rb") as fh:
+        if not out_of_band:
+            return pickle.load(_reader(fh, codec))
+
+        return pickle.load(_reader(fh, codec), buffers=_read_buffers(buffers_path, codec))
+
+
+def load(dir_path, allow_not_found=False, converter=None, start=0, stop=None, prefetch=0, statistics=None, allow_incomplete=False):
+    try:
+        manifest = _read_manifest(dir_path)
+        shard_indices = _shard_indices(dir_path)
     except FileNotFoundError as e:
         if allow_not_found:
             return None
         else:
             raise e
 
-    for sub_file in sorted(sub_files, key=lambda item: int(item[:item.index(EXTENSION)])):
-        file_path = os.path.join(dir_path, sub_file)
-        size = os.path.getsize(file_path)
+    _check_complete(dir_path, manifest, allow_incomplete)
+
+    return _load(dir_path, manifest, shard_indices, converter, start, stop, prefetch, statistics)
+
+
+def _load(dir_path, manifest, shard_indices, converter, start, stop, prefetch=0, statistics=None):
+    if manifest is None:
+        shards = [{"index": index, "items": None} for index in shard_indices]
+    else:
+        shards = manifest["shards"]
 
-        with open(file_path, "rb") as fh:
-            bytes_in = bytearray(0)
+    if prefetch > 0:
+        decoded = _prefetch_shards(dir_path, shards, start, stop, prefetch, statistics)
+    else:
+        decoded = _decode_shards(dir_path, shards, start, stop, statistics)
 
-            for i in range(0, size, MAX_BYTES):
-                bytes_in += fh.read(MAX_BYTES)
+    while True:
+        waiting = time.time()
 
-            for item in pickle.loads(bytes_in):
+        try:
+            position, items = next(decoded)
+        except StopIteration:
+            break
+
+        if statistics is not None:
+            statistics.waited(time.time() - waiting)
+
+        for item in items:
+            if position >= start and (stop is None or position < stop):
                 if converter is None:
                     yield item
                 else:
@@ -159,3 +634,146 @@ def load(dir_path, allow_not_found=False, converter=None):
                     if result is not None:
                         yield result
 
+            position += 1
+
+    if statistics is not None:
+        logging.debug("Loaded '%s': %s." % (dir_path, statistics))
+
+
+def _decode_shards(dir_path, shards, start, stop, statistics):
+    # The position (in items) of the first item of the current shard.
+    position = 0
+
+    for shard in shards:
+        items = shard["items"]
+
+        if stop is not None and position >= stop:
+            break
+
+        # Jump over the shards entirely before the start, without deserializing them.
+        if items is not None and position + items <= start:
+            position += items
+            continue
+
+        decoding = time.time()
+        shard_items = _read_shard(dir_path, shard)
+
+        if statistics is not None:
+            statistics.decoded(len(shard_items), _shard_size(dir_path, shard), time.time() - decoding)
+
+        yield position, shard_items
+        position += len(shard_items)
+
+
+def _shard_size(dir_path, shard):
+    if "stored" in shard:
+        return shard["stored"]
+    elif "bytes" in shard:
+        return shard["bytes"]
+
+    return os.path.getsize(os.path.join(dir_path, str(shard["index"]) + EXTENSION))
+
+
+def _prefetch_shards(dir_path, shards, start, stop, prefetch, statistics):
+    # Decode up to 'prefetch' shards ahead of the consumer in a background thread.
+    return mlbase.prefetched(_decode_shards(dir_path, shards, start, stop, statistics), prefetch)
+
+
+class Statistics:
+    def __init__(self):
+        self.shards = 0
+        self.items = 0
+        self.bytes = 0
+        # Time spent reading and unpickling shards (by whichever thread is doing the loading).
+        self.decode_seconds = 0.0
+        # Time the consumer spent blocked, waiting on the loader for its next shard.
+        self.wait_seconds = 0.0
+        self.started = time.time()
+        # The loader (when prefetching) and the consumer update the counters from different threads.
+        self._lock = threading.Lock()
+
+    def decoded(self, items, size, seconds):
+        with self._lock:
+            self.shards += 1
+            self.items += items
+            self.bytes += size
+            self.decode_seconds += seconds
+
+    def waited(self, seconds):
+        with self._lock:
+            self.wait_seconds += seconds
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def __repr__(self):
+        elapsed = self.elapsed()
+        return "Statistics{shards=%d, items=%d, MB=%.1f, decode=%.2fs, wait=%.2fs (%.1f%% of %.2fs), items/s=%.1f}" % \
+            (self.shards, self.items, self.bytes / (1024.0 * 1024.0), self.decode_seconds, self.wait_seconds,
+                0.0 if elapsed == 0 else 100.0 * self.wait_seconds / elapsed, elapsed, 0.0 if elapsed == 0 else self.items / elapsed)
+
+
+# Notice, within this module the builtin is always referred to as 'io.open'.
+def open(dir_path, converter=None, allow_incomplete=False):
+    return Shards(dir_path, converter, allow_incomplete)
+
+
+class Shards:
+    def __init__(self, dir_path, converter=None, allow_incomplete=False):
+        self.dir_path = dir_path
+        self.converter = converter
+        manifest = _read_manifest(dir_path)
+        _check_complete(dir_path, manifest, allow_incomplete)
+
+        if manifest is None:
+            # Without a manifest, the only way to count the items is by deserializing every shard (once).
+            logging.debug("No manifest for '%s' - counting shard items." % dir_path)
+            self.shards = [{"index": index, "items": len(_read_shard(dir_path, {"index": index})), "bytes": os.path.getsize(os.path.join(dir_path, str(index) + EXTENSION))} \
+                for index in _shard_indices(dir_path)]
+        else:
+            self.shards = manifest["shards"]
+
+        self.offsets = []
+        total = 0
+
+        for shard in self.shards:
+            self.offsets += [total]
+            total += shard["items"]
+
+        self.count = total
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "Shards{%s, count=%d, shards=%d}" % (self.dir_path, self.count, len(self.shards))
+
+    def counts(self):
+        return [shard["items"] for shard in self.shards]
+
+    def shard(self, position):
+        # The (unconverted) items of the shard at 'position' in the manifest, caching the most recently used shard.
+        if self._cached[0] != position:
+            self._cached = (position, _read_shard(self.dir_path, self.shards[position]))
+
+        return self._cached[1]
+
+    def release(self):
+        # Drop the cached shard (ex: once it has been consumed), so it isn't kept in memory.
+        self._cached = (None, None)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+
+        if index < 0 or index >= self.count:
+            raise IndexError("index %d out of range for %d items" % (index, self.count))
+
+        # Empty shards share their offset with the following shard, so take the right most match.
+        position = bisect.bisect_right(self.offsets, index) - 1
+        item = self.shard(position)[index - self.offsets[position]]
+        return item if self.converter is None else self.converter(item)
+
+    def __iter__(self):
+        return _load(self.dir_path, {"shards": self.shards}, None, self.converter, 0, None)
@@ -0,0 +1,145 @@
+
+import contextlib
+import queue
+import tensorflow as tf
+import threading
+import time
+
+from nnwd import rnn
+from pytils import check
+
+
+def session_config(intra_op_threads=0, inter_op_threads=0):
+    # The session configuration of each replica, where 0 threads lets tensorflow choose.
+    config = tf.ConfigProto()
+    config.intra_op_parallelism_threads = check.check_gte(intra_op_threads, 0)
+    config.inter_op_parallelism_threads = check.check_gte(inter_op_threads, 0)
+    return config
+
+
+def replicate(count, construct):
+    # Each replica is constructed in its own graph (and so, with its own session), so that they may be run concurrently.
+    check.check_gte(count, 1)
+    replicas = []
+
+    for i in range(count):
+        with tf.Graph().as_default():
+            replicas += [construct()]
+
+    return replicas
+
+
+class ReplicaPool:
+    # Hands out each of the (independent) replicas to one request thread at a time, blocking when they are all in use.
+    def __init__(self, replicas):
+        self.replicas = check.check_list(replicas)
+        check.check_gte(len(replicas), 1)
+        self.requests = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._free = queue.Queue()
+        self._lock = threading.Lock()
+
+        for replica in replicas:
+            self._free.put(replica)
+
+    def __repr__(self):
+        return "%s{replicas=%d, requests=%d, waits=%d, wait=%.2fs}" % \
+            (self.__class__.__name__, len(self.replicas), self.requests, self.waits, self.wait_seconds)
+
+    @contextlib.contextmanager
+    def replica(self):
+        waiting = time.time()
+
+        try:
+            replica = self._free.get(block=False)
+            waited = False
+        except queue.Empty:
+            replica = self._free.get()
+            waited = True
+
+        with self._lock:
+            self.requests += 1
+
+            if waited:
+                self.waits += 1
+                self.wait_seconds += time.time() - waiting
+
+        try:
+            yield replica
+        finally:
+            self._free.put(replica)
+
+
+class LstmPool(ReplicaPool):
+    # Mirrors the inference interface of rnn.Lstm, so it may be used in its place (ex: by rnn.Stepwise).
+    def __init__(self, replicas):
+        super(LstmPool, self).__init__(replicas)
+        self.hyper_parameters = replicas[0].hyper_parameters
+        self.ablations = replicas[0].ablations
+        self.word_labels = replicas[0].word_labels
+        self.output_labels = replicas[0].output_labels
+
+    def evaluate_sequence(self, xs, handle_unknown=False, instrument_names=[]):
+        with self.replica() as lstm:
+            return lstm.evaluate_sequence(xs, handle_unknown, instrument_names)
+
+    def evaluate(self, x, handle_unknown=False, state=None, instrument_names=[]):
+        with self.replica() as lstm:
+            return lstm.evaluate(x, handle_unknown, state, instrument_names)
+
+    def evaluate_batch(self, xs, handle_unknown=False, states=None, instrument_names=[]):
+        with self.replica() as lstm:
+            return lstm.evaluate_batch(xs, handle_unknown, states, instrument_names)
+
+    def evaluate_batch_instrumented(self, sequences, handle_unknown=False, instrument_names=[]):
+        with self.replica() as lstm:
+            return lstm.evaluate_batch_instrumented(sequences, handle_unknown, instrument_names)
+
+    def result(self, state):
+        with self.replica() as lstm:
+            return lstm.result(state)
+
+    def stepwise(self, name=None, handle_unknown=False):
+        return rnn.Stepwise(self, name, handle_unknown)
+
+    def embed(self, x):
+        with self.replica() as lstm:
+            return lstm.embed(x)
+
+    def probe(self, name, layer):
+        with self.replica() as lstm:
+            return lstm.probe(name, layer)
+
+    def keys(self):
+        return self.replicas[0].keys()
+
+    def part_layers(self):
+        return self.replicas[0].part_layers()
+
+    def is_embedding(self, key_or_part, layer=None):
+        return self.replicas[0].is_embedding(key_or_part, layer)
+
+    def part_width(self, key):
+        return self.replicas[0].part_width(key)
+
+    def encode_key(self, part, layer=None):
+        return self.replicas[0].encode_key(part, layer)
+
+    def decode_key(self, key):
+        return self.replicas[0].decode_key(key)
+
+
+class ModelPool(ReplicaPool):
+    # Mirrors the inference interface of ml.model.Model (ex: the semantic model).
+    def __init__(self, replicas):
+        super(ModelPool, self).__init__(replicas)
+        self.scope = replicas[0].scope
+
+    def evaluate(self, batch, handle_unknown=False):
+        with self.replica() as model:
+            return model.evaluate(batch, handle_unknown)
+
+    def predict_top_k(self, inputs, cases, k):
+        with self.replica() as model:
+            return model.predict_top_k(inputs, cases, k)
@@ -0,0 +1,186 @@
+
+import collections
+import hashlib
+import numpy as np
+import threading
+
+from pytils import check
+
+
+MAX_BYTES = 256 * 1024 * 1024
+
+
+class PrefixTrie:
+    # The rnn.Stepwise (lstm state) of each queried sequence prefix, where sequences with a common prefix share its nodes.
+    # The states are bounded to 'max_bytes', by evicting the least recently used leaves.
+    # Safe to use from multiple (server) threads - notice, the lstm is run outside of the lock.
+    def __init__(self, root, max_bytes=MAX_BYTES):
+        self.max_bytes = check.check_gte(max_bytes, 0)
+        self.bytes = 0
+        self.nodes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._root = _Node(None, None, root)
+        # The leaves, in least to most recently used order.
+        self._leaves = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "PrefixTrie{nodes=%d, bytes=%d/%d, hits=%d, misses=%d, evictions=%d}" % \
+            (self.nodes, self.bytes, self.max_bytes, self.hits, self.misses, self.evictions)
+
+    def stepwise(self, sequence):
+        with self._lock:
+            path = self._path(sequence)
+
+            if len(path) == len(sequence) + 1:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        # Run the rest of the sequence from the longest cached prefix.
+        stepwises = [node.stepwise for node in path]
+
+        for word in sequence[len(path) - 1:]:
+            stepwises += [stepwises[-1].next_stepwise(word)]
+
+        if len(path) < len(stepwises):
+            with self._lock:
+                self._insert(sequence, stepwises)
+                self._evict()
+
+        return stepwises[-1]
+
+    def _path(self, sequence):
+        # The nodes of the longest cached prefix of the sequence (starting with the root).
+        path = [self._root]
+
+        for word in sequence:
+            child = path[-1].children.get(word)
+
+            if child is None:
+                break
+
+            path += [child]
+
+        if len(path) > 1 and len(path[-1].children) == 0:
+            self._leaves.move_to_end(id(path[-1]))
+
+        return path
+
+    def _insert(self, sequence, stepwises):
+        # Notice, another thread may have inserted (or evicted) some of these prefixes in the meantime.
+        node = self._root
+
+        for i, word in enumerate(sequence):
+            child = node.children.get(word)
+
+            if child is None:
+                # The node is no longer a leaf (if it was one).
+                self._leaves.pop(id(node), None)
+
+                child = _Node(node, word, stepwises[i + 1])
+                node.children[word] = child
+                self.bytes += child.bytes
+                self.nodes += 1
+
+            node = child
+
+        if len(node.children) == 0:
+            self._leaves[id(node)] = node
+            self._leaves.move_to_end(id(node))
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self._leaves) > 0:
+            identifier, leaf = self._leaves.popitem(last=False)
+            parent = leaf.parent
+            del parent.children[leaf.word]
+            self.bytes -= leaf.bytes
+            self.nodes -= 1
+            self.evictions += 1
+
+            if len(parent.children) == 0 and parent is not self._root:
+                # The parent was used no more recently than its child.
+                self._leaves[id(parent)] = parent
+                self._leaves.move_to_end(id(parent), last=False)
+
+
+def prefix_hash(sequence, person=b""):
+    # A stable (across processes) 64 bit hash of the sequence of words, as an int64.
+    digest = hashlib.blake2b("\x1f".join(sequence).encode("utf-8"), digest_size=8, person=person).digest()
+    return int(np.frombuffer(digest, dtype="<i8")[0])
+
+
+def prefix_key(sequence):
+    # The (hash, check, length) a prefix is stored under - the check is a second (independent) hash, which together with
+    # the length tells apart prefixes whose hashes collide.
+    return prefix_hash(sequence), prefix_hash(sequence, b"check"), len(sequence)
+
+
+class PrefixStore:
+    # The precomputed lstm states of sequence prefixes (see generate-prefix-states.py), read from memory mapped columns.
+    def __init__(self, columns):
+        self.columns = columns
+        # The parts of the state, in order (see rnn.SCAN_PARTS).
+        self.parts = columns.metadata["parts"]
+        self.layers = columns.metadata["layers"]
+        self.width = columns.metadata["width"]
+        self.embedding_width = columns.metadata["embedding_width"]
+        self._state_width = len(self.parts) * self.layers * self.width
+        assert columns.width == self._state_width + self.embedding_width, "%d != %d" % (columns.width, self._state_width + self.embedding_width)
+
+        if columns.sorted != "hash":
+            raise ValueError("the prefix states in '%s' must be sorted by their hash (see states.set_prefix_states)" % columns.dir_path)
+
+        # The rows are looked up by binary search over the (memory mapped) hashes, so nothing is loaded per process.
+        self._hashes = columns.array("hash")
+        self._checks = columns.array("check")
+        self._lengths = columns.array("length")
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __repr__(self):
+        return "PrefixStore{%s, prefixes=%d}" % (self.columns.dir_path, len(self.columns))
+
+    def _row(self, sequence):
+        hash, check_hash, length = prefix_key(sequence)
+
+        # Prefixes with colliding hashes are adjacent, and are told apart by their checks and lengths.
+        for row in range(int(np.searchsorted(self._hashes, hash, "left")), int(np.searchsorted(self._hashes, hash, "right"))):
+            if self._checks[row] == check_hash and self._lengths[row] == length:
+                return row
+
+        return None
+
+    def get(self, sequence, instrument_names):
+        # The (state, instruments) after the sequence, as per rnn.Stepwise.query, or None if the prefix isn't stored.
+        row = self._row(sequence)
+
+        if row is None:
+            return None
+
+        point = self.columns.points[row]
+        state = np.array(point[:self._state_width]).reshape([len(self.parts), self.layers, 1, self.width])
+        instrument_values = {}
+
+        for name in instrument_names:
+            if name == "embedding":
+                instrument_values[name] = np.array(point[self._state_width:]).reshape([1, self.embedding_width])
+            elif name in self.parts:
+                instrument_values[name] = state[self.parts.index(name)].reshape([-1, self.width])
+            else:
+                # Notice, the soft filters aren't stored (they depend on every timestep of the prefix).
+                return None
+
+        return state, instrument_values
+
+
+class _Node:
+    def __init__(self, parent, word, stepwise):
+        self.parent = parent
+        self.word = word
+        self.stepwise = stepwise
+        self.bytes = 0 if stepwise.state is None else stepwise.state.nbytes
+        self.children = {}
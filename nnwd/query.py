@@ -37,7 +37,7 @@ def sqlite_db(query_dir, key):
     return db
 
 
-def database_for(query_dir, db_kind, lstm, key):
+def database_for(query_dir, db_kind, lstm, key, vocabulary=None):
     if db_kind == POSTGRES:
         db = postgres_db()
         table_suffix = "_%s" % key.replace("-", "_")
@@ -81,23 +81,23 @@ def database_for(query_dir, db_kind, lstm, key):
             raise e
 
     db.commit()
-    return QueryDatabase(db, db_kind, table_suffix, dimensions)
+    return QueryDatabase(db, db_kind, table_suffix, dimensions, vocabulary)
 
 
-def get_databases(query_dir, db_kind, lstm):
+def get_databases(query_dir, db_kind, lstm, vocabulary=None):
     databases = {}
 
     if db_kind == POSTGRES:
         for key in lstm.keys():
             db = postgres.connect("dbname=postgres user=sawatzky")
-            databases[key] = QueryDatabase(db, db_kind, "_%s" % key.replace("-", "_"), lstm.part_width(key))
+            databases[key] = QueryDatabase(db, db_kind, "_%s" % key.replace("-", "_"), lstm.part_width(key), vocabulary)
     else:
         for name in os.listdir(query_dir):
             if name.startswith(QUERY_DB):
                 db_path = os.path.join(query_dir, name)
                 db = sqlite.connect(db_path, detect_types=sqlite.PARSE_DECLTYPES)
                 key = name[len(QUERY_DB):]
-                databases[key] = QueryDatabase(db, db_kind, "", lstm.part_width(key))
+                databases[key] = QueryDatabase(db, db_kind, "", lstm.part_width(key), vocabulary)
 
     return databases
 
@@ -105,11 +105,14 @@ def get_databases(query_dir, db_kind, lstm):
 class QueryDatabase:
     BATCH_SIZE = 500
 
-    def __init__(self, db, db_kind, table_suffix, dimensions):
+    def __init__(self, db, db_kind, table_suffix, dimensions, vocabulary=None):
         self.db = db
         self.db_kind = db_kind
         self.table_suffix = table_suffix
         self.dimensions = dimensions
+        # Sequences may be stored as tuples of word ids (see Vocabulary), which are decoded on the way out.
+        self.vocabulary = vocabulary
+        self._encoded = None
         suffix = "" if self.db_kind == SQLITE else " on conflict do nothing"
         self._insert_activations = "insert into activations%s values (?, ?, %s)%s" % (self.table_suffix, ",".join(["?"] * self.dimensions), suffix)
         self._select_point = ", ".join(["activations.axis_%d" % d for d in range(dimensions)])
@@ -122,9 +125,28 @@ class QueryDatabase:
 
     def _converter(self):
         if self.db_kind == SQLITE:
-            return lambda item: item
+            return lambda item: tuple((self._decode(item[0]), *item[1:]))
         else:
-            return lambda item: tuple((pickle.loads(item[0]), *item[1:]))
+            return lambda item: tuple((self._decode(pickle.loads(item[0])), *item[1:]))
+
+    def _decode(self, sequence):
+        if len(sequence) > 0 and isinstance(sequence[0], int):
+            assert self.vocabulary is not None, "the sequences are encoded, but no vocabulary was provided"
+            return self.vocabulary.decode(sequence)
+
+        return sequence
+
+    def encoded(self):
+        if self._encoded is None:
+            cursor = self.db.cursor()
+            cursor.execute("select sequence from sequences limit 1")
+            row = cursor.fetchone()
+
+            if row is not None:
+                sequence = row[0] if self.db_kind == SQLITE else pickle.loads(row[0])
+                self._encoded = len(sequence) > 0 and isinstance(sequence[0], int)
+
+        return self._encoded is True
 
     def insert_sequence(self, sequence):
         self.commit()
@@ -152,6 +174,11 @@ class QueryDatabase:
     def commit(self):
         self.db.commit()
 
+    def count_activations(self):
+        cursor = self.db.cursor()
+        cursor.execute("select count(*) from activations%s" % self.table_suffix)
+        return cursor.fetchone()[0]
+
     @functools.lru_cache()
     def select_activations_range(self, axis, lower_bound, upper_bound, operator):
         activations_suffix = "" if self.db_kind == SQLITE else self.table_suffix + " as activations"
@@ -179,6 +206,11 @@ class QueryDatabase:
         activations_suffix = "" if self.db_kind == SQLITE else self.table_suffix + " as activations"
         cursor = self.db.cursor()
         matched_sequences = [sequence for sequence in sequences]
+
+        if self.encoded():
+            # Sequences with words outside of the vocabulary can't be in the database.
+            matched_sequences = [encoded for encoded in [self.vocabulary.lookup(sequence) for sequence in matched_sequences] if encoded is not None]
+
         points = []
         offset = 0
 
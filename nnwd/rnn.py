@@ -52,6 +52,20 @@ LSTM_PARTS = [
     "cell_hats",
     "outputs",
 ]
+# The parts, in the order they are stacked into the scan states.
+SCAN_PARTS = [
+    "outputs",
+    "cells",
+    "remember_gates",
+    "forget_gates",
+    "output_gates",
+    "input_hats",
+    "remembers",
+    "cell_previouses",
+    "forgets",
+    "cell_hats",
+]
+UNROLLED_SUFFIX = "_unrolled"
 LSTM_SINGULARS = {
     "remember_gates": "remember_gate",
     "forget_gates": "forget_gate",
@@ -71,12 +85,16 @@ class Lstm:
     # we track all the other intermediate gates/states for the weight instrumentation.
     SCAN_STATES = 10
 
-    def __init__(self, hyper_parameters, ablations, word_labels, output_labels, scope="rnn", skeleton=False):
+    def __init__(self, hyper_parameters, ablations, word_labels, output_labels, scope="rnn", skeleton=False, inference=False, session_config=None):
         self.hyper_parameters = hyper_parameters
         self.ablations = ablations
         self.word_labels = word_labels
         self.output_labels = output_labels
         self.scope = scope
+        # Inference only models build just the forward pass (no cost, gradients or updates), so they cannot be trained/tested.
+        self.inference = inference
+        # The tf.ConfigProto for the model's session (ex: to set its thread counts), or None for the defaults.
+        self.session_config = session_config
 
         if not skeleton:
             self.computational_graph()
@@ -202,20 +220,18 @@ class Lstm:
 
         # We can produce the 'w' term irrespective of the ablations (or lack thereof).
         # However notice, this will only have the intended sum of soft filters interpretation under the srnn + out conditions.
+        # The w of timestep t is: remember_gate[t] * product(forget_gate[t + 1:]).
+        # The products of the later forget gates are a single (reverse, exclusive) cumulative product.
+        # Notice, this is only run when the "ws" instrument is requested.
         REMEMBER_POSITION = 2
         FORGET_POSITION = 3
-        def step_w(index):
-            left = self.unrolled_states[index][REMEMBER_POSITION]
-            assert_shape(left, [self.hyper_parameters.layers, self.batch_dimension, self.hyper_parameters.width])
-
-            right = tf.reduce_prod(self.unrolled_states[index + 1:, FORGET_POSITION, :], 0)
-            assert_shape(right, [self.hyper_parameters.layers, self.batch_dimension, self.hyper_parameters.width])
 
-            result = left * right
-            assert_shape(result, [self.hyper_parameters.layers, self.batch_dimension, self.hyper_parameters.width])
-            return result
+        with tf.name_scope("soft_filters"):
+            remember_gates = self.unrolled_states[:, REMEMBER_POSITION]
+            later_forget_gates = tf.cumprod(self.unrolled_states[:, FORGET_POSITION], axis=0, exclusive=True, reverse=True)
+            assert_shape(later_forget_gates, [self.time_dimension, self.hyper_parameters.layers, self.batch_dimension, self.hyper_parameters.width])
+            self.ws = remember_gates * later_forget_gates
 
-        self.ws = tf.map_fn(step_w, tf.range(0, self.max_time), dtype=tf.float32)
         assert_shape(self.ws, [self.time_dimension, self.hyper_parameters.layers, self.batch_dimension, self.hyper_parameters.width])
         tf.identity(tf.reshape(self.ws, [self.max_time, self.hyper_parameters.layers, self.hyper_parameters.width]), name="ws")
 
@@ -240,6 +256,13 @@ class Lstm:
         tf.identity(tf.reshape(forgets, [-1, self.hyper_parameters.width]), name="forgets")
         tf.identity(tf.reshape(cell_hats, [-1, self.hyper_parameters.width]), name="cell_hats")
 
+        # The instruments across all timesteps, for eliciting whole (batches of) sequences in a single run.
+        # Each is [time, layers, batch, width] - the embedding has exactly 1 'layer'.
+        tf.identity(tf.expand_dims(self.unrolled_embedded_inputs, 1), name="embedding%s" % UNROLLED_SUFFIX)
+
+        for position, part in enumerate(SCAN_PARTS):
+            tf.identity(self.unrolled_states[:, position], name="%s%s" % (part, UNROLLED_SUFFIX))
+
         # Grab the last state layer across all timesteps from the unrolled state layers ([z z z] in diagram).
         # Notice, each cell in the diagram represents 2 (+all the extra instrumentation) states (hidden, cell, ..instrumentation..).
         #
@@ -262,13 +285,21 @@ class Lstm:
         self.output_distributions = tf.nn.softmax(self.unrolled_outputs)
         assert_shape(self.output_distributions, [self.time_dimension, self.batch_dimension, len(self.output_labels)])
 
-        self.cost = self.computational_graph_cost()
-        #self.updates = tf.train.AdamOptimizer().minimize(self.cost)
+        if not self.inference:
+            self.cost = self.computational_graph_cost()
+            #self.updates = tf.train.AdamOptimizer().minimize(self.cost)
 
-        optimizer = tf.train.GradientDescentOptimizer(self.learning_rate_p[0])
-        gradients = optimizer.compute_gradients(self.cost)
-        gradients_clipped = [(tf.clip_by_norm(g, self.clip_norm_p[0]), var) for g, var in gradients if g is not None]
-        self.updates = optimizer.apply_gradients(gradients_clipped)
+            optimizer = tf.train.GradientDescentOptimizer(self.learning_rate_p[0])
+            gradients = [(g, var) for g, var in optimizer.compute_gradients(self.cost) if g is not None]
+            # The gradients are made dense before clipping, so the (sparse) embedding gradient is clipped after its duplicate rows are summed.
+            # This way a batch is clipped the same as the externally combined gradients of data parallel training (see nnwd.parallel).
+            self.gradient_variables = [var for g, var in gradients]
+            self.gradients = [tf.convert_to_tensor(g) for g, var in gradients]
+            self.updates = optimizer.apply_gradients([(tf.clip_by_norm(g, self.clip_norm_p[0]), var) for g, var in zip(self.gradients, self.gradient_variables)])
+
+            # For data parallel training: the (clipped) update from externally combined (unclipped) gradients.
+            self.gradients_p = [self.placeholder("gradients_%d_p" % i, var.shape) for i, var in enumerate(self.gradient_variables)]
+            self.gradient_updates = optimizer.apply_gradients([(tf.clip_by_norm(g, self.clip_norm_p[0]), var) for g, var in zip(self.gradients_p, self.gradient_variables)])
 
         #trainable_variables = tf.trainable_variables()
         #gradients = tf.gradients(self.cost, trainable_variables)
@@ -276,7 +307,7 @@ class Lstm:
         #optimizer = tf.train.GradientDescentOptimizer(self.learning_rate_p[0])
         #self.updates = optimizer.apply_gradients(zip(gradients_clipped, trainable_variables))
 
-        config = tf.ConfigProto()
+        config = tf.ConfigProto() if self.session_config is None else self.session_config
         config.gpu_options.allow_growth = True
         self.session = tf.Session(config=config)
         self.session.run(tf.global_variables_initializer())
@@ -307,10 +338,13 @@ class Lstm:
     def train(self, xy_sequences, training_parameters):
         check.check_instance(training_parameters, mlbase.TrainingParameters)
 
+        if self.inference:
+            raise ValueError("cannot train an inference only model")
+
         if id(xy_sequences) != self._training_id:
             self._training_id = id(xy_sequences)
-            # Sort the training sequences by their length to minimize padding (each batch will consist of roughly equal lengthed sequences).
-            self.training_xys = sorted(xy_sequences, key=lambda xy: len(xy.x))
+            # The training sequences are sorted by their length to minimize padding (each batch will consist of roughly equal lengthed sequences).
+            self.training_encoded = self.encode(xy_sequences)
 
         slot_length = len(str(training_parameters.epochs())) - 1
         case_slot_length = len(str(len(xy_sequences)))
@@ -319,41 +353,34 @@ class Lstm:
         losses = training_parameters.losses()
         finished = False
         epoch = -1
+        statistics = mlbase.FeedStatistics()
 
         while not finished:
             epoch += 1
             epoch_loss = 0
             # Start at a different offset for every epoch to help avoid overfitting.
-            offset = random.randint(0, min(training_parameters.batch(), len(self.training_xys)) - 1)
+            offset = random.randint(0, min(training_parameters.batch(), len(self.training_encoded)) - 1)
             count = 0
-            first = True
-
-            while offset < len(self.training_xys):
-                if first:
-                    first = False
-                    batch = self.training_xys[0:offset]
-                else:
-                    batch = self.training_xys[offset:offset + training_parameters.batch()]
-                    offset += training_parameters.batch()
-
-                # To account for when offset is randomly assigned 0
-                if len(batch) > 0:
-                    count += len(batch)
-                    feed = self.get_training_feed(batch, training_parameters)
-                    _, loss = self.session.run([self.updates, self.cost], feed_dict=feed)
-                    #_, loss, logits, targets = self.session.run([self.updates, self.cost, self.logits, self.targets], feed_dict=feed)
-                    #_, loss, mask, uop1, lrs, mmm, mmn, mnn = self.session.run([self.updates, self.cost, self.mask, self.unrolled_outputs_p, self.losses_reduced, self.masked, self.masked2, self.masked3], feed_dict=feed)
-                    #_, loss, mask, uop1, tgs, lrs, mmm = self.session.run([self.updates, self.cost, self.mask, self.unrolled_outputs_p, self.targets, self.losses_reduced, self.masked], feed_dict=feed)
-                    #if epoch == 0:
-                        #print(mask)
-                        #print(uop1)
-                        #print(tgs)
-                        #print(lrs)
-                        #print(mmm)
-                        #print(mmn)
-                        #print(mnn)
-                        #print(dd)
-                    epoch_loss += loss
+            # The feeds are prepared ahead of the session runs.
+            feeds = mlbase.prefetch_feeds(self.training_batches(offset, training_parameters.batch()),
+                lambda batch: self.get_training_feed(batch, training_parameters), training_parameters.prefetch(), statistics)
+
+            for batch, feed in feeds:
+                count += len(batch)
+                _, loss = self.session.run([self.updates, self.cost], feed_dict=feed)
+                #_, loss, logits, targets = self.session.run([self.updates, self.cost, self.logits, self.targets], feed_dict=feed)
+                #_, loss, mask, uop1, lrs, mmm, mmn, mnn = self.session.run([self.updates, self.cost, self.mask, self.unrolled_outputs_p, self.losses_reduced, self.masked, self.masked2, self.masked3], feed_dict=feed)
+                #_, loss, mask, uop1, tgs, lrs, mmm = self.session.run([self.updates, self.cost, self.mask, self.unrolled_outputs_p, self.targets, self.losses_reduced, self.masked], feed_dict=feed)
+                #if epoch == 0:
+                    #print(mask)
+                    #print(uop1)
+                    #print(tgs)
+                    #print(lrs)
+                    #print(mmm)
+                    #print(mmn)
+                    #print(mnn)
+                    #print(dd)
+                epoch_loss += loss
 
             assert count == len(xy_sequences), "%d != %d" % (count, len(xy_sequences))
             epoch_loss /= count
@@ -366,12 +393,12 @@ class Lstm:
                     score = 0.0
                     offset = 0
 
-                    while offset < len(xy_sequences):
-                        batch = xy_sequences[offset:offset + 32]
+                    while offset < len(self.training_encoded):
+                        batch = self.training_encoded.batch(offset, offset + 32)
                         offset += 32
                         feed = self.get_testing_feed(batch)
                         time_distributions = self.session.run(self.output_distributions, feed_dict=feed)
-                        score += self.score(batch, feed, time_distributions, False, case_slot_length)
+                        score += self.score(batch, time_distributions, False, case_slot_length)
 
                     logging.debug(epoch_template.format(epoch, epoch_loss, epoch_perplexity, score / len(xy_sequences)))
                 else:
@@ -381,38 +408,78 @@ class Lstm:
             score = 0.0
             offset = 0
 
-            while offset < len(xy_sequences):
-                batch = xy_sequences[offset:offset + 32]
+            while offset < len(self.training_encoded):
+                batch = self.training_encoded.batch(offset, offset + 32)
                 offset += 32
                 feed = self.get_testing_feed(batch)
                 time_distributions = self.session.run(self.output_distributions, feed_dict=feed)
-                score += self.score(batch, feed, time_distributions, False, case_slot_length)
+                score += self.score(batch, time_distributions, False, case_slot_length)
 
             logging.debug(epoch_template.format(epoch, epoch_loss, epoch_perplexity, score / len(xy_sequences)))
         else:
             logging.debug(epoch_template.format(epoch, epoch_loss, epoch_perplexity))
 
         #logging.debug("Training finished due to %s (%s)." % (reason, losses))
+        logging.debug("Training feeds: %s." % statistics)
         return epoch_loss, -epoch_perplexity
 
+    def compute_gradients(self, batch, training_parameters):
+        # The loss and (unclipped) gradients of the batch, without applying them.
+        feed = self.get_training_feed(batch, training_parameters)
+        loss, *gradients = self.session.run([self.cost] + self.gradients, feed_dict=feed)
+        return loss, gradients
+
+    def apply_gradients(self, gradients, training_parameters):
+        # The gradients are clipped as for the 'updates' of a single batch.
+        feed = {
+            self.learning_rate_p: [training_parameters.learning_rate()],
+            self.clip_norm_p: [training_parameters.clip_norm()],
+        }
+
+        for gradient_p, gradient in zip(self.gradients_p, gradients):
+            feed[gradient_p] = gradient
+
+        self.session.run(self.gradient_updates, feed_dict=feed)
+
+    def get_variables(self):
+        return self.session.run(self.gradient_variables)
+
+    def set_variables(self, values):
+        for variable, value in zip(self.gradient_variables, values):
+            variable.load(value, self.session)
+
+    def training_batches(self, offset, batch_size):
+        # The first batch is [0, offset) (none when offset is randomly assigned 0), followed by every 'batch_size' from there.
+        if offset > 0:
+            yield self.training_encoded.batch(0, offset)
+
+        while offset < len(self.training_encoded):
+            yield self.training_encoded.batch(offset, offset + batch_size)
+            offset += batch_size
+
     def test(self, xy_sequences, debug=False, score=False):
         assert len(xy_sequences) > 0
+
+        if self.inference:
+            raise ValueError("cannot test an inference only model")
+
         training_parameters = mlbase.TrainingParameters() \
             .dropout_rate(0)
         total_loss = 0.0
         total_score = 0.0
         case_slot_length = len(str(len(xy_sequences)))
+        encoded = self.encode(xy_sequences)
         offset = 0
 
-        while offset < len(xy_sequences):
-            batch = xy_sequences[offset:offset + 32]
+        while offset < len(encoded):
+            batch = encoded.batch(offset, offset + 32)
             offset += 32
             feed = self.get_training_feed(batch, training_parameters)
             time_distributions, loss = self.session.run([self.output_distributions, self.cost], feed_dict=feed)
             total_loss += loss
 
             if score:
-                total_score += self.score(batch, feed, time_distributions, debug, case_slot_length)
+                total_score += self.score(batch, time_distributions, debug, case_slot_length)
 
         if score:
             logging.debug("total score for %d instances: %f" % (len(xy_sequences), total_score / len(xy_sequences)))
@@ -420,13 +487,13 @@ class Lstm:
         return -math.exp(total_loss / len(xy_sequences))
 
     def evaluate_sequence(self, xs, handle_unknown=False, instrument_names=[]):
-        feed = self.get_testing_feed([mlbase.Xy([(x, None) for x in xs], [])])
+        feed = self.get_inference_feed([xs], True)
         instruments = self.get_instruments(instrument_names)
         distributions, *instrument_values = self.session.run([self.output_distributions] + instruments, feed_dict=feed)
         assert len(distributions) == len(xs), "%d != %d" % (len(distributions), len(xs))
         assert len(distributions[-1]) == 1, "%d != 1" % (len(distributions[-1]))
         distribution = distributions[-1][0]
-        result = Result(self.output_labels.vector_decode(distribution), self.output_labels.vector_decode_distribution(distribution), self.output_labels.encoding())
+        result = TopKResult(self.output_labels, distribution)
         return result, {name: instrument_values[i] for i, name in enumerate(instrument_names)}
 
     def evaluate(self, x, handle_unknown=False, state=None, instrument_names=[]):
@@ -440,9 +507,83 @@ class Lstm:
         assert len(distributions) == 1
         assert len(distributions[-1]) == 1
         distribution = distributions[-1][0]
-        result = Result(self.output_labels.vector_decode(distribution), self.output_labels.vector_decode_distribution(distribution), self.output_labels.encoding())
+        result = TopKResult(self.output_labels, distribution)
         return result, next_state, {name: instrument_values[i] for i, name in enumerate(instrument_names)}
 
+    def evaluate_batch(self, xs, handle_unknown=False, states=None, instrument_names=[]):
+        # Evaluate a single step of each of a batch of (independent) sequences, in a single run.
+        # Returns the (result, next_state, instruments) of each, as per evaluate.
+        states = [None] * len(xs) if states is None else states
+        feed = {
+            self.unrolled_inputs_p: [[self.word_labels.encode(x, handle_unknown) for x in xs]],
+            self.initial_state_p: np.concatenate([self.initial_state(1) if state is None else state for state in states], axis=2),
+            self.dropout_keep_p: np.array([1.0]),
+        }
+        instruments = self.get_instruments(unrolled_instrument_names(instrument_names))
+        distributions, next_state, *instrument_values = self.session.run([self.output_distributions, self.state] + instruments, feed_dict=feed)
+        assert len(distributions) == 1
+        return [(TopKResult(self.output_labels, distributions[-1][b]), next_state[:, :, b:b + 1].copy(), case_instruments(instrument_names, instrument_values, b)) \
+            for b in range(len(xs))]
+
+    def evaluate_batch_instrumented(self, sequences, handle_unknown=False, instrument_names=[]):
+        # Elicit the instruments of every timestep for a batch of sequences (each a list of words), in a single run.
+        # Returns, per sequence, the instruments of each of its timesteps, indexed as per Stepwise.step: instruments[part][layer].
+        feed = self.get_inference_feed(sequences, handle_unknown)
+        instruments = self.get_instruments(["%s%s" % (name, UNROLLED_SUFFIX) for name in instrument_names])
+        instrument_values = self.session.run(instruments, feed_dict=feed) if len(instruments) > 0 else []
+        # Notice, the per-timestep instruments are views into the unrolled instrument arrays.
+        return [[{name: instrument_values[i][t, :, b] for i, name in enumerate(instrument_names)} for t in range(len(xs))] for b, xs in enumerate(sequences)]
+
+    def result(self, state):
+        # The result of a (batch of one) state, without running the lstm - the final layer's output is fed directly.
+        feed = {
+            # Only the shape of the inputs is used.
+            self.unrolled_inputs_p: [[self.word_labels.encode(mlbase.BLANK, True)]],
+            self.final_state: state[0, -1:],
+            self.dropout_keep_p: np.array([1.0]),
+        }
+        distributions = self.session.run(self.output_distributions, feed_dict=feed)
+        distribution = distributions[-1][0]
+        return TopKResult(self.output_labels, distribution)
+
+    def encode(self, xy_sequences):
+        # Encode the xy sequences into the ids of their words, once, so that each (training or testing) feed is just a numpy slice.
+        # Already encoded sequences are returned as is.
+        if isinstance(xy_sequences, EncodedSequences):
+            return xy_sequences
+
+        buckets = {}
+
+        for xy in xy_sequences:
+            buckets.setdefault(len(xy.x), []).append(xy)
+
+        xys = []
+        inputs = []
+        outputs = []
+
+        for length in sorted(buckets.keys()):
+            bucket = buckets[length]
+            xys += bucket
+            inputs += [np.array([[self.word_labels.encode(word_pos[0], True) for word_pos in xy.x] for xy in bucket], dtype="int32").reshape([len(bucket), length])]
+            outputs += [self.encode_outputs(bucket, length)]
+
+        # Whether the outputs are sequences (ex: LM), rather than one per sequence (ex: SA).
+        sequence_outputs = self.encode_outputs([], 0).ndim == 2
+        return EncodedSequences(xys, inputs, outputs, self.word_labels.encode(mlbase.BLANK, True), sequence_outputs)
+
+    def get_inference_feed(self, sequences, handle_unknown=False):
+        # The feed for just the forward pass of a batch of sequences (each a list of words), padded with blanks.
+        check.check_gte(len(sequences), 1)
+        max_time = max([len(xs) for xs in sequences])
+        check.check_gte(max_time, 1)
+        blank = self.word_labels.encode(mlbase.BLANK, True)
+        input_labels = [[self.word_labels.encode(xs[t], handle_unknown) if t < len(xs) else blank for xs in sequences] for t in range(max_time)]
+        return {
+            self.unrolled_inputs_p: input_labels,
+            self.initial_state_p: self.initial_state(len(sequences)),
+            self.dropout_keep_p: np.array([1.0]),
+        }
+
     def get_instruments(self, instrument_names):
         key = hash(tuple(instrument_names))
 
@@ -473,6 +614,19 @@ class Lstm:
         }
         return self.session.run([self.session.graph.get_tensor_by_name("embedding:0")], feed_dict=feed)[0].tolist()
 
+    def export_parameters(self):
+        # The values of the model's parameters, for running the forward pass outside of tensorflow (see nnwd.inference).
+        names = ["E", "R", "R_bias", "F", "F_bias", "O", "O_bias", "H", "Y", "Y_bias"]
+
+        if not self.ablations.srnn:
+            names += ["H_bias"]
+
+        if self.hyper_parameters.embedding_width != self.hyper_parameters.width:
+            names += ["EP"]
+
+        values = self.session.run([getattr(self, name) for name in names])
+        return {name: values[i] for i, name in enumerate(names)}
+
     def load_parameters(self, model_dir, version=None):
         checkpoints = mlbase.Checkpoints.load(model_dir)
         model_path = checkpoints.model_path(version)
@@ -550,8 +704,8 @@ class Lstm:
 
 
 class LstmLm(Lstm):
-    def __init__(self, hyper_parameters, ablations, word_labels, skeleton):
-        super(LstmLm, self).__init__(hyper_parameters, ablations, word_labels, word_labels, skeleton=skeleton)
+    def __init__(self, hyper_parameters, ablations, word_labels, skeleton, inference=False, session_config=None):
+        super(LstmLm, self).__init__(hyper_parameters, ablations, word_labels, word_labels, skeleton=skeleton, inference=inference, session_config=session_config)
         pass
 
     def computational_graph_cost(self):
@@ -588,106 +742,96 @@ class LstmLm(Lstm):
         targets = tf.reshape(self.unrolled_outputs_p, [self.batch_size, self.max_time])
         return tf.contrib.seq2seq.sequence_loss(logits=logits, targets=targets, weights=self.mask, average_across_timesteps=True, average_across_batch=True)
 
+    def encode_outputs(self, bucket, length):
+        return np.array([[self.output_labels.encode(word_pos[0], True) for word_pos in xy.y] for xy in bucket], dtype="int32").reshape([len(bucket), length])
+
     def get_training_feed(self, batch, training_parameters):
-        data_x, data_y = mlbase.as_time_major(batch, True)
-        input_labels = [[self.word_labels.encode(word_pos[0] if word_pos is not None else mlbase.BLANK, True) for word_pos in timespot] for timespot in data_x]
-        input_lengths = [len(sequence.x) for sequence in batch]
-        output_labels = [[self.word_labels.encode(word_pos[0] if word_pos is not None else mlbase.BLANK, True) for word_pos in timespot] for timespot in data_y]
         return {
-            self.unrolled_inputs_p: input_labels,
-            self.input_lengths_p: input_lengths,
+            self.unrolled_inputs_p: batch.inputs,
+            self.input_lengths_p: batch.lengths,
             self.initial_state_p: self.initial_state(len(batch)),
             self.learning_rate_p: [training_parameters.learning_rate()],
             self.clip_norm_p: [training_parameters.clip_norm()],
             self.dropout_keep_p: [1.0 - training_parameters.dropout_rate()],
-            self.unrolled_outputs_p: output_labels,
+            self.unrolled_outputs_p: batch.outputs,
         }
 
     def get_testing_feed(self, batch):
-        data_x, data_y = mlbase.as_time_major(batch, True)
-        input_labels = [[self.word_labels.encode(word_pos[0] if word_pos is not None else mlbase.BLANK, True) for word_pos in timespot] for timespot in data_x]
-        input_lengths = [len(sequence.x) for sequence in batch]
         return {
-            self.unrolled_inputs_p: input_labels,
-            self.input_lengths_p: input_lengths,
+            self.unrolled_inputs_p: batch.inputs,
+            self.input_lengths_p: batch.lengths,
             self.initial_state_p: self.initial_state(len(batch)),
             self.dropout_keep_p: np.array([1.0]),
         }
 
-    def score(self, batch, feed, time_distributions, debug, case_slot_length):
-        case_template = "{{Case {:%dd}}}" % case_slot_length
-        input_lengths = feed[self.input_lengths_p]
-        total_perplexity = 0.0
+    def score(self, batch, time_distributions, debug, case_slot_length):
+        # The perplexity of each case, from the probabilities of its expected outputs.
+        #   [time, batch]
+        timesteps = np.arange(len(time_distributions)).reshape([-1, 1])
+        cases = np.arange(len(batch)).reshape([1, -1])
+        mask = timesteps < batch.lengths.reshape([1, -1])
+        expected_probabilities = time_distributions[timesteps, cases, batch.outputs].astype("float64")
+        #   [batch]
+        log_probabilities = np.sum(np.log2(np.where(mask, expected_probabilities, 1.0)), axis=0)
+        perplexities = 2**(-(log_probabilities / batch.lengths))
 
         if debug:
-            sequence = [[] for case in range(len(batch))]
-            predictions = [[] for case in range(len(batch))]
-            predictions_probabilities = [[] for case in range(len(batch))]
-            expectations = [[] for case in range(len(batch))]
-            expectations_probabilities = [[] for case in range(len(batch))]
-
-        log_probabilities = [0.0 for case in range(len(batch))]
-
-        for timestep, distributions in enumerate(time_distributions):
-            for case, distribution in enumerate(distributions):
-                if timestep < input_lengths[case]:
-                    if debug:
-                        sequence[case] += [batch[case].x[timestep][0]]
-
-                        predicted = self.output_labels.vector_decode(distribution)
-                        predicted_probability = self.output_labels.vector_decode_probability(distribution, predicted)
-                        predictions[case] += [predicted]
-                        predictions_probabilities[case] += [predicted_probability]
-
-                    expected = self.output_labels.decode(self.output_labels.encode(batch[case].y[timestep][0], True))
-                    expected_probability = self.output_labels.vector_decode_probability(distribution, expected)
+            self.debug_score(batch, time_distributions, expected_probabilities, perplexities, case_slot_length)
 
-                    if debug:
-                        expectations[case] += [expected]
-                        expectations_probabilities[case] += [expected_probability]
+        # Since 'score' means that the higher is better, but with perplexity the lower is better, so negate it.
+        return -np.sum(perplexities).item()
 
-                    log_probabilities[case] += math.log2(expected_probability)
+    def debug_score(self, batch, time_distributions, expected_probabilities, perplexities, case_slot_length):
+        case_template = "{{Case {:%dd}}}" % case_slot_length
 
-        for case, log_probability in enumerate(log_probabilities):
-            perplexity = 2**(-(log_probability / input_lengths[case]))
-            total_perplexity += perplexity
+        for case, xy in enumerate(batch.xys):
+            sequence = []
+            predictions = []
+            predictions_probabilities = []
+            expectations = []
+            expectations_probabilities = []
 
-            if debug:
-                float_points = 4
-                string_lengths = []
+            for timestep in range(batch.lengths[case]):
+                distribution = time_distributions[timestep][case]
+                sequence += [xy.x[timestep][0]]
+                predicted = self.output_labels.vector_decode(distribution)
+                predictions += [predicted]
+                predictions_probabilities += [self.output_labels.vector_decode_probability(distribution, predicted)]
+                expectations += [self.output_labels.decode(batch.outputs[timestep][case])]
+                expectations_probabilities += [expected_probabilities[timestep][case]]
 
-                for timestep in range(input_lengths[case]):
-                    maximum = float_points + 2
+            float_points = 4
+            string_lengths = []
 
-                    if len(sequence[case][timestep]) > maximum:
-                        maximum = len(sequence[case][timestep])
+            for timestep in range(batch.lengths[case]):
+                maximum = float_points + 2
 
-                    if len(predictions[case][timestep]) > maximum:
-                        maximum = len(predictions[case][timestep])
+                if len(sequence[timestep]) > maximum:
+                    maximum = len(sequence[timestep])
 
-                    if len(expectations[case][timestep]) > maximum:
-                        maximum = len(expectations[case][timestep])
+                if len(predictions[timestep]) > maximum:
+                    maximum = len(predictions[timestep])
 
-                    string_lengths += [maximum]
+                if len(expectations[timestep]) > maximum:
+                    maximum = len(expectations[timestep])
 
-                debug_template = " ".join(["{:%d.%ds}" % (l, l) for l in string_lengths])
-                float_template = "{:.%df}" % float_points
-                sequence_str = debug_template.format(*(sequence[case]))
-                predicted_str = debug_template.format(*predictions[case])
-                predicted_probability_str = debug_template.format(*[float_template.format(p) for p in predictions_probabilities[case]])
-                expected_str = debug_template.format(*expectations[case])
-                expected_probability_str = debug_template.format(*[float_template.format(p) for p in expectations_probabilities[case]])
-                debug_str = "   Inputed: %s\n Predicted: %s\n            %s\n  Expected: %s\n            %s" % \
-                    (sequence_str, predicted_str, predicted_probability_str, expected_str, expected_probability_str)
-                logging.debug("%s perplexity %.4f.\n%s" % (case_template.format(case), perplexity, debug_str))
+                string_lengths += [maximum]
 
-        # Since 'score' means that the higher is better, but with perplexity the lower is better, so negate it.
-        return -total_perplexity
+            debug_template = " ".join(["{:%d.%ds}" % (l, l) for l in string_lengths])
+            float_template = "{:.%df}" % float_points
+            sequence_str = debug_template.format(*sequence)
+            predicted_str = debug_template.format(*predictions)
+            predicted_probability_str = debug_template.format(*[float_template.format(p) for p in predictions_probabilities])
+            expected_str = debug_template.format(*expectations)
+            expected_probability_str = debug_template.format(*[float_template.format(p) for p in expectations_probabilities])
+            debug_str = "   Inputed: %s\n Predicted: %s\n            %s\n  Expected: %s\n            %s" % \
+                (sequence_str, predicted_str, predicted_probability_str, expected_str, expected_probability_str)
+            logging.debug("%s perplexity %.4f.\n%s" % (case_template.format(case), perplexities[case], debug_str))
 
 
 class LstmSa(Lstm):
-    def __init__(self, hyper_parameters, ablations, word_labels, output_labels, skeleton):
-        super(LstmSa, self).__init__(hyper_parameters, ablations, word_labels, output_labels, skeleton=skeleton)
+    def __init__(self, hyper_parameters, ablations, word_labels, output_labels, skeleton, inference=False, session_config=None):
+        super(LstmSa, self).__init__(hyper_parameters, ablations, word_labels, output_labels, skeleton=skeleton, inference=inference, session_config=session_config)
         pass
 
     def computational_graph_cost(self):
@@ -696,58 +840,108 @@ class LstmSa(Lstm):
         expected_outputs = tf.gather_nd(self.unrolled_outputs, self.input_gathers_p)
         return tf.reduce_sum(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=expected_outputs, labels=self.output_p))
 
+    def encode_outputs(self, bucket, length):
+        return np.array([self.output_labels.encode(xy.y, True) for xy in bucket], dtype="int32")
+
     def get_training_feed(self, batch, training_parameters):
-        data_x, data_y = mlbase.as_time_major(batch, False)
-        input_labels = [[self.word_labels.encode(word_pos[0] if word_pos is not None else mlbase.BLANK, True) for word_pos in timespot] for timespot in data_x]
-        # Gathers are indexes, not lengths.
-        #                                 vvv
-        input_gathers = [[len(sequence.x) - 1, i] for i, sequence in enumerate(batch)]
-        output_labels = [self.output_labels.encode(word if word is not None else mlbase.BLANK, True) for word in data_y]
         return {
-            self.unrolled_inputs_p: input_labels,
-            self.input_gathers_p: input_gathers,
+            self.unrolled_inputs_p: batch.inputs,
+            self.input_gathers_p: self.input_gathers(batch),
             self.initial_state_p: self.initial_state(len(batch)),
             self.learning_rate_p: [training_parameters.learning_rate()],
             self.clip_norm_p: [training_parameters.clip_norm()],
             self.dropout_keep_p: [1.0 - training_parameters.dropout_rate()],
-            self.output_p: output_labels,
+            self.output_p: batch.outputs,
         }
 
     def get_testing_feed(self, batch):
-        data_x, data_y = mlbase.as_time_major(batch, False)
-        input_labels = [[self.word_labels.encode(word_pos[0] if word_pos is not None else mlbase.BLANK, True) for word_pos in timespot] for timespot in data_x]
-        # Gathers are indexes, not lengths.
-        #                                 vvv
-        input_gathers = [[len(sequence.x) - 1, i] for i, sequence in enumerate(batch)]
         return {
-            self.unrolled_inputs_p: input_labels,
-            self.input_gathers_p: input_gathers,
+            self.unrolled_inputs_p: batch.inputs,
+            self.input_gathers_p: self.input_gathers(batch),
             self.initial_state_p: self.initial_state(len(batch)),
             self.dropout_keep_p: np.array([1.0]),
         }
 
-    def score(self, batch, feed, time_distributions, debug, case_slot_length):
+    def input_gathers(self, batch):
+        # Gathers are indexes, not lengths.
+        #                           vvv
+        return np.stack([batch.lengths - 1, np.arange(len(batch), dtype="int32")], axis=1)
+
+    def score(self, batch, time_distributions, debug, case_slot_length):
         case_template = "{{Case {:%dd}}}" % case_slot_length
-        input_gathers = feed[self.input_gathers_p]
-        total_correct = 0
-        predictions = [[] for case in range(len(batch))]
+        # The prediction of each case, at its last timestep.
+        predictions = np.argmax(time_distributions[batch.lengths - 1, np.arange(len(batch))], axis=-1)
+        corrects = predictions == batch.outputs
+
+        if debug:
+            for case, xy in enumerate(batch.xys):
+                if corrects[case]:
+                    logging.debug("%s passed!\n   Sequence: %s\n   Expected: %s" % \
+                        (case_template.format(case), " ".join([word_pos[0] for word_pos in xy.x]), xy.y))
+                else:
+                    logging.debug("%s failed!\n   Sequence: %s\n   Expected: %s\n  Predicted: %s" % \
+                        (case_template.format(case), " ".join([word_pos[0] for word_pos in xy.x]), xy.y, self.output_labels.decode(predictions[case])))
+
+        return np.sum(corrects).item()
 
-        for timestep, distributions in enumerate(time_distributions):
-            for case, distribution in enumerate(distributions):
-                if timestep == input_gathers[case][0]:
-                    prediction = self.output_labels.vector_decode(distribution)
 
-                    if prediction == batch[case].y:
-                        total_correct += 1
+class EncodedSequences:
+    # The xy sequences of a data set, encoded into int32 ids (see Lstm.encode).
+    # Sorted by length, where each length is a bucket of (unpadded) [sequences, length] ids.
+    def __init__(self, xys, inputs, outputs, blank, sequence_outputs):
+        self.xys = xys
+        self.inputs = inputs
+        self.outputs = outputs
+        self.blank = blank
+        self.sequence_outputs = sequence_outputs
+        self.bucket_lengths = np.array([bucket.shape[1] for bucket in inputs], dtype="int32")
+        self.bucket_offsets = np.cumsum([0] + [len(bucket) for bucket in inputs])
+        assert self.bucket_offsets[-1] == len(xys), "%d != %d" % (self.bucket_offsets[-1], len(xys))
 
-                        if debug:
-                            logging.debug("%s passed!\n   Sequence: %s\n   Expected: %s" % \
-                                (case_template.format(case), " ".join([word_pos[0] for word_pos in batch[case].x]), batch[case].y))
-                    elif debug:
-                        logging.debug("%s failed!\n   Sequence: %s\n   Expected: %s\n  Predicted: %s" % \
-                            (case_template.format(case), " ".join([word_pos[0] for word_pos in batch[case].x]), batch[case].y, prediction))
+    def __len__(self):
+        return len(self.xys)
 
-        return total_correct
+    def __repr__(self):
+        return "EncodedSequences{sequences=%d, buckets=%d}" % (len(self.xys), len(self.inputs))
+
+    def batch(self, start, end):
+        # The (time major) batch of the sequences [start, end), padded with blanks to its longest sequence.
+        end = min(end, len(self.xys))
+        check.check_gte(end - start, 0)
+        first = np.searchsorted(self.bucket_offsets, start, side="right") - 1
+        last = np.searchsorted(self.bucket_offsets, end, side="left")
+        lengths = np.empty([end - start], dtype="int32")
+        inputs = np.full([end - start, self.bucket_lengths[last - 1] if end > start else 0], self.blank, dtype="int32")
+        outputs = np.full(inputs.shape if self.sequence_outputs else [end - start], self.blank, dtype="int32")
+
+        for b in range(first, last):
+            # The rows of this bucket that are in the batch.
+            lower = max(start, self.bucket_offsets[b]) - self.bucket_offsets[b]
+            upper = min(end, self.bucket_offsets[b + 1]) - self.bucket_offsets[b]
+            rows = slice(self.bucket_offsets[b] + lower - start, self.bucket_offsets[b] + upper - start)
+            lengths[rows] = self.bucket_lengths[b]
+            inputs[rows, :self.bucket_lengths[b]] = self.inputs[b][lower:upper]
+
+            if outputs.ndim == 2:
+                outputs[rows, :self.bucket_lengths[b]] = self.outputs[b][lower:upper]
+            else:
+                outputs[rows] = self.outputs[b][lower:upper]
+
+        return EncodedBatch(self.xys[start:end], inputs.T, lengths, outputs.T)
+
+
+class EncodedBatch:
+    def __init__(self, xys, inputs, lengths, outputs):
+        self.xys = xys
+        #   [time, batch]
+        self.inputs = inputs
+        #   [batch]
+        self.lengths = lengths
+        #   [time, batch] or [batch]
+        self.outputs = outputs
+
+    def __len__(self):
+        return len(self.xys)
 
 
 class Stepwise:
@@ -787,6 +981,76 @@ class Result:
         return "(prediction=%s, distribution=%s)" % (self.prediction, sorted(self.distribution.items()))
 
 
+class TopKResult:
+    # A result which keeps the raw distribution array, so that the top few outputs may be found without decoding every output.
+    # Has the same fields as Result, although the (per output) distribution is only built when it is asked for.
+    def __init__(self, labels, array):
+        self.labels = labels
+        self.array = array
+        self._prediction = None
+        self._distribution = None
+
+    @property
+    def prediction(self):
+        if self._prediction is None:
+            self._prediction = self.labels.decode(int(np.argmax(self.array)))
+
+        return self._prediction
+
+    @property
+    def distribution(self):
+        if self._distribution is None:
+            self._distribution = self.labels.vector_decode_distribution(self.array)
+
+        return self._distribution
+
+    @property
+    def encoding(self):
+        return self.labels.encoding()
+
+    def top_k(self, k):
+        # The k most probable outputs (and their probabilities), most probable first.
+        k = min(check.check_gte(k, 1), len(self.array))
+        indices = np.argpartition(-self.array, k - 1)[:k]
+        return {self.labels.decode(int(index)): self.array[index] for index in indices[np.argsort(-self.array[indices], kind="stable")]}
+
+    def __repr__(self):
+        return "(prediction=%s, top_k=%s)" % (self.prediction, sorted(self.top_k(5).items()))
+
+
+def unrolled_instrument_names(instrument_names):
+    # The unrolled instruments from which the (single step) instruments of each sequence in a batch are sliced (see case_instruments).
+    # For a single step, the soft filters are just the remember gates.
+    return ["%s%s" % ("remember_gates" if name == "ws" else name, UNROLLED_SUFFIX) for name in instrument_names]
+
+
+def case_instruments(instrument_names, unrolled_values, b):
+    # The instruments of the b-th sequence, shaped as per evaluate (of a batch of one).
+    instrument_values = {}
+
+    for i, name in enumerate(instrument_names):
+        #   [1, layers, width]
+        value = unrolled_values[i][:, :, b]
+        instrument_values[name] = value if name == "ws" else value.reshape([-1, value.shape[-1]])
+
+    return instrument_values
+
+
+def stream_instrumented(rnn, xys, instrument_names, batch_size=32, handle_unknown=True):
+    # Stream the (xy, timestep instruments) of each xy, eliciting the instruments a batch of xys at a time.
+    batch = []
+
+    for xy in xys:
+        batch += [xy]
+
+        if len(batch) == batch_size:
+            yield from zip(batch, rnn.evaluate_batch_instrumented([[word_pos[0] for word_pos in xy.x] for xy in batch], handle_unknown, instrument_names))
+            batch = []
+
+    if len(batch) > 0:
+        yield from zip(batch, rnn.evaluate_batch_instrumented([[word_pos[0] for word_pos in xy.x] for xy in batch], handle_unknown, instrument_names))
+
+
 def assert_shape(tensor, expected):
     assert tensor.shape.as_list() == expected, "actual %s != expected %s" % (tensor.shape, expected)
 
@@ -2,6 +2,7 @@
 import logging
 
 from nnwd import data
+from nnwd.vocabulary import Vocabulary
 
 
 def create(data_dir, corpus_stream_fn):
@@ -37,14 +38,17 @@ def create(data_dir, corpus_stream_fn):
         else:
             test_xys += [xy]
 
-    data.set_train(data_dir, train_xys)
-    data.set_validation(data_dir, validation_xys)
-    data.set_test(data_dir, test_xys)
+    # The description comes first, since the data is stored according to it.
+    data.set_description(data_dir, data.Description(data.SA, encoded=True))
+    vocabulary = Vocabulary()
+    data.set_train(data_dir, train_xys, vocabulary)
+    data.set_validation(data_dir, validation_xys, vocabulary)
+    data.set_test(data_dir, test_xys, vocabulary)
+    data.set_vocabulary(data_dir, vocabulary)
     data.set_outputs(data_dir, sentiments, sentiment_sort_key)
     data.set_output_distribution(data_dir, {k: v / float(total) for k, v in output_distribution.items()})
     words = set([item[0] for item in words.items() if item[1] >= data.MINIMUM_OCCURRENCE_COUNT])
     data.set_words(data_dir, words)
-    data.set_description(data_dir, data.Description(data.SA))
     logging.debug("total pairs (t, v, t): %d, %d, %d" % (sum([len(xy[0]) for xy in train_xys]), sum([len(xy[0]) for xy in validation_xys]), sum([len(xy[0]) for xy in test_xys])))
     return train_xys, validation_xys, test_xys
 
@@ -1,5 +1,6 @@
 
 import json
+import numpy as np
 import os
 
 from ml import base as mlbase
@@ -55,11 +56,32 @@ def model_for(lstm, semantic_dir=None, hyper_parameters=None, extra=None, \
         hyper_parameters = get_hyper_parameters(semantic_dir)
         extra = get_extra(semantic_dir)
 
-    case_labels = mlbase.Labels(lstm.keys())
-    hidden_vector = mlbase.VectorField(max(lstm.hyper_parameters.width, lstm.hyper_parameters.embedding_width))
+    case_labels = case_labels_for(lstm)
+    hidden_vector = mlbase.VectorField(hidden_width(lstm))
     return model_fn("sem", hyper_parameters, extra, case_labels, hidden_vector, lstm.word_labels, lstm.output_labels)
 
 
+def case_labels_for(lstm):
+    return mlbase.Labels(lstm.keys())
+
+
+def hidden_width(lstm):
+    return max(lstm.hyper_parameters.width, lstm.hyper_parameters.embedding_width)
+
+
+def stack_inputs(case_labels, width, keys, points):
+    # Encodes the (key, point) inputs as one [len(keys), case_labels + width] float32 matrix (the layout of ConcatField([case_labels, hidden_vector])),
+    # where the points are zero padded up to the width, along with the [len(keys)] case ids (see model.TfModel.predict_top_k).
+    cases = np.array([case_labels.encode(key) for key in keys], dtype="int32")
+    inputs = np.zeros([len(keys), len(case_labels) + width], dtype="float32")
+    inputs[np.arange(len(keys)), cases] = 1.0
+
+    for i, point in enumerate(points):
+        inputs[i, len(case_labels):len(case_labels) + len(point)] = point
+
+    return inputs, cases
+
+
 def load_model(lstm, semantic_dir, model_fn):
     sem = model_for(lstm, semantic_dir, model_fn=model_fn)
     load_parameters(sem, semantic_dir)
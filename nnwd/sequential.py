@@ -47,7 +47,7 @@ def set_ablations(sequential_dir, ablations):
         fh.write(json.dumps(key_values, sort_keys=True, indent=4))
 
 
-def model_for(data_dir, sequential_dir=None, hyper_parameters=None, ablations=None, skeleton=False):
+def model_for(data_dir, sequential_dir=None, hyper_parameters=None, ablations=None, skeleton=False, inference=False, session_config=None):
     if sequential_dir is None:
         assert hyper_parameters is not None and ablations is not None, "one of (sequential_dir) or (hyper_parameters, ablations) must be specified"
     else:
@@ -59,14 +59,15 @@ def model_for(data_dir, sequential_dir=None, hyper_parameters=None, ablations=No
     words = data.get_words(data_dir)
 
     if description.task == data.LM:
-        return rnn.LstmLm(hyper_parameters, ablations, words, skeleton)
+        return rnn.LstmLm(hyper_parameters, ablations, words, skeleton, inference, session_config)
     else:
         outputs = data.get_outputs(data_dir)
-        return rnn.LstmSa(hyper_parameters, ablations, words, outputs, skeleton)
+        return rnn.LstmSa(hyper_parameters, ablations, words, outputs, skeleton, inference, session_config)
 
 
-def load_model(data_dir, sequential_dir, skeleton=False):
-    rnn = model_for(data_dir, sequential_dir, skeleton=skeleton)
+def load_model(data_dir, sequential_dir, skeleton=False, inference=False, session_config=None):
+    # Notice, an inference model only restores (and builds) the forward pass - it cannot be trained.
+    rnn = model_for(data_dir, sequential_dir, skeleton=skeleton, inference=inference, session_config=session_config)
 
     if not skeleton:
         load_parameters(rnn, sequential_dir)
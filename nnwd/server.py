@@ -129,6 +129,13 @@ def main(argv):
     ap.add_argument("--query-dir", default=None)
     ap.add_argument("--db-kind", choices=["postgres", "sqlite"])
     ap.add_argument("--use-fixed-buckets", default=False, action="store_true")
+    ap.add_argument("--numpy-inference", default=False, action="store_true", help="Query the lstm via numpy, rather than tensorflow.")
+    ap.add_argument("--prefix-states-dir", default=None, help="Look up the precomputed states of known prefixes (see generate-prefix-states.py).")
+    ap.add_argument("--replicas", default=1, type=int, help="Number of (independent) model replicas to serve concurrent requests from.")
+    ap.add_argument("--intra-op-threads", default=0, type=int, help="Threads for each replica's ops to parallelize within (0 lets tensorflow choose).")
+    ap.add_argument("--inter-op-threads", default=0, type=int, help="Threads for each replica to run independent ops on (0 lets tensorflow choose).")
+    ap.add_argument("--micro-batch", default=0, type=int, help="Run up to this many concurrent lstm/semantic model calls together as a batch (0 to run each on its own).")
+    ap.add_argument("--micro-batch-wait", default=2, type=float, help="Milliseconds to wait for concurrent calls to batch together.")
     ap.add_argument("data_dir")
     ap.add_argument("sequential_dir")
     ap.add_argument("buckets_dir")
@@ -139,7 +146,8 @@ def main(argv):
     logging.debug(aargs)
 
     words = data.get_words(aargs.data_dir)
-    neural_network = domain.NeuralNetwork(aargs.data_dir, aargs.sequential_dir, aargs.buckets_dir, aargs.encoding_dir, aargs.use_fixed_buckets)
+    neural_network = domain.NeuralNetwork(aargs.data_dir, aargs.sequential_dir, aargs.buckets_dir, aargs.encoding_dir, aargs.use_fixed_buckets, aargs.numpy_inference, aargs.prefix_states_dir,
+        aargs.replicas, aargs.intra_op_threads, aargs.inter_op_threads, aargs.micro_batch, aargs.micro_batch_wait / 1000.0)
 
     # Quick test for seeing which mechanism is fastest for hitting the lstm.
     #logging.info("start")
@@ -154,7 +162,7 @@ def main(argv):
     pattern_engine = None
 
     if aargs.query_dir is not None:
-        query_engine = domain.QueryEngine(neural_network.lstm, aargs.query_dir, aargs.db_kind)
+        query_engine = domain.QueryEngine(neural_network.lstm, aargs.query_dir, aargs.db_kind, data.get_vocabulary(aargs.data_dir))
         pattern_engine = domain.PatternEngine(neural_network.lstm)
 
     run_server(aargs.port, words, neural_network, query_engine, pattern_engine)
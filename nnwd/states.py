@@ -1,23 +1,57 @@
 
 import collections
 import json
+import numpy as np
 import os
 import pdb
+import queue
 import random
 
 from ml import base as mlbase
 from ml import nlp
+from nnwd import columnar
 from nnwd import semantic
 from nnwd import parameters
 from nnwd import pickler
+from nnwd import prefixes
 
 
 STATES_TRAIN = "hidden-states-xys.train"
 STATES_VALIDATION = "hidden-states-xys.validation"
 STATES_TEST = "hidden-states-xys.test"
 STATES_ACTIVATION = "activation-states-xys"
+STATES_PREFIX = "prefix-states"
+# Notice, this must not share a prefix with the other states folders (see '_is_key').
+STATES_FUSED = "hidden-states-fused"
 HiddenState = collections.namedtuple("HiddenState", ["word", "point", "annotation"])
+# The hidden states of every key for a single timestep, with the points in the order of the keys they were set with.
+FusedState = collections.namedtuple("FusedState", ["word", "points", "annotation"])
 ActivationState = collections.namedtuple("ActivationState", ["sequence", "index", "point"])
+# The lstm state after a sequence prefix, keyed by the prefix's (hash, check, length) (see prefixes.prefix_key).
+PrefixState = collections.namedtuple("PrefixState", ["hash", "check", "length", "state", "embedding"])
+HIDDEN_FIELDS = [("word", columnar.INTERNED), ("point", columnar.POINT), ("annotation", columnar.INTERNED)]
+ACTIVATION_FIELDS = [("sequence", columnar.INTERNED), ("index", columnar.INTEGER), ("point", columnar.POINT)]
+PREFIX_FIELDS = [("hash", columnar.INTEGER64), ("check", columnar.INTEGER64), ("length", columnar.INTEGER), ("point", columnar.POINT)]
+# Storage backends.
+#   PICKLER         pickled tuples of python values
+#   PICKLER_ARRAYS  pickled tuples, with the point as a float32 array stored out-of-band (read back as zero-copy views)
+#   COLUMNAR        memory mapped columns (see columnar)
+PICKLER = "pickler"
+PICKLER_ARRAYS = "pickler-arrays"
+COLUMNAR = "columnar"
+BACKENDS = [PICKLER, PICKLER_ARRAYS, COLUMNAR]
+# Sampling modes for 'random_stream_hidden_states'.
+#   SAMPLE_STREAMS  every stream is open at once, and each item is sampled after it has been decoded
+#   SAMPLE_ITEMS    the items to sample from each shard are chosen up front, and shards without any are never decoded
+#   SAMPLE_SHARDS   whole shards are sampled, so only (roughly) 'sample_rate' of each key's shards are decoded at all
+#                   (cheapest, but the items of a shard are contiguous, and so correlated)
+# Pickled streams without a manifest are always sampled as for SAMPLE_STREAMS.
+SAMPLE_STREAMS = "streams"
+SAMPLE_ITEMS = "items"
+SAMPLE_SHARDS = "shards"
+SAMPLINGS = [SAMPLE_STREAMS, SAMPLE_ITEMS, SAMPLE_SHARDS]
+# The number of sampled items to mix together, when sampling by items or shards.
+SHUFFLE_SIZE = 50000
 
 
 def _folder(kind):
@@ -25,25 +59,251 @@ def _folder(kind):
         STATES_VALIDATION if kind == "validation" else STATES_TEST
 
 
-def set_hidden_states(states_dir, kind, key, states):
-    pickler.dump(states, os.path.join(states_dir, _folder(kind) + "." + key), converter=lambda hs: tuple((hs.word, hs.point, hs.annotation)))
+def _dump(states, dir_path, fields, converter, backend, append, codec):
+    if backend == COLUMNAR:
+        if append:
+            raise ValueError("the columnar backend cannot be appended to")
+
+        if codec != pickler.NONE:
+            raise ValueError("the columnar backend cannot be compressed (it is memory mapped)")
+
+        columnar.dump(states, dir_path, fields, converter=converter)
+    elif backend == PICKLER_ARRAYS:
+        pickler.dump(states, dir_path, converter=_point_array(converter, fields), out_of_band=True, append=append, codec=codec)
+    else:
+        pickler.dump(states, dir_path, converter=converter, append=append, codec=codec)
+
+
+def _point_array(converter, fields):
+    position = [kind for name, kind in fields].index(columnar.POINT)
+
+    def _convert(item):
+        row = converter(item)
+        return row[:position] + (np.asarray(row[position], dtype="float32"),) + row[position + 1:]
+
+    return _convert
+
+
+def _load(dir_path, converter):
+    # Columnar directories are detected by their manifest, so readers need not know which backend wrote the states.
+    if columnar.exists(dir_path):
+        return columnar.load(dir_path, converter=converter)
+    else:
+        return pickler.load(dir_path, converter=converter)
+
+
+def points(states):
+    # The (count, width) float32 matrix of the states' points.
+    # This is a memory mapped view for columnar states, and materialized otherwise.
+    if isinstance(states, columnar.Columns):
+        return states.points
+
+    return np.array([state.point for state in states], dtype="float32")
+
+
+def _fused_folder(kind):
+    return STATES_FUSED + "." + kind
+
+
+def set_fused_hidden_states(states_dir, kind, key_widths, states):
+    # Write the hidden states of all the keys together, as one columnar row per timestep.
+    # The row's point is the concatenation of each key's point, so the word and annotation are only stored once.
+    layout = []
+    offset = 0
+
+    for key, width in key_widths:
+        layout += [(key, offset, width)]
+        offset += width
+
+    converter = lambda fs: tuple((fs.word, np.concatenate([np.asarray(point, dtype="float32") for point in fs.points]), fs.annotation))
+    columnar.dump(states, os.path.join(states_dir, _fused_folder(kind)), HIDDEN_FIELDS, converter=converter, metadata={"layout": layout})
+
+
+def get_fused_hidden_states(states_dir, kind):
+    return columnar.load(os.path.join(states_dir, _fused_folder(kind)), allow_not_found=True)
+
+
+def _fused_keys(fused):
+    return [key for key, offset, width in fused.metadata["layout"]]
+
+
+def _fused_view(fused, key, converter):
+    for layout_key, offset, width in fused.metadata["layout"]:
+        if layout_key == key:
+            return fused.view(offset, offset + width, converter)
+
+    raise ValueError("unknown key '%s' in %s" % (key, fused))
+
+
+def _load_hidden(states_dir, kind, key):
+    converter = lambda item: HiddenState(*item)
+    dir_path = os.path.join(states_dir, _folder(kind) + "." + key)
+
+    # Readers of a single key are served a view of the fused store, when that's how the hidden states were written.
+    if not os.path.exists(dir_path):
+        fused = get_fused_hidden_states(states_dir, kind)
+
+        if fused is not None:
+            return _fused_view(fused, key, converter)
+
+    return _load(dir_path, converter)
+
+
+def set_hidden_states(states_dir, kind, key, states, backend=PICKLER, append=False, codec=pickler.NONE):
+    _dump(states, os.path.join(states_dir, _folder(kind) + "." + key), HIDDEN_FIELDS, lambda hs: tuple((hs.word, hs.point, hs.annotation)), backend, append, codec)
+
+
+def committed_hidden_states(states_dir, kind, key):
+    # The input position that the (marked) hidden states stream has been committed up to, or None.
+    return pickler.committed(os.path.join(states_dir, _folder(kind) + "." + key))
 
 
 def get_hidden_states(states_dir, key):
-    train = pickler.load(os.path.join(states_dir, STATES_TRAIN + "." + key), converter=lambda item: HiddenState(*item))
-    test = pickler.load(os.path.join(states_dir, STATES_TEST + "." + key), converter=lambda item: HiddenState(*item))
+    train = _load_hidden(states_dir, "train", key)
+    test = _load_hidden(states_dir, "test", key)
     return train, test
 
 
-def random_stream_hidden_states(states_dir, kind, keys, sample_rate=1.0):
+def random_stream_hidden_states(states_dir, kind, keys, sample_rate=1.0, sampling=SAMPLE_STREAMS, shuffle_size=SHUFFLE_SIZE):
+    fused = get_fused_hidden_states(states_dir, kind)
+
+    if fused is not None:
+        return _random_stream_fused(fused, keys, sample_rate)
+    elif sampling == SAMPLE_STREAMS:
+        return _random_stream(states_dir, kind, keys, sample_rate)
+    else:
+        return _shuffle(_sample_units(states_dir, kind, keys, sample_rate, sampling == SAMPLE_SHARDS), shuffle_size)
+
+
+def _sample_units(states_dir, kind, keys, sample_rate, whole):
+    # A unit is a shard of a pickled stream, or a chunk of a columnar one.
+    # The units are visited in a random order, and only one is decoded at a time.
+    units = []
+    # Pickled streams without a manifest can't be split into units without decoding every shard, so they are streamed instead.
+    streamed = []
+
+    for name in os.listdir(states_dir):
+        key = _key(name) if _is_key(name) else None
+
+        if name.startswith(_folder(kind)) and (keys is None or key in keys):
+            dir_path = os.path.join(states_dir, name)
+
+            if columnar.exists(dir_path):
+                source = columnar.load(dir_path)
+                units += [(key, source, offset, min(columnar.READ_CHUNK, len(source) - offset)) for offset in range(0, len(source), columnar.READ_CHUNK)]
+            elif pickler.has_manifest(dir_path):
+                source = pickler.open(dir_path)
+                units += [(key, source, position, count) for position, count in enumerate(source.counts()) if count > 0]
+            else:
+                streamed += [(key, dir_path)]
+
+    if whole:
+        selected = _select_whole_units(units, sample_rate)
+    else:
+        selected = [True] * len(units)
+
+    for u in np.random.permutation(len(units) + len(streamed)):
+        if u < len(units):
+            key, source, position, count = units[u]
+
+            if not selected[u]:
+                indices = np.arange(0)
+            elif sample_rate == 1.0 or whole:
+                indices = np.arange(count)
+            else:
+                indices = np.flatnonzero(np.random.random(count) <= sample_rate)
+
+            if len(indices) > 0:
+                for hidden_state in _unit_states(source, position, indices):
+                    yield key, hidden_state
+        else:
+            key, dir_path = streamed[u - len(units)]
+
+            for hidden_state in _load(dir_path, lambda item: HiddenState(*item)):
+                if sample_rate == 1.0 or random.random() <= sample_rate:
+                    yield key, hidden_state
+
+
+def _select_whole_units(units, sample_rate):
+    # Each key keeps (roughly) 'sample_rate' of its units, but always at least one, so that no key goes unsampled.
+    selected = [False] * len(units)
+    key_units = collections.defaultdict(list)
+
+    for u, (key, source, position, count) in enumerate(units):
+        key_units[key] += [u]
+
+    for key, indices in key_units.items():
+        expected = sample_rate * len(indices)
+        # Round stochastically, so the expected number of units kept is exact.
+        keep = max(1, int(expected) + (1 if np.random.random() < expected - int(expected) else 0))
+
+        for u in np.random.choice(indices, min(keep, len(indices)), replace=False):
+            selected[u] = True
+
+    return selected
+
+
+def _unit_states(source, position, indices):
+    if isinstance(source, columnar.Columns):
+        indices = indices + position
+        words = source.array("word")[indices]
+        annotations = source.array("annotation")[indices]
+        points = source.points[indices]
+        return [HiddenState(source.vocabulary("word")[words[i]], points[i], source.vocabulary("annotation")[annotations[i]]) for i in range(len(indices))]
+    else:
+        items = source.shard(position)
+        states = [HiddenState(*items[i]) for i in indices]
+        # Each unit is visited once, so its shard needn't stay cached.
+        source.release()
+        return states
+
+
+def _shuffle(stream, shuffle_size):
+    # Mix the stream by yielding a random item from a buffer of (up to) 'shuffle_size' items, replacing it with the next one.
+    buffer = []
+
+    for item in stream:
+        if len(buffer) < shuffle_size:
+            buffer += [item]
+        else:
+            i = random.randrange(shuffle_size)
+            yield buffer[i]
+            buffer[i] = item
+
+    random.shuffle(buffer)
+
+    for item in buffer:
+        yield item
+
+
+def _random_stream_fused(fused, keys, sample_rate):
+    # Each timestep is sampled just once, for all of the keys.
+    views = [(key, _fused_view(fused, key, None)) for key in _fused_keys(fused) if keys is None or key in keys]
+
+    for offset in range(0, len(fused), columnar.READ_CHUNK):
+        end = min(offset + columnar.READ_CHUNK, len(fused))
+        indices = np.arange(offset, end) if sample_rate == 1.0 else offset + np.flatnonzero(np.random.random(end - offset) <= sample_rate)
+        words = fused.array("word")[indices]
+        annotations = fused.array("annotation")[indices]
+        points = [(key, view.points[indices]) for key, view in views]
+
+        for i in range(len(indices)):
+            word = fused.vocabulary("word")[words[i]]
+            annotation = fused.vocabulary("annotation")[annotations[i]]
+
+            for key, key_points in points:
+                yield key, HiddenState(word, key_points[i], annotation)
+
+
+def _random_stream(states_dir, kind, keys, sample_rate):
     streams = {}
     stream_names = []
 
     for name in os.listdir(states_dir):
-        key = _key(name)
+        key = _key(name) if _is_key(name) else None
 
         if name.startswith(_folder(kind)) and (keys is None or key in keys):
-            streams[name] = pickler.load(os.path.join(states_dir, name), converter=lambda item: HiddenState(*item))
+            streams[name] = iter(_load(os.path.join(states_dir, name), lambda item: HiddenState(*item)))
             stream_names += [name]
 
     while len(streams) > 0:
@@ -87,17 +347,55 @@ def stream_hidden_test(states_dir, key):
 
 
 def stream_hidden_states(states_dir, kind, key):
-    return pickler.load(os.path.join(states_dir, _folder(kind) + "." + key), converter=lambda item: HiddenState(*item))
+    return iter(_load_hidden(states_dir, kind, key))
+
 
+def set_activation_states(states_dir, key, states, backend=PICKLER, append=False, codec=pickler.NONE):
+    _dump(states, os.path.join(states_dir, STATES_ACTIVATION + "." + key), ACTIVATION_FIELDS, lambda _as: tuple((_as.sequence, _as.index, _as.point)), backend, append, codec)
 
-def set_activation_states(states_dir, key, states):
-    pickler.dump(states, os.path.join(states_dir, STATES_ACTIVATION + "." + key), converter=lambda _as: tuple((_as.sequence, _as.index, _as.point)))
 
+def _activation_converter(vocabulary):
+    # Sequences may be encoded by the data's vocabulary (as an int32 array) - these are decoded when a 'vocabulary' is given.
+    if vocabulary is None:
+        return lambda item: ActivationState(*item)
 
-def get_activation_states(states_dir, key):
-    return pickler.load(os.path.join(states_dir, STATES_ACTIVATION + "." + key), converter=lambda item: ActivationState(*item))
+    return lambda item: ActivationState(vocabulary.decode_sequence(item[0]) if isinstance(item[0], np.ndarray) else item[0], item[1], item[2])
 
 
-def stream_activations(states_dir, key):
-    return pickler.load(os.path.join(states_dir, STATES_ACTIVATION + "." + key), converter=lambda item: ActivationState(*item))
+def get_activation_states(states_dir, key, vocabulary=None):
+    return _load(os.path.join(states_dir, STATES_ACTIVATION + "." + key), _activation_converter(vocabulary))
+
+
+def set_prefix_states(states_dir, parts, layers, width, embedding_width, states):
+    # Always columnar, so that the store is memory mapped (and shared) by each server process.
+    # The row's point is the flattened state (of the 'parts', in order), followed by the embedding of the prefix's last word.
+    # The rows are then sorted by their hash, for the reader's binary search (see prefixes.PrefixStore).
+    if isinstance(states, queue.Queue):
+        raise ValueError("prefix states can't be streamed from a queue, since they are sorted once they have all been written")
+
+    converter = lambda ps: (ps.hash, ps.check, ps.length, np.concatenate([np.asarray(ps.state, dtype="float32").reshape([-1]), np.asarray(ps.embedding, dtype="float32").reshape([-1])]))
+    metadata = {
+        "parts": parts,
+        "layers": layers,
+        "width": width,
+        "embedding_width": embedding_width,
+    }
+    dir_path = os.path.join(states_dir, STATES_PREFIX)
+    columnar.dump(states, dir_path, PREFIX_FIELDS, converter=converter, metadata=metadata)
+    columnar.sort(dir_path, "hash")
+
+
+def get_prefix_states(states_dir):
+    columns = columnar.load(os.path.join(states_dir, STATES_PREFIX), allow_not_found=True)
+    return None if columns is None else prefixes.PrefixStore(columns)
+
+
+def stream_activations(states_dir, key, start=0, prefetch=0, statistics=None, vocabulary=None):
+    dir_path = os.path.join(states_dir, STATES_ACTIVATION + "." + key)
+    converter = _activation_converter(vocabulary)
+
+    if columnar.exists(dir_path):
+        return columnar.load(dir_path, converter=converter).rows(start)
+    else:
+        return pickler.load(dir_path, converter=converter, start=start, prefetch=prefetch, statistics=statistics)
 
@@ -0,0 +1,63 @@
+
+import numpy as np
+import threading
+
+
+class Vocabulary:
+    # Interns the words (and pos tags) of a data directory as int32 ids.
+    # Notice, None is a legitimate value (ex: the pos tags of sentiment analysis data).
+    # Ids are assigned in order of first appearance, and are never reassigned.
+    def __init__(self, values=[]):
+        self._values = []
+        self._ids = {}
+        self._lock = threading.Lock()
+
+        for value in values:
+            self.id(value)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "Vocabulary{%d}" % len(self._values)
+
+    def values(self):
+        return [value for value in self._values]
+
+    def id(self, value):
+        identifier = self._ids.get(value)
+
+        if identifier is None:
+            with self._lock:
+                if value not in self._ids:
+                    self._ids[value] = len(self._values)
+                    self._values += [value]
+
+                identifier = self._ids[value]
+
+        return identifier
+
+    def lookup(self, values):
+        # The ids of the values (without interning them), or None if any of them aren't in the vocabulary.
+        identifiers = [self._ids.get(value) for value in values]
+        return None if None in identifiers else tuple(identifiers)
+
+    def value(self, identifier):
+        return self._values[identifier]
+
+    def encode(self, values):
+        return np.array([self.id(value) for value in values], dtype="int32")
+
+    def decode(self, identifiers):
+        return tuple([self._values[identifier] for identifier in identifiers])
+
+    def encode_sequence(self, word_pos_sequence):
+        # A sequence of (word, pos) pairs as an int32 array of shape (len(sequence), 2).
+        return np.array([(self.id(word_pos[0]), self.id(word_pos[1])) for word_pos in word_pos_sequence], dtype="int32").reshape((-1, 2))
+
+    def decode_sequence(self, identifiers):
+        return [(self._values[word], self._values[pos]) for word, pos in identifiers.tolist()]
+
+    def decode_words(self, identifiers):
+        # Just the words of an encoded sequence.
+        return self.decode(identifiers[:, 0])
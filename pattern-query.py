@@ -25,7 +25,7 @@ def main():
     setup_logging(".%s.log" % os.path.splitext(os.path.basename(__file__))[0], aargs.verbose, False, True, True)
     logging.debug(aargs)
 
-    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir)
+    lstm = sequential.load_model(aargs.data_dir, aargs.sequential_dir, inference=True)
     query_engine = domain.QueryEngine(lstm, "moot", "postgres")
 
     predicates = Predicates(predicate_strs=aargs.predicate)
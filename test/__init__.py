@@ -4,9 +4,20 @@
 from pytils.invigilator import create_suite
 
 
+from test import batching
+from test import columnar
 from test import geometry
+from test import inference
 from test import mlbase
+from test import mlmodel
 from test import monotonic_paths
+from test import parallel
+from test import pickler
+from test import pool
+from test import prefixes
+from test import rnn
+from test import states
+from test import vocabulary
 
 
 def all():
@@ -15,8 +26,19 @@ def all():
 
 def unit():
     return [
+        batching.tests(),
+        columnar.tests(),
         geometry.tests(),
+        inference.tests(),
         mlbase.tests(),
+        mlmodel.tests(),
         monotonic_paths.tests(),
+        parallel.tests(),
+        pickler.tests(),
+        pool.tests(),
+        prefixes.tests(),
+        rnn.tests(),
+        states.tests(),
+        vocabulary.tests(),
     ]
 
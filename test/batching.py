@@ -0,0 +1,117 @@
+import logging
+import numpy as np
+import threading
+import time
+from unittest import TestCase
+
+from ml import model
+from nnwd import batching
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+class FakeModel:
+    # Treats its inputs as the output distributions themselves.
+    def __init__(self):
+        self.scope = "fake"
+        self.calls = 0
+
+    def predict_top_k(self, inputs, cases, k):
+        self.calls += 1
+        return model.top_k(inputs, k)
+
+
+class Tests(TestCase):
+    def test_micro_batcher(self):
+        batches = []
+
+        def run_batch(calls):
+            batches.append(calls)
+            return [call * 2 for call in calls]
+
+        batcher = batching.MicroBatcher(run_batch, 4, 0.05)
+        results = {}
+
+        def submit(i):
+            results[i] = batcher.submit("key", i)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(10)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {i: i * 2 for i in range(10)})
+        self.assertEqual(batcher.calls, 10)
+        self.assertLess(batcher.batches, 10)
+        self.assertLessEqual(max([len(batch) for batch in batches]), 4)
+
+    def test_micro_batcher_keys(self):
+        batches = []
+
+        def run_batch(calls):
+            batches.append(calls)
+            # Notice, the calls of a batch all share the same key.
+            self.assertEqual(len(set([call[0] for call in calls])), 1)
+            return [call[1] for call in calls]
+
+        batcher = batching.MicroBatcher(run_batch, 8, 0.05)
+        results = {}
+
+        def submit(i):
+            results[i] = batcher.submit(i % 2, (i % 2, i))
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(10)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {i: i for i in range(10)})
+
+    def test_micro_batcher_error(self):
+        def run_batch(calls):
+            raise ValueError("bad batch")
+
+        batcher = batching.MicroBatcher(run_batch, 4, 0)
+
+        with self.assertRaises(ValueError):
+            batcher.submit("key", 1)
+
+        # The batcher continues working after a failed batch.
+        with self.assertRaises(ValueError):
+            batcher.submit("key", 2)
+
+    def test_batching_model_predict_top_k(self):
+        fake = FakeModel()
+        batching_model = batching.BatchingModel(fake, 8, 0.05)
+        distributions = np.random.dirichlet([1.0] * 6, size=10).astype("float32")
+        results = {}
+
+        def predict(i):
+            results[i] = batching_model.predict_top_k(distributions[i:i + 2], np.array([0, 0]), 3)
+
+        threads = [threading.Thread(target=predict, args=(i,)) for i in range(0, 10, 2)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(fake.calls, 5)
+
+        for i, (indices, probabilities) in results.items():
+            self.assertEqual(indices.shape, (2, 3))
+
+            for j in range(2):
+                expected = np.argsort(-distributions[i + j], kind="stable")[:3]
+                self.assertEqual(list(indices[j]), list(expected))
+                self.assertTrue(np.allclose(probabilities[j], distributions[i + j][expected]))
@@ -0,0 +1,100 @@
+
+import logging
+import numpy as np
+import os
+import queue
+import tempfile
+import time
+from unittest import TestCase
+
+from nnwd import columnar
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+FIELDS = [("word", columnar.INTERNED), ("point", columnar.POINT), ("index", columnar.INTEGER)]
+
+
+class Tests(TestCase):
+    def test_round_trip(self):
+        rows = [("the", (0.5, 1.0, -1.0), 0), ("little", (0.25, 0.0, 2.0), 1), ("the", (1.5, -0.5, 0.0), 2)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            columnar.dump(rows, dir_path, FIELDS)
+            self.assertTrue(columnar.exists(dir_path))
+            columns = columnar.load(dir_path)
+            self.assertEqual(len(columns), 3)
+            self.assertEqual(columns.points.shape, (3, 3))
+            self.assertEqual(columns.points.dtype, np.float32)
+            self.assertEqual(columns.vocabulary("word"), ["the", "little"])
+            self.assertEqual(columns.array("word").tolist(), [0, 1, 0])
+            self.assertEqual([(row[0], tuple(row[1]), row[2]) for row in columns], rows)
+            self.assertEqual(columns[-1][0], "the")
+            self.assertEqual(tuple(columns[1][1]), (0.25, 0.0, 2.0))
+
+    def test_view(self):
+        rows = [("the", (0.5, 1.0, -1.0, 3.0), 0), ("little", (0.25, 0.0, 2.0, 4.0), 1)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            columnar.dump(rows, dir_path, FIELDS, metadata={"layout": [["a", 0, 1], ["b", 1, 3]]})
+            columns = columnar.load(dir_path)
+            self.assertEqual(columns.metadata, {"layout": [["a", 0, 1], ["b", 1, 3]]})
+            view = columns.view(1, 4, lambda row: (row[0], tuple(row[1])))
+            self.assertEqual(view.width, 3)
+            self.assertEqual(view.points.tolist(), [[1.0, -1.0, 3.0], [0.0, 2.0, 4.0]])
+            self.assertEqual([row for row in view], [("the", (1.0, -1.0, 3.0)), ("little", (0.0, 2.0, 4.0))])
+            self.assertEqual(columns.view(0, 1)[1][1].tolist(), [0.25])
+            self.assertEqual(view.view(1, 2).points.tolist(), [[-1.0], [2.0]])
+
+    def test_stream(self):
+        data = queue.Queue()
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            columnar.dump(data, dir_path, FIELDS, converter=lambda item: (item[0], item[1], item[2]))
+
+            for i in range(columnar.FLUSH_SIZE + 5):
+                data.put(("w%d" % (i % 7), (float(i), 0.0), i))
+
+            data.put(None)
+
+            # Wait for the writer thread, failing rather than hanging should it never finish.
+            deadline = time.time() + 30
+
+            while not columnar.exists(dir_path):
+                self.assertLess(time.time(), deadline, "timed out waiting for the columnar stream")
+                time.sleep(0.01)
+
+            columns = columnar.load(dir_path, converter=lambda item: item[2])
+            self.assertEqual(len(columns), columnar.FLUSH_SIZE + 5)
+            self.assertEqual([index for index in columns], [i for i in range(columnar.FLUSH_SIZE + 5)])
+            self.assertEqual(columns.points[-1, 0], float(columnar.FLUSH_SIZE + 4))
+
+    def test_sort(self):
+        fields = [("key", columnar.INTEGER64), ("word", columnar.INTERNED), ("point", columnar.POINT)]
+        rows = [(2 ** 40, "the", (1.0,)), (-5, "little", (2.0,)), (7, "the", (3.0,))]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            columnar.dump(rows, dir_path, fields)
+            self.assertIsNone(columnar.load(dir_path).sorted)
+            columnar.sort(dir_path, "key")
+            columns = columnar.load(dir_path)
+            self.assertEqual(columns.sorted, "key")
+            self.assertEqual(columns.array("key").dtype, np.int64)
+            self.assertEqual([(row[0], row[1], tuple(row[2])) for row in columns], sorted(rows))
+
+            with self.assertRaises(ValueError):
+                columnar.sort(dir_path, "point")
+
+    def test_empty(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            columnar.dump([], dir_path, FIELDS)
+            columns = columnar.load(dir_path)
+            self.assertEqual(len(columns), 0)
+            self.assertEqual([row for row in columns], [])
+
+    def test_not_found(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.assertIsNone(columnar.load(os.path.join(dir_path, "missing"), allow_not_found=True))
@@ -0,0 +1,144 @@
+import logging
+import numpy as np
+import os
+import tensorflow as tf
+from unittest import TestCase
+
+from ml import base as mlbase
+from nnwd import inference
+from nnwd import rnn
+from nnwd import sequential
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+WORDS = mlbase.Labels(set(["the", "little", "prince", "was", "is", mlbase.BLANK]), unknown="<unknown>")
+SEQUENCE = ["the", "little", "prince", "is", "zebra"]
+
+
+def lstms(hyper_parameters, ablations, inference_only=False):
+    with tf.Graph().as_default():
+        lstm = rnn.LstmLm(hyper_parameters, ablations, WORDS, False, inference_only)
+
+    return lstm, inference.NumpyLstm(lstm)
+
+
+class Tests(TestCase):
+    def test_stepwise(self):
+        for hyper_parameters, ablations in [(sequential.HyperParameters(2, 6, 6), sequential.Ablations()),
+                (sequential.HyperParameters(2, 6, 4), sequential.Ablations()),
+                (sequential.HyperParameters(1, 5, 5), sequential.Ablations(srnn=True)),
+                (sequential.HyperParameters(3, 5, 7), sequential.Ablations(srnn=True, out=True))]:
+            lstm, numpy_lstm = lstms(hyper_parameters, ablations)
+            stepwise_tf = lstm.stepwise(handle_unknown=True)
+            stepwise_np = numpy_lstm.stepwise(handle_unknown=True)
+
+            for word in SEQUENCE:
+                result_tf, instruments_tf = stepwise_tf.step(word, rnn.LSTM_INSTRUMENTS + ["ws"])
+                result_np, instruments_np = stepwise_np.step(word, rnn.LSTM_INSTRUMENTS + ["ws"])
+                self.assertEqual(result_np.prediction, result_tf.prediction)
+
+                for output, probability in result_tf.distribution.items():
+                    self.assertTrue(np.isclose(result_np.distribution[output], probability, atol=1e-5), output)
+
+                for name in rnn.LSTM_INSTRUMENTS + ["ws"]:
+                    self.assertEqual(instruments_np[name].shape, instruments_tf[name].shape, name)
+                    self.assertTrue(np.allclose(instruments_np[name], instruments_tf[name], atol=1e-5), name)
+
+            self.assertTrue(np.allclose(stepwise_np.state, stepwise_tf.state, atol=1e-5))
+
+    def test_evaluate_sequence(self):
+        lstm, numpy_lstm = lstms(sequential.HyperParameters(2, 6, 4), sequential.Ablations())
+        result_tf, instruments_tf = lstm.evaluate_sequence(SEQUENCE, True, rnn.LSTM_INSTRUMENTS + ["ws"])
+        result_np, instruments_np = numpy_lstm.evaluate_sequence(SEQUENCE, True, rnn.LSTM_INSTRUMENTS + ["ws"])
+        self.assertEqual(result_np.prediction, result_tf.prediction)
+
+        for name in rnn.LSTM_INSTRUMENTS + ["ws"]:
+            self.assertTrue(np.allclose(instruments_np[name], instruments_tf[name], atol=1e-5), name)
+
+        # The soft filters, directly from their definition.
+        timestep_instruments = numpy_lstm.evaluate_batch_instrumented([SEQUENCE], True, ["remember_gates", "forget_gates"])[0]
+        self.assertEqual(len(instruments_tf["ws"]), len(SEQUENCE))
+
+        for t in range(len(SEQUENCE)):
+            w = timestep_instruments[t]["remember_gates"]
+
+            for later in range(t + 1, len(SEQUENCE)):
+                w = w * timestep_instruments[later]["forget_gates"]
+
+            self.assertTrue(np.allclose(instruments_tf["ws"][t], w, atol=1e-5), t)
+
+    def test_evaluate_batch_instrumented(self):
+        lstm, numpy_lstm = lstms(sequential.HyperParameters(2, 6, 4), sequential.Ablations())
+        sequences = [SEQUENCE, SEQUENCE[:2], ["prince"]]
+        batch_tf = lstm.evaluate_batch_instrumented(sequences, True, rnn.LSTM_INSTRUMENTS)
+        batch_np = numpy_lstm.evaluate_batch_instrumented(sequences, True, rnn.LSTM_INSTRUMENTS)
+        self.assertEqual([len(timesteps) for timesteps in batch_np], [len(sequence) for sequence in sequences])
+        stepwise_np = numpy_lstm.stepwise(handle_unknown=True)
+
+        for t, word in enumerate(SEQUENCE):
+            result, instruments = stepwise_np.step(word, rnn.LSTM_INSTRUMENTS)
+
+            for part, layer in lstm.part_layers():
+                self.assertTrue(np.allclose(batch_np[0][t][part][layer], batch_tf[0][t][part][layer], atol=1e-5), (t, part, layer))
+                # The batched instruments are the same as those of stepping through the sequence.
+                self.assertTrue(np.allclose(batch_np[0][t][part][layer], instruments[part][layer], atol=1e-5), (t, part, layer))
+
+    def test_evaluate_batch(self):
+        lstm, numpy_lstm = lstms(sequential.HyperParameters(2, 6, 4), sequential.Ablations())
+        _, state, _ = lstm.evaluate("the", True)
+        xs = ["little", "prince", "zebra"]
+        states = [None, state, state]
+
+        for model in [lstm, numpy_lstm]:
+            batch = model.evaluate_batch(xs, True, states, rnn.LSTM_INSTRUMENTS + ["ws"])
+            self.assertEqual(len(batch), len(xs))
+
+            # Each is the same as evaluating it on its own.
+            for x, state, (result, next_state, instruments) in zip(xs, states, batch):
+                expected_result, expected_state, expected_instruments = lstm.evaluate(x, True, state, rnn.LSTM_INSTRUMENTS + ["ws"])
+                self.assertEqual(result.prediction, expected_result.prediction)
+                self.assertTrue(np.allclose(next_state, expected_state, atol=1e-5))
+
+                for name in rnn.LSTM_INSTRUMENTS + ["ws"]:
+                    self.assertEqual(instruments[name].shape, expected_instruments[name].shape, name)
+                    self.assertTrue(np.allclose(instruments[name], expected_instruments[name], atol=1e-5), name)
+
+    def test_probe(self):
+        lstm, numpy_lstm = lstms(sequential.HyperParameters(2, 6, 4), sequential.Ablations())
+
+        for name in ["R", "F", "O", "H", "R_bias", "F_bias", "O_bias", "H_bias"]:
+            for layer in range(2):
+                self.assertTrue(np.allclose(numpy_lstm.probe(name, layer), lstm.probe(name, layer)), name)
+
+        self.assertTrue(np.allclose(numpy_lstm.probe("Y", None), lstm.probe("Y", None)))
+        self.assertTrue(np.allclose(numpy_lstm.probe("Y_bias", None), lstm.probe("Y_bias", None)))
+        self.assertTrue(np.allclose(numpy_lstm.embed("prince"), lstm.embed("prince")))
+
+    def test_inference_only(self):
+        lstm, numpy_lstm = lstms(sequential.HyperParameters(2, 6, 4), sequential.Ablations(), True)
+        self.assertFalse(hasattr(lstm, "cost"))
+        self.assertFalse(hasattr(lstm, "updates"))
+
+        with self.assertRaises(ValueError):
+            lstm.train([mlbase.Xy([("the", None)], [("little", None)])], mlbase.TrainingParameters())
+
+        result_tf, instruments_tf = lstm.evaluate_sequence(SEQUENCE, True, rnn.LSTM_INSTRUMENTS)
+        result_np, instruments_np = numpy_lstm.evaluate_sequence(SEQUENCE, True, rnn.LSTM_INSTRUMENTS)
+        self.assertEqual(result_np.prediction, result_tf.prediction)
+
+        for name in rnn.LSTM_INSTRUMENTS:
+            self.assertTrue(np.allclose(instruments_np[name], instruments_tf[name], atol=1e-5), name)
+
+    def test_top_k(self):
+        array = np.array([0.05, 0.4, 0.1, 0.3, 0.15], dtype="float32")
+        labels = mlbase.Labels(set(["a", "b", "c", "d", "e"]))
+        result = rnn.TopKResult(labels, array)
+        self.assertEqual(result.prediction, "b")
+        self.assertEqual(list(result.top_k(3).keys()), ["b", "d", "e"])
+        self.assertEqual(list(result.top_k(10).keys()), ["b", "d", "e", "c", "a"])
+        self.assertTrue(np.isclose(result.top_k(1)["b"], 0.4))
+        self.assertEqual(result.distribution, labels.vector_decode_distribution(array))
@@ -144,3 +144,47 @@ class Tests(TestCase):
 
         self.assertEqual(tp.finished(1, losses), (True, "degradation"), losses)
 
+
+    def test_prefetch_feeds(self):
+        batches = [[i, i + 1] for i in range(0, 20, 2)]
+
+        for prefetch in [0, 1, 3]:
+            statistics = base.FeedStatistics()
+            feeds = [batch_feed for batch_feed in base.prefetch_feeds(batches, lambda batch: sum(batch), prefetch, statistics)]
+            self.assertEqual(feeds, [(batch, sum(batch)) for batch in batches])
+            self.assertEqual(statistics.feeds, len(batches))
+
+    def test_prefetched(self):
+        # Any value may be prefetched, including None and exceptions.
+        values = [0, None, ValueError("a value"), "three"]
+        self.assertEqual([str(value) for value in base.prefetched(iter(values), 2)], [str(value) for value in values])
+
+        def failing():
+            yield 1
+            raise ValueError("bad value")
+
+        prefetched = base.prefetched(failing(), 1)
+        self.assertEqual(next(prefetched), 1)
+
+        with self.assertRaises(ValueError):
+            next(prefetched)
+
+    def test_prefetch_feeds_error(self):
+        def feed_fn(batch):
+            if batch == 3:
+                raise ValueError("bad batch")
+
+            return batch
+
+        feeds = base.prefetch_feeds(range(5), feed_fn, 2)
+        self.assertEqual(next(feeds), (0, 0))
+
+        with self.assertRaises(ValueError):
+            for batch_feed in feeds:
+                pass
+
+    def test_prefetch_feeds_abandoned(self):
+        feeds = base.prefetch_feeds(range(100), lambda batch: batch, 1)
+        self.assertEqual([next(feeds) for i in range(5)], [(i, i) for i in range(5)])
+        # Closing the feeds early must release the background producer.
+        feeds.close()
@@ -0,0 +1,91 @@
+import logging
+import numpy as np
+import tensorflow as tf
+from unittest import TestCase
+
+from ml import base as mlbase
+from ml import model
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+CASES = mlbase.Labels(set(["a", "b", "c", "d"]))
+OUTPUTS = mlbase.Labels(set(["x", "y", "z"]))
+WIDTH = 5
+NAMES = ["E", "E_bias", "H", "H_bias", "Y", "Y_bias"]
+
+
+def separate_ffnn(layers):
+    with tf.Graph().as_default():
+        ffnn = model.SeparateFfnn("separate", model.HyperParameters(layers, 4), {}, mlbase.VectorField(WIDTH), OUTPUTS, CASES)
+
+    # Random biases too, so that a bias from the wrong case would show.
+    random = np.random.RandomState(layers)
+
+    for name in variable_names(ffnn):
+        variable = getattr(ffnn, name)
+        variable.load(random.normal(size=variable.shape.as_list()).astype("float32"), ffnn.session)
+
+    return ffnn
+
+
+def variable_names(ffnn):
+    return [name for name in NAMES if hasattr(ffnn, name)]
+
+
+def loop_logits(ffnn, inputs, cases):
+    # The logits of each instance with its own case's weights, as they were looked up per instance before being grouped.
+    values = {name: ffnn.session.run(getattr(ffnn, name)) for name in variable_names(ffnn)}
+    logits = []
+
+    for x, case in zip(inputs, cases):
+        hidden = x
+
+        if ffnn.hyper_parameters.layers > 0:
+            hidden = np.tanh(np.matmul(hidden, values["E"][case]) + values["E_bias"][case][0])
+
+            for l in range(ffnn.hyper_parameters.layers - 1):
+                hidden = np.tanh(np.matmul(hidden, values["H"][case][l]) + values["H_bias"][case][l][0])
+
+        logits += [np.matmul(hidden, values["Y"][case]) + values["Y_bias"][case][0]]
+
+    return np.array(logits)
+
+
+class Tests(TestCase):
+    def test_separate_ffnn(self):
+        random = np.random.RandomState(1)
+        # Interleaved cases, with case 1 missing from the first batch and all but case 3 missing from the second.
+        for cases in [[2, 0, 2, 3, 0, 2, 3], [3], [3, 3, 3]]:
+            inputs = random.normal(size=[len(cases), WIDTH]).astype("float32")
+
+            for layers in [0, 1, 3]:
+                ffnn = separate_ffnn(layers)
+                logits = ffnn.session.run(ffnn.output_logit, feed_dict=ffnn.get_prediction_feed(inputs, cases))
+                # Each row is the instance's own, in the original (not grouped by case) order.
+                self.assertTrue(np.allclose(logits, loop_logits(ffnn, inputs, cases), atol=1e-5), (cases, layers))
+
+    def test_separate_ffnn_cost(self):
+        random = np.random.RandomState(2)
+        cases = [2, 0, 2, 3, 0, 2, 3]
+        inputs = random.normal(size=[len(cases), WIDTH]).astype("float32")
+        outputs = random.randint(0, len(OUTPUTS), size=len(cases))
+        ffnn = separate_ffnn(2)
+        feed = ffnn.get_prediction_feed(inputs, cases)
+        feed[ffnn.output_p] = outputs
+
+        with ffnn.session.graph.as_default():
+            Y_gradient = tf.convert_to_tensor(tf.gradients(ffnn.cost, ffnn.Y)[0])
+
+        cost, Y_gradient = ffnn.session.run([ffnn.cost, Y_gradient], feed_dict=feed)
+        logits = loop_logits(ffnn, inputs, cases)
+        log_distributions = logits - np.log(np.sum(np.exp(logits), axis=-1, keepdims=True))
+        self.assertAlmostEqual(cost, -np.sum(log_distributions[np.arange(len(cases)), outputs]), places=3)
+        # Only the cases in the batch are trained.
+        self.assertTrue(np.all(Y_gradient[1] == 0))
+
+        for case in [0, 2, 3]:
+            self.assertTrue(np.any(Y_gradient[case] != 0), case)
@@ -0,0 +1,85 @@
+import logging
+import multiprocessing
+import numpy as np
+import threading
+from unittest import TestCase
+
+from ml import base as mlbase
+from nnwd import parallel
+from pytils.invigilator import create_suite
+from test import rnn as rnn_tests
+
+
+def tests():
+    return create_suite(Tests)
+
+
+def replicas(count):
+    # Lstms (each with their own graph) which all start from the same parameters.
+    lstms = [rnn_tests.lstm_lm() for i in range(count)]
+    variables = lstms[0].get_variables()
+
+    for lstm in lstms[1:]:
+        lstm.set_variables(variables)
+
+    return lstms
+
+
+class Tests(TestCase):
+    def assert_variables(self, expected, actual):
+        for expected_value, actual_value in zip(expected.get_variables(), actual.get_variables()):
+            self.assertTrue(np.allclose(expected_value, actual_value, atol=1e-6), (expected_value, actual_value))
+
+    def test_combine(self):
+        # A large norm (so nothing is clipped) and a small one (so everything is).
+        for clip_norm in [1000.0, 0.01]:
+            training_parameters = mlbase.TrainingParameters().dropout_rate(0).learning_rate(0.1).clip_norm(clip_norm)
+            single, combined, worker_a, worker_b = replicas(4)
+            encoded = single.encode(rnn_tests.lm_xys())
+            single.session.run(single.updates, feed_dict=single.get_training_feed(encoded.batch(0, len(encoded)), training_parameters))
+            # Unevenly split, as the last step of an epoch may be.
+            loss_a, gradients_a = worker_a.compute_gradients(encoded.batch(0, 2), training_parameters)
+            loss_b, gradients_b = worker_b.compute_gradients(encoded.batch(2, len(encoded)), training_parameters)
+            combined.apply_gradients(parallel.combine([gradients_a, gradients_b]), training_parameters)
+            self.assert_variables(single, combined)
+            # The step actually moved the parameters.
+            self.assertFalse(all([np.allclose(a, b) for a, b in zip(single.get_variables(), worker_a.get_variables())]))
+
+    def test_serve(self):
+        training_parameters = mlbase.TrainingParameters().dropout_rate(0).batch(4)
+        lstm, worker = replicas(2)
+        encoded = lstm.encode(rnn_tests.lm_xys())
+        connection, worker_connection = multiprocessing.Pipe()
+        thread = threading.Thread(target=parallel._serve, args=(worker_connection, worker))
+        thread.start()
+        connection.send(("shard", encoded.xys))
+        connection.send(("variables", lstm.get_variables()))
+        connection.send(("epoch", (2, training_parameters)))
+
+        # The worker steps through its shard from the offset, in sync with the lstm it mirrors.
+        for start, end in [(0, 2), (2, 6)]:
+            connection.send(("gradients", None))
+            batch_count, loss, gradients = connection.recv()
+            self.assertEqual(batch_count, end - start)
+            expected_loss, expected_gradients = lstm.compute_gradients(encoded.batch(start, end), training_parameters)
+            self.assertAlmostEqual(loss, expected_loss, places=5)
+
+            for expected_gradient, gradient in zip(expected_gradients, gradients):
+                self.assertTrue(np.allclose(expected_gradient, gradient, atol=1e-6))
+
+            connection.send(("apply", gradients))
+            lstm.apply_gradients(gradients, training_parameters)
+
+        connection.send(("gradients", None))
+        self.assertEqual(connection.recv(), (0, None, None))
+        connection.send(("stop", None))
+        thread.join()
+        self.assert_variables(lstm, worker)
+
+    def test_single_process_rate(self):
+        training_parameters = mlbase.TrainingParameters().dropout_rate(0).batch(2)
+        lstm, reference = replicas(2)
+        encoded = lstm.encode(rnn_tests.lm_xys())
+        self.assertGreater(parallel.single_process_rate(lstm, encoded, training_parameters), 0)
+        # The timed steps are real training steps, but they are undone.
+        self.assert_variables(reference, lstm)
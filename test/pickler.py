@@ -0,0 +1,273 @@
+
+import logging
+import numpy as np
+import os
+import queue
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from nnwd import pickler
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+class Tests(TestCase):
+    def dump_sharded(self, data, dir_path, out_of_band=False):
+        # Force several small shards, rather than a single 100 MB one.
+        previous = pickler.TARGET_FILE_SIZE
+        pickler.TARGET_FILE_SIZE = 1
+
+        try:
+            pickler.dump(data, dir_path, out_of_band=out_of_band)
+        finally:
+            pickler.TARGET_FILE_SIZE = previous
+
+    def test_manifest(self):
+        data = [i for i in range(10)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.dump_sharded(data, dir_path)
+            shards = pickler.open(dir_path)
+            self.assertEqual(len(shards), 10)
+            self.assertEqual(sum(shards.counts()), 10)
+            self.assertTrue(len(shards.counts()) > 1)
+            self.assertEqual([item for item in pickler.load(dir_path)], data)
+
+    def test_start_stop(self):
+        data = [i for i in range(10)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.dump_sharded(data, dir_path)
+            self.assertEqual([item for item in pickler.load(dir_path, start=3)], data[3:])
+            self.assertEqual([item for item in pickler.load(dir_path, start=3, stop=7)], data[3:7])
+            self.assertEqual([item for item in pickler.load(dir_path, stop=0)], [])
+            self.assertEqual([item for item in pickler.load(dir_path, start=20)], [])
+            self.assertEqual([item for item in pickler.load(dir_path, start=2, converter=lambda item: item * 2)], [i * 2 for i in data[2:]])
+
+    def test_random_access(self):
+        data = ["item-%d" % i for i in range(25)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.dump_sharded(data, dir_path)
+            shards = pickler.open(dir_path)
+
+            for i in [0, 24, 7, 8, 3, 15]:
+                self.assertEqual(shards[i], data[i])
+
+            self.assertEqual(shards[-1], data[-1])
+            self.assertEqual([item for item in shards], data)
+
+            with self.assertRaises(IndexError):
+                shards[25]
+
+    def test_no_manifest(self):
+        data = [i for i in range(10)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.dump_sharded(data, dir_path)
+            os.remove(os.path.join(dir_path, pickler.MANIFEST))
+            self.assertEqual([item for item in pickler.load(dir_path, start=4)], data[4:])
+            self.assertEqual(pickler.open(dir_path)[5], 5)
+
+    def test_out_of_band(self):
+        data = [("word-%d" % i, np.arange(i, i + 5, dtype="float32")) for i in range(10)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.dump_sharded(data, dir_path, out_of_band=True)
+            loaded = [item for item in pickler.load(dir_path, start=2)]
+            self.assertEqual(len(loaded), 8)
+
+            for expected, actual in zip(data[2:], loaded):
+                self.assertEqual(actual[0], expected[0])
+                self.assertEqual(actual[1].dtype, np.float32)
+                self.assertTrue(np.array_equal(actual[1], expected[1]))
+                # A view over the mapped buffers, rather than a copy.
+                self.assertFalse(actual[1].flags.writeable)
+
+            self.assertTrue(np.array_equal(pickler.open(dir_path)[7][1], data[7][1]))
+
+    def test_stale_buffers(self):
+        data = [("word-%d" % i, i) for i in range(10)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            # A buffers file left behind by an earlier (ex: interrupted) write.
+            with open(os.path.join(dir_path, "0" + pickler.BUFFERS_EXTENSION), "wb") as fh:
+                fh.write(b"stale")
+
+            pickler.dump(data, dir_path)
+            self.assertEqual([item for item in pickler.load(dir_path)], data)
+            self.assertEqual(pickler.open(dir_path)[3], data[3])
+
+    def test_codecs(self):
+        data = [("word-%d" % i, np.arange(i, i + 5, dtype="float32") / 3.0) for i in range(20)]
+
+        for codec in pickler.CODECS:
+            for out_of_band in [False, True]:
+                with tempfile.TemporaryDirectory() as dir_path:
+                    previous = pickler.TARGET_FILE_SIZE
+                    pickler.TARGET_FILE_SIZE = 1
+
+                    try:
+                        pickler.dump(data, dir_path, out_of_band=out_of_band, codec=codec)
+                    finally:
+                        pickler.TARGET_FILE_SIZE = previous
+
+                    loaded = [item for item in pickler.load(dir_path, start=5)]
+                    self.assertEqual([item[0] for item in loaded], [item[0] for item in data[5:]])
+
+                    for expected, actual in zip(data[5:], loaded):
+                        self.assertTrue(np.array_equal(actual[1], expected[1]), "%s %s" % (codec, out_of_band))
+
+                    self.assertTrue(np.array_equal(pickler.open(dir_path)[13][1], data[13][1]))
+
+    def test_shuffle(self):
+        buffer = memoryview(np.arange(7, dtype="float64"))
+        shuffled = pickler._shuffle(memoryview(buffer.tobytes()), 8)
+        self.assertNotEqual(shuffled, buffer.tobytes())
+        self.assertEqual(bytes(pickler._unshuffle(shuffled, 8)), buffer.tobytes())
+
+    def test_out_of_band_empty(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            pickler.dump([], dir_path, out_of_band=True)
+            self.assertEqual([item for item in pickler.load(dir_path)], [])
+
+    def test_stream(self):
+        data = queue.Queue()
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            pickler.dump(data, dir_path)
+
+            for i in range(100):
+                data.put(i)
+
+            data.put(None)
+
+            while not pickler.complete(dir_path):
+                pass
+
+            self.assertEqual([item for item in pickler.load(dir_path, start=50)], [i for i in range(50, 100)])
+
+    def test_incomplete(self):
+        data = [i for i in range(10)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.dump_sharded(data, dir_path)
+            shards = pickler.open(dir_path).shards
+            # As if the writer were interrupted after the first 2 shards.
+            pickler._write_manifest(dir_path, shards[:2], False)
+            self.assertFalse(pickler.complete(dir_path))
+
+            with self.assertRaises(ValueError):
+                pickler.load(dir_path)
+
+            self.assertEqual([item for item in pickler.load(dir_path, allow_incomplete=True)], data[:sum([shard["items"] for shard in shards[:2]])])
+            self.assertEqual(os.listdir(dir_path).count(pickler.MANIFEST + pickler.TEMPORARY_EXTENSION), 0)
+
+    def stream_marked(self, dir_path, positions, append):
+        data = pickler.StreamQueue()
+        pickler.dump(data, dir_path, append=append)
+        data.put(pickler.Mark(positions[0]))
+
+        for position in positions:
+            for i in range(3):
+                data.put((position, i))
+
+            data.put(pickler.Mark(position + 1))
+
+        data.put(None)
+
+        while not pickler.complete(dir_path) or pickler.committed(dir_path) != positions[-1] + 1:
+            pass
+
+    def test_append(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.assertIsNone(pickler.committed(dir_path))
+            self.stream_marked(dir_path, [0, 1, 2, 3, 4], False)
+            self.assertEqual(pickler.committed(dir_path), 5)
+            # Resuming from an earlier position drops the items already committed.
+            self.stream_marked(dir_path, [3, 4, 5, 6, 7], True)
+            self.assertEqual(pickler.committed(dir_path), 8)
+            self.assertEqual([item for item in pickler.load(dir_path)], [(position, i) for position in range(8) for i in range(3)])
+            self.assertTrue(len(pickler.open(dir_path).counts()) > 1)
+
+    def test_prefetch(self):
+        data = [i for i in range(50)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.dump_sharded(data, dir_path)
+            statistics = pickler.Statistics()
+            self.assertEqual([item for item in pickler.load(dir_path, prefetch=2, statistics=statistics)], data)
+            self.assertEqual(statistics.items, 50)
+            self.assertEqual(statistics.shards, len(pickler.open(dir_path).counts()))
+            self.assertEqual([item for item in pickler.load(dir_path, start=10, stop=20, prefetch=3)], data[10:20])
+
+    def test_prefetch_abandoned(self):
+        data = [i for i in range(50)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            self.dump_sharded(data, dir_path)
+            stream = pickler.load(dir_path, prefetch=1)
+            self.assertEqual([next(stream) for i in range(5)], data[:5])
+            # Closing the stream early must release the background loader.
+            stream.close()
+
+    def test_stream_queue(self):
+        data = pickler.StreamQueue()
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            pickler.dump(data, dir_path)
+
+            for i in range(pickler.STREAM_MAX_BATCH * 3):
+                data.put(("word-%d" % i, tuple([float(i)] * 10)))
+
+            data.put(None)
+
+            while data.written_items < pickler.STREAM_MAX_BATCH * 3:
+                pass
+
+            self.assertEqual(data.depth(), 0)
+            self.assertTrue(data.in_flight < 1e-6, data.in_flight)
+            self.assertTrue(data.written_bytes > 0)
+            self.assertEqual(len([item for item in pickler.load(dir_path)]), pickler.STREAM_MAX_BATCH * 3)
+
+    def test_stream_queue_budget(self):
+        data = pickler.StreamQueue(2 * pickler.STREAM_TARGET_FILE_SIZE)
+        data.put("x" * (2 * pickler.STREAM_TARGET_FILE_SIZE))
+        # The next item is over budget, so it can only be put once the first has been written.
+        releaser = threading.Timer(0.1, lambda: data.written(1, 10))
+        releaser.start()
+        data.put("y")
+        self.assertEqual(data.written_items, 1)
+        self.assertTrue(data.blocked_seconds > 0)
+
+    def test_stream_queue_converted(self):
+        data = pickler.StreamQueue(2 * pickler.STREAM_TARGET_FILE_SIZE)
+        # Items much larger than they're written at - budgeted at their raw size, these would fill the queue before a shard is cut.
+        raw = "x" * (100 * 1024)
+        count = pickler.STREAM_MAX_BATCH * 2
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            pickler.dump(data, dir_path, converter=lambda item: item[1])
+
+            def produce():
+                for i in range(count):
+                    data.put((raw, i))
+
+                data.put(None)
+
+            producer = threading.Thread(target=produce)
+            producer.daemon = True
+            producer.start()
+            producer.join(30)
+            self.assertFalse(producer.is_alive())
+            deadline = time.time() + 30
+
+            while not pickler.complete(dir_path) and time.time() < deadline:
+                time.sleep(0.01)
+
+            self.assertEqual([item for item in pickler.load(dir_path)], [i for i in range(count)])
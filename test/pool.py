@@ -0,0 +1,67 @@
+import logging
+import tensorflow as tf
+import threading
+import time
+from unittest import TestCase
+
+from nnwd import pool
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+class FakeModel:
+    def __init__(self, name):
+        self.name = name
+        self.scope = "fake"
+        self.running = 0
+        self.maximum_running = 0
+
+    def evaluate(self, batch, handle_unknown=False):
+        self.running += 1
+        self.maximum_running = max(self.maximum_running, self.running)
+        time.sleep(0.01)
+        self.running -= 1
+        return self.name, None
+
+
+class Tests(TestCase):
+    def test_replicate(self):
+        graphs = pool.replicate(3, lambda: tf.get_default_graph())
+        self.assertEqual(len(set([id(graph) for graph in graphs])), 3)
+        self.assertNotIn(tf.get_default_graph(), graphs)
+
+    def test_session_config(self):
+        config = pool.session_config(2, 1)
+        self.assertEqual(config.intra_op_parallelism_threads, 2)
+        self.assertEqual(config.inter_op_parallelism_threads, 1)
+
+        with self.assertRaises(ValueError):
+            pool.session_config(-1, 0)
+
+    def test_model_pool(self):
+        replicas = [FakeModel("a"), FakeModel("b")]
+        model_pool = pool.ModelPool(replicas)
+        names = []
+
+        def request():
+            for i in range(5):
+                name, _ = model_pool.evaluate([])
+                names.append(name)
+
+        threads = [threading.Thread(target=request) for i in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(names), 20)
+        self.assertEqual(set(names), set(["a", "b"]))
+        # A replica is only ever handed to one request at a time.
+        self.assertEqual([replica.maximum_running for replica in replicas], [1, 1])
+        self.assertEqual(model_pool.requests, 20)
+        self.assertGreater(model_pool.waits, 0)
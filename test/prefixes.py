@@ -0,0 +1,180 @@
+import logging
+import numpy as np
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from nnwd import columnar
+from nnwd.prefixes import PrefixStore, PrefixTrie, prefix_hash, prefix_key
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+WIDTH = 4
+FIELDS = [("hash", columnar.INTEGER64), ("check", columnar.INTEGER64), ("length", columnar.INTEGER), ("point", columnar.POINT)]
+
+
+class FakeStepwise:
+    def __init__(self, name, state, runs):
+        self.name = name
+        self.state = state
+        self.runs = runs
+
+    def next_stepwise(self, x):
+        self.runs[x] = self.runs.get(x, 0) + 1
+        return FakeStepwise(self.name + "," + x, np.full([WIDTH], len(self.name), dtype="float32"), self.runs)
+
+
+def root(runs):
+    return FakeStepwise("root", None, runs)
+
+
+class Tests(TestCase):
+    def test_stepwise(self):
+        runs = {}
+        trie = PrefixTrie(root(runs))
+        self.assertEqual(trie.stepwise(()).name, "root")
+        self.assertEqual(trie.stepwise(("the", "little", "prince")).name, "root,the,little,prince")
+        self.assertEqual(runs, {"the": 1, "little": 1, "prince": 1})
+        self.assertEqual(trie.nodes, 3)
+        self.assertEqual(trie.bytes, 3 * WIDTH * 4)
+
+        # The common prefix is shared.
+        self.assertEqual(trie.stepwise(("the", "little", "fox")).name, "root,the,little,fox")
+        self.assertEqual(runs, {"the": 1, "little": 1, "prince": 1, "fox": 1})
+        self.assertEqual(trie.nodes, 4)
+
+        self.assertEqual(trie.stepwise(("the", "little")).name, "root,the,little")
+        self.assertEqual(runs, {"the": 1, "little": 1, "prince": 1, "fox": 1})
+        self.assertEqual((trie.hits, trie.misses, trie.evictions), (2, 2, 0))
+
+    def test_evict(self):
+        runs = {}
+        # Enough for 3 states.
+        trie = PrefixTrie(root(runs), 3 * WIDTH * 4)
+        trie.stepwise(("a", "b"))
+        trie.stepwise(("a", "c"))
+        self.assertEqual((trie.nodes, trie.evictions), (3, 0))
+
+        # Touch a,b - making a,c the least recently used leaf.
+        trie.stepwise(("a", "b"))
+        trie.stepwise(("a", "d"))
+        self.assertEqual((trie.nodes, trie.evictions), (3, 1))
+        self.assertEqual(trie.bytes, 3 * WIDTH * 4)
+        trie.stepwise(("a", "b"))
+        self.assertEqual(runs, {"a": 1, "b": 1, "c": 1, "d": 1})
+        trie.stepwise(("a", "c"))
+        self.assertEqual(runs, {"a": 1, "b": 1, "c": 2, "d": 1})
+
+        # Leaves are evicted before their parents.
+        trie.stepwise(("x", "y", "z"))
+        self.assertEqual(trie.nodes, 3)
+        self.assertEqual(trie.stepwise(("x", "y", "z")).name, "root,x,y,z")
+        self.assertEqual(runs, {"a": 1, "b": 1, "c": 2, "d": 1, "x": 1, "y": 1, "z": 1})
+
+    def test_evict_everything(self):
+        runs = {}
+        trie = PrefixTrie(root(runs), 0)
+        self.assertEqual(trie.stepwise(("a", "b")).name, "root,a,b")
+        self.assertEqual((trie.nodes, trie.bytes, trie.evictions), (0, 0, 2))
+        self.assertEqual(trie.stepwise(("a", "b")).name, "root,a,b")
+        self.assertEqual(runs, {"a": 2, "b": 2})
+
+    def test_threads(self):
+        runs = {}
+        trie = PrefixTrie(root(runs), 20 * WIDTH * 4)
+        sequences = [tuple(str(i) for i in range(j % 7)) + (str(j),) for j in range(50)]
+        errors = []
+
+        def query():
+            for sequence in sequences:
+                stepwise = trie.stepwise(sequence)
+
+                if stepwise.name != ",".join(("root",) + sequence):
+                    errors.append(stepwise.name)
+
+        threads = [threading.Thread(target=query) for i in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(trie.bytes, trie.max_bytes)
+        self.assertEqual(trie.hits + trie.misses, 4 * len(sequences))
+
+    def test_store(self):
+        parts = ["outputs", "cells"]
+        layers = 2
+        embedding_width = 3
+        sequences = [("the",), ("the", "little"), ("a",)]
+        rows = []
+
+        for i, sequence in enumerate(sequences):
+            state = np.arange(len(parts) * layers * WIDTH, dtype="float32") + (i * 100)
+            embedding = np.full([embedding_width], i, dtype="float32")
+            rows += [prefix_key(sequence) + (np.concatenate([state, embedding]),)]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            metadata = {"parts": parts, "layers": layers, "width": WIDTH, "embedding_width": embedding_width}
+            columnar.dump(rows, dir_path, FIELDS, metadata=metadata)
+
+            # The rows must be sorted by their hash.
+            with self.assertRaises(ValueError):
+                PrefixStore(columnar.load(dir_path))
+
+            columnar.sort(dir_path, "hash")
+            columns = columnar.load(dir_path)
+            self.assertEqual(columns.array("hash").tolist(), sorted([prefix_hash(sequence) for sequence in sequences]))
+            store = PrefixStore(columns)
+            self.assertEqual(len(store), 3)
+            self.assertIsNone(store.get(("the", "big"), ["cells"]))
+            self.assertIsNone(store.get(("zebra",), ["cells"]))
+
+            for i, sequence in enumerate(sequences):
+                state, instruments = store.get(sequence, ["embedding"])
+                self.assertEqual(instruments["embedding"].tolist(), [[i] * embedding_width], sequence)
+
+            # Unstored instruments can't be looked up.
+            self.assertIsNone(store.get(("the",), ["ws"]))
+
+            state, instruments = store.get(("the", "little"), ["embedding", "outputs", "cells"])
+            self.assertEqual(state.shape, (len(parts), layers, 1, WIDTH))
+            self.assertEqual(instruments["embedding"].tolist(), [[1, 1, 1]])
+            self.assertEqual(instruments["outputs"].tolist(), [[100 + v for v in range(WIDTH)], [100 + WIDTH + v for v in range(WIDTH)]])
+            self.assertEqual(instruments["cells"][1].tolist(), [100 + (3 * WIDTH) + v for v in range(WIDTH)])
+
+    def test_store_collisions(self):
+        metadata = {"parts": ["outputs"], "layers": 1, "width": WIDTH, "embedding_width": 1}
+        the_hash, the_check, the_length = prefix_key(("the",))
+        rows = [
+            # Other prefixes stored under the same hash (as if they had collided with "the").
+            (the_hash, prefix_key(("a",))[1], 1, np.full([WIDTH + 1], 1, dtype="float32")),
+            (the_hash, the_check, 2, np.full([WIDTH + 1], 2, dtype="float32")),
+            (the_hash, the_check, the_length, np.full([WIDTH + 1], 3, dtype="float32")),
+            (prefix_hash(("zebra",)), prefix_key(("a",))[1], 1, np.full([WIDTH + 1], 4, dtype="float32")),
+        ]
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            columnar.dump(rows, dir_path, FIELDS, metadata=metadata)
+            columnar.sort(dir_path, "hash")
+            store = PrefixStore(columnar.load(dir_path))
+            state, instruments = store.get(("the",), ["embedding"])
+            self.assertEqual(instruments["embedding"].tolist(), [[3]])
+            # A matching hash alone isn't enough.
+            self.assertIsNone(store.get(("zebra",), ["embedding"]))
+
+    def test_prefix_hash(self):
+        self.assertEqual(prefix_hash(("the", "little")), prefix_hash(["the", "little"]))
+        self.assertNotEqual(prefix_hash(("the", "little")), prefix_hash(("the little",)))
+        self.assertNotEqual(prefix_hash(("the",)), prefix_hash(("the", "")))
+        hash, check_hash, length = prefix_key(("the", "little"))
+        self.assertEqual(hash, prefix_hash(("the", "little")))
+        self.assertNotEqual(check_hash, hash)
+        self.assertEqual(length, 2)
@@ -0,0 +1,146 @@
+import logging
+import math
+import numpy as np
+import tensorflow as tf
+from unittest import TestCase
+
+from ml import base as mlbase
+from nnwd import rnn
+from nnwd import sequential
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+WORDS = mlbase.Labels(set(["the", "little", "prince", "was", "is", mlbase.BLANK]), unknown="<unknown>")
+SENTIMENTS = mlbase.Labels(set(["positive", "negative"]))
+SENTENCES = [["the", "little", "prince"], ["the"], ["was", "the", "zebra", "prince"], ["is", "little"], ["the", "prince"], ["prince", "was", "little"]]
+
+
+def lm_xys():
+    return [mlbase.Xy([(word, "NN") for word in sentence], [(word, "NN") for word in sentence[1:] + ["the"]]) for sentence in SENTENCES]
+
+
+def sa_xys():
+    return [mlbase.Xy([(word, "NN") for word in sentence], "positive" if i % 2 == 0 else "negative") for i, sentence in enumerate(SENTENCES)]
+
+
+def lstm_lm():
+    with tf.Graph().as_default():
+        return rnn.LstmLm(sequential.HyperParameters(1, 4, 4), sequential.Ablations(), WORDS, False)
+
+
+def lstm_sa():
+    with tf.Graph().as_default():
+        return rnn.LstmSa(sequential.HyperParameters(1, 4, 4), sequential.Ablations(), WORDS, SENTIMENTS, False)
+
+
+def time_major_feed(lstm, batch, y_is_sequence):
+    # The (input labels, input lengths, output labels) of a batch, as they were fed before the sequences were pre-encoded.
+    data_x, data_y = mlbase.as_time_major(batch, y_is_sequence)
+    input_labels = [[lstm.word_labels.encode(word_pos[0] if word_pos is not None else mlbase.BLANK, True) for word_pos in timespot] for timespot in data_x]
+    input_lengths = [len(sequence.x) for sequence in batch]
+
+    if y_is_sequence:
+        output_labels = [[lstm.word_labels.encode(word_pos[0] if word_pos is not None else mlbase.BLANK, True) for word_pos in timespot] for timespot in data_y]
+    else:
+        output_labels = [lstm.output_labels.encode(word if word is not None else mlbase.BLANK, True) for word in data_y]
+
+    return input_labels, input_lengths, output_labels
+
+
+def time_distributions(batch, labels):
+    # Random [time, batch, labels] distributions, including at the padded timesteps.
+    random = np.random.RandomState(len(batch))
+    logits = random.normal(size=[batch.inputs.shape[0], len(batch), len(labels)])
+    return (np.exp(logits) / np.sum(np.exp(logits), axis=-1, keepdims=True)).astype("float32")
+
+
+def loop_perplexity(lstm, batch, time_distributions):
+    # The (negated, total) perplexity, as scored case by case before it was vectorized.
+    input_lengths = [len(xy.x) for xy in batch.xys]
+    log_probabilities = [0.0 for case in range(len(batch))]
+
+    for timestep, distributions in enumerate(time_distributions):
+        for case, distribution in enumerate(distributions):
+            if timestep < input_lengths[case]:
+                expected = lstm.output_labels.encode(batch.xys[case].y[timestep][0], True)
+                log_probabilities[case] += math.log2(distribution[expected])
+
+    return -sum([2**(-(log_probability / input_lengths[case])) for case, log_probability in enumerate(log_probabilities)])
+
+
+def loop_correct(lstm, batch, time_distributions):
+    # The number of correct predictions, as scored case by case before it was vectorized.
+    total_correct = 0
+
+    for timestep, distributions in enumerate(time_distributions):
+        for case, distribution in enumerate(distributions):
+            if timestep == len(batch.xys[case].x) - 1:
+                if lstm.output_labels.decode(int(np.argmax(distribution))) == batch.xys[case].y:
+                    total_correct += 1
+
+    return total_correct
+
+
+class Tests(TestCase):
+    def assert_batches(self, lstm, xys, y_is_sequence):
+        encoded = lstm.encode(xys)
+        self.assertEqual(len(encoded), len(xys))
+        self.assertIs(lstm.encode(encoded), encoded)
+        # Bucketed by length (stably, so equal lengths keep their order).
+        self.assertEqual(encoded.xys, sorted(xys, key=lambda xy: len(xy.x)))
+
+        for start, end in [(0, len(xys)), (0, 1), (1, 4), (2, 5), (3, 100)]:
+            batch = encoded.batch(start, end)
+            input_labels, input_lengths, output_labels = time_major_feed(lstm, encoded.xys[start:end], y_is_sequence)
+            self.assertEqual(batch.xys, encoded.xys[start:end])
+            self.assertEqual(batch.inputs.tolist(), input_labels, (start, end))
+            self.assertEqual(batch.lengths.tolist(), input_lengths, (start, end))
+            self.assertEqual(batch.outputs.tolist(), output_labels, (start, end))
+
+    def test_encode_lm(self):
+        lstm = lstm_lm()
+        self.assert_batches(lstm, lm_xys(), True)
+        feed = lstm.get_training_feed(lstm.encode(lm_xys()).batch(0, 3), mlbase.TrainingParameters())
+        self.assertEqual(feed[lstm.unrolled_outputs_p].shape, feed[lstm.unrolled_inputs_p].shape)
+
+    def test_encode_sa(self):
+        lstm = lstm_sa()
+        self.assert_batches(lstm, sa_xys(), False)
+        batch = lstm.encode(sa_xys()).batch(1, 4)
+        # The gathers select the last timestep of each sequence.
+        self.assertEqual(lstm.input_gathers(batch).tolist(), [[len(xy.x) - 1, i] for i, xy in enumerate(batch.xys)])
+
+    def test_encode_empty(self):
+        for lstm, outputs_shape in [(lstm_lm(), (0, 0)), (lstm_sa(), (0,))]:
+            encoded = lstm.encode([])
+            self.assertEqual(len(encoded), 0)
+            batch = encoded.batch(0, 32)
+            self.assertEqual(len(batch), 0)
+            self.assertEqual(batch.inputs.shape, (0, 0))
+            self.assertEqual(batch.outputs.shape, outputs_shape)
+
+    def test_score_lm(self):
+        lstm = lstm_lm()
+        encoded = lstm.encode(lm_xys())
+
+        for start, end in [(0, len(encoded)), (1, 4), (4, 6)]:
+            batch = encoded.batch(start, end)
+            distributions = time_distributions(batch, lstm.output_labels)
+            # The padded timesteps are blanks, whose probabilities must not count.
+            self.assertIn(lstm.word_labels.encode(mlbase.BLANK), batch.outputs.tolist()[-1])
+            self.assertAlmostEqual(lstm.score(batch, distributions, False, 1), loop_perplexity(lstm, batch, distributions), places=4)
+            self.assertAlmostEqual(lstm.score(batch, distributions, True, 1), loop_perplexity(lstm, batch, distributions), places=4)
+
+    def test_score_sa(self):
+        lstm = lstm_sa()
+        encoded = lstm.encode(sa_xys())
+
+        for start, end in [(0, len(encoded)), (1, 4), (4, 6)]:
+            batch = encoded.batch(start, end)
+            distributions = time_distributions(batch, lstm.output_labels)
+            self.assertEqual(lstm.score(batch, distributions, False, 1), loop_correct(lstm, batch, distributions))
+            self.assertEqual(lstm.score(batch, distributions, True, 1), loop_correct(lstm, batch, distributions))
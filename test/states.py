@@ -0,0 +1,132 @@
+import collections
+import logging
+import numpy as np
+import os
+import queue
+import random
+import tempfile
+from unittest import TestCase
+
+from nnwd import pickler
+from nnwd import prefixes
+from nnwd import states
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+KEYS = ["cells-0", "outputs-0", "embedding-0"]
+COUNT = 400
+
+
+def hidden_states(key):
+    return [states.HiddenState("w%d" % (i % 7), (float(i), 1.0), "%s-%d" % (key, i)) for i in range(COUNT)]
+
+
+class Tests(TestCase):
+    def write_states(self, states_dir, backend, manifest=True):
+        previous = pickler.TARGET_FILE_SIZE
+        # Many small shards, so that there are plenty of units to sample.
+        pickler.TARGET_FILE_SIZE = 1024
+
+        try:
+            for key in KEYS:
+                states.set_hidden_states(states_dir, "train", key, hidden_states(key), backend=backend)
+
+                if not manifest:
+                    os.remove(os.path.join(states_dir, states.STATES_TRAIN + "." + key, pickler.MANIFEST))
+        finally:
+            pickler.TARGET_FILE_SIZE = previous
+
+    def sample(self, states_dir, sample_rate, sampling):
+        counts = collections.Counter()
+        annotations = set()
+
+        for key, hidden_state in states.random_stream_hidden_states(states_dir, "train", None, sample_rate, sampling, shuffle_size=100):
+            counts[key] += 1
+            annotations.add(hidden_state.annotation)
+            # Each state is streamed with the key it was set for.
+            self.assertTrue(hidden_state.annotation.startswith(key + "-"), (key, hidden_state))
+
+        return counts, annotations
+
+    def test_sampling(self):
+        np.random.seed(1)
+        random.seed(1)
+
+        for backend in [states.PICKLER, states.COLUMNAR]:
+            for sampling in states.SAMPLINGS:
+                with tempfile.TemporaryDirectory() as states_dir:
+                    self.write_states(states_dir, backend)
+                    counts, annotations = self.sample(states_dir, 1.0, sampling)
+                    self.assertEqual(counts, {key: COUNT for key in KEYS}, (backend, sampling))
+                    self.assertEqual(len(annotations), COUNT * len(KEYS), (backend, sampling))
+
+                    counts, annotations = self.sample(states_dir, 0.25, sampling)
+                    # Every key is reachable, and sampled at (roughly) the sample rate.
+                    self.assertEqual(set(counts.keys()), set(KEYS), (backend, sampling))
+
+                    if backend == states.COLUMNAR and sampling == states.SAMPLE_SHARDS:
+                        # Each key is a single columnar chunk, which is always kept.
+                        continue
+
+                    self.assertLess(abs(sum(counts.values()) - (0.25 * COUNT * len(KEYS))), 0.1 * COUNT * len(KEYS), (backend, sampling, counts))
+
+    def test_sampling_shards_low_rate(self):
+        np.random.seed(2)
+
+        with tempfile.TemporaryDirectory() as states_dir:
+            self.write_states(states_dir, states.PICKLER)
+            counts, annotations = self.sample(states_dir, 0.001, states.SAMPLE_SHARDS)
+            # Even when the rate would round every shard away, each key keeps one.
+            self.assertEqual(set(counts.keys()), set(KEYS))
+
+    def test_sampling_without_manifest(self):
+        random.seed(3)
+
+        for sampling in [states.SAMPLE_ITEMS, states.SAMPLE_SHARDS]:
+            with tempfile.TemporaryDirectory() as states_dir:
+                self.write_states(states_dir, states.PICKLER, manifest=False)
+                counts, annotations = self.sample(states_dir, 1.0, sampling)
+                self.assertEqual(counts, {key: COUNT for key in KEYS}, sampling)
+                counts, annotations = self.sample(states_dir, 0.25, sampling)
+                self.assertEqual(set(counts.keys()), set(KEYS), sampling)
+                self.assertLess(abs(sum(counts.values()) - (0.25 * COUNT * len(KEYS))), 0.1 * COUNT * len(KEYS), (sampling, counts))
+
+    def test_prefix_states(self):
+        sequences = [("the",), ("the", "little"), ("a",), ("prince",)]
+        prefix_states = [states.PrefixState(*prefixes.prefix_key(sequence), np.full([2, 1, 1, 3], i, dtype="float32"), np.full([1, 2], i, dtype="float32")) for i, sequence in enumerate(sequences)]
+
+        with tempfile.TemporaryDirectory() as states_dir:
+            self.assertIsNone(states.get_prefix_states(states_dir))
+
+            # The rows are sorted once they have all been written, so they can't be streamed (asynchronously).
+            with self.assertRaises(ValueError):
+                states.set_prefix_states(states_dir, ["outputs", "cells"], 1, 3, 2, queue.Queue())
+
+            states.set_prefix_states(states_dir, ["outputs", "cells"], 1, 3, 2, iter(prefix_states))
+            store = states.get_prefix_states(states_dir)
+            self.assertEqual(len(store), len(sequences))
+
+            for i, sequence in enumerate(sequences):
+                state, instruments = store.get(sequence, ["embedding", "cells"])
+                self.assertEqual(instruments["embedding"].tolist(), [[i, i]], sequence)
+                self.assertEqual(instruments["cells"].tolist(), [[i, i, i]], sequence)
+
+    def test_shuffle(self):
+        random.seed(4)
+        stream = [i for i in range(1000)]
+        shuffled = [item for item in states._shuffle(iter(stream), 10)]
+        self.assertEqual(sorted(shuffled), stream)
+        self.assertNotEqual(shuffled, stream)
+
+        # An item is only ever yielded once it (and the buffer before it) has been read.
+        for position, item in enumerate(shuffled):
+            self.assertLessEqual(item, position + 10)
+
+        # Streams shorter than the buffer are still mixed.
+        shuffled = [item for item in states._shuffle(iter(stream[:5]), 10)]
+        self.assertEqual(sorted(shuffled), stream[:5])
+        self.assertEqual([item for item in states._shuffle(iter([]), 10)], [])
@@ -0,0 +1,37 @@
+import logging
+import numpy as np
+from unittest import TestCase
+
+from nnwd.vocabulary import Vocabulary
+from pytils.invigilator import create_suite
+
+
+def tests():
+    return create_suite(Tests)
+
+
+class Tests(TestCase):
+    def test_encode_decode(self):
+        vocabulary = Vocabulary()
+        encoded = vocabulary.encode(["the", "little", "the", "prince"])
+        self.assertEqual(encoded.dtype, np.int32)
+        self.assertEqual(encoded.tolist(), [0, 1, 0, 2])
+        self.assertEqual(vocabulary.decode(encoded), ("the", "little", "the", "prince"))
+        self.assertEqual(len(vocabulary), 3)
+        self.assertEqual(Vocabulary(vocabulary.values()).encode(["prince"]).tolist(), [2])
+
+    def test_sequence(self):
+        vocabulary = Vocabulary()
+        sequence = [("the", "DT"), ("prince", "NN"), ("the", None)]
+        encoded = vocabulary.encode_sequence(sequence)
+        self.assertEqual(encoded.shape, (3, 2))
+        self.assertEqual(vocabulary.decode_sequence(encoded), sequence)
+        self.assertEqual(vocabulary.decode_words(encoded), ("the", "prince", "the"))
+        self.assertTrue(np.array_equal(encoded, vocabulary.encode_sequence(sequence)))
+        self.assertEqual(vocabulary.encode_sequence([]).shape, (0, 2))
+
+    def test_lookup(self):
+        vocabulary = Vocabulary(["the", "prince"])
+        self.assertEqual(vocabulary.lookup(["prince", "the"]), (1, 0))
+        self.assertIsNone(vocabulary.lookup(["the", "fox"]))
+        self.assertEqual(len(vocabulary), 2)